@@ -2,8 +2,10 @@ import os
 import requests
 import json
 import stripe
-from flask import Flask, render_template, redirect, url_for, flash, request, session, g
+from flask import Flask, render_template, redirect, url_for, flash, request, session, g, jsonify
+from flask.ctx import _AppCtxGlobals
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import DeclarativeBase
 from flask_login import LoginManager, current_user, login_user, logout_user, login_required
 from werkzeug.middleware.proxy_fix import ProxyFix
@@ -21,7 +23,7 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_pre_ping": True,
 }
 app.secret_key = os.environ.get("SESSION_SECRET", secrets.token_hex(16))
-app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
 
 db.init_app(app)
 
@@ -30,32 +32,184 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-from models import User
+import assets
+from availability import AvailabilityIndex
+from checkout_sessions import CheckoutSessions
+from metrics import Metrics
+from query_inspector import QueryInspector
+from page_cache import PageCache
+from profiler import RequestProfiler
+from passwords import PasswordHashingBusy
+from shared_cache import SharedCache
+from stripe_catalog import StripeCatalog
+from stripe_client import StripeTransport, StripeUnavailable
+from stripe_webhooks import StripeWebhooks
+from write_behind import WriteBehindQueue
+from models import (User, Principal, add_missing_columns, add_missing_indexes,
+                    conflicting_field, normalize_email)
 from forms import LoginForm, RegistrationForm, SettingsForm
 
+# Serve hashed, precompressed static files when `python assets.py build` has run
+assets.init_app(app)
+
+# Request, query and template timings for Prometheus at /metrics
+metrics = Metrics(app, db, name=os.environ.get("SHARED_CACHE_NAME", "discobots"))
+
+# Flags slow statements and N+1 patterns when QUERY_INSPECTOR is log or strict
+query_inspector = QueryInspector(app, db)
+
+# Profiles requests carrying PROFILER_TOKEN, or a PROFILE_SAMPLE_RATE share of them
+profiler = RequestProfiler(app)
+
+# Shared by every gunicorn worker on the host, so pages are rendered once
+# per host rather than once per worker
+shared_cache = SharedCache(os.environ.get("SHARED_CACHE_NAME", "discobots"))
+
+def page_version(app):
+    # The pricing section shows the catalog, so a catalog change renders pages anew
+    return f'{assets.version(app)}.{stripe_catalog.version}'
+
+# Cache the rendered HTML of public pages for logged-out visitors
+page_cache = PageCache(app, store=shared_cache, version=page_version)
+
+# GET /api/availability for the register form's as-you-type checks
+availability = AvailabilityIndex(app, db, User)
+
+# Configure Stripe
+stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
+
+# Send Stripe calls elsewhere, e.g. to stripe_stub.py for offline load tests
+stripe.api_base = os.environ.get('STRIPE_API_BASE', stripe.api_base)
+
+# Pooled connections, timeouts, retries and a circuit breaker for Stripe calls
+stripe_transport = StripeTransport(app)
+
+# Stripe events at POST /stripe/webhook, when STRIPE_WEBHOOK_SECRET is set
+stripe_webhooks = StripeWebhooks(app)
+
+# Products, prices and vouchers synced from Stripe into the database and kept
+# in memory, for the pricing section and checkout
+stripe_catalog = StripeCatalog(app, db, webhooks=stripe_webhooks)
+
+# The voucher advertised on the pricing page; its coupon is created in Stripe
+# with these terms if missing, and after that Stripe's copy is what counts
+stripe_catalog.require_voucher('Uflvb62d', advertised=True, percent_off=30, duration='once',
+                               name='30% Off Special Offer')
+
+# Shown and sold until the first sync from Stripe has filled the catalog
+stripe_catalog.fallback_plan('prod_S5lpY8QkDBwJhx', 'Standard', 599, 'usd')
+
+# Hand out a visitor's open checkout session again rather than making another
+checkout_sessions = CheckoutSessions(app, store=shared_cache, webhooks=stripe_webhooks)
+
+# Session key holding the logged-in user's Principal snapshot
+PRINCIPAL_KEY = 'principal'
+
+# How long workers remember a user's current profile version; after that
+# the next page view reads it from the database again. The shared cache is
+# per host and only spares queries: with several hosts (autoscale deploys),
+# a change saved through another host is noticed here once the entry expires.
+PRINCIPAL_VERSION_TTL = 60
+
+def principal_version_key(user_id):
+    return f'user-version:{user_id}'
+
+def remember_principal(user):
+    """Store user's snapshot in the session and publish its version.
+
+    Call after login and after every write to the user's profile, with the
+    version already bumped, so other sessions of the same user notice.
+    """
+    principal = Principal.from_user(user)
+    session[PRINCIPAL_KEY] = principal.to_dict()
+    shared_cache.set(principal_version_key(user.id), user.version, ttl=PRINCIPAL_VERSION_TTL)
+    return principal
+
+def publish_flushed_versions(pending):
+    # Sessions that queued these writes reload the rows that now hold them
+    for user_id, values in pending.items():
+        shared_cache.set(principal_version_key(user_id), values['version'],
+                         ttl=PRINCIPAL_VERSION_TTL)
+
+# Theme and language toggles are saved in the background, a few at a time
+preferences = WriteBehindQueue(app, db, User, version='version',
+                               on_flush=publish_flushed_versions)
+
+def queue_preference(**values):
+    """Apply a theme or language change to the session now and save it later.
+
+    The snapshot keeps the version it was read at, which the queued write is
+    based on: the write only lands on a row still at that version, and the
+    snapshot is trusted only while the row is, after which it is read again.
+    Both preferences are queued, as the snapshot may hold a toggle queued on
+    another worker.
+    """
+    snapshot = current_user.to_dict()
+    snapshot.update(values)
+    session[PRINCIPAL_KEY] = snapshot
+    preferences.queue(current_user.id, theme=snapshot['theme'], language=snapshot['language'],
+                      version=snapshot['version'])
+
+def wants_json():
+    return request.accept_mimetypes.best == 'application/json'
+
 @login_manager.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    user_id = int(id)
+    # Trust the session snapshot while it matches the version the workers on
+    # this host know, so page views need no database query. The snapshot may
+    # hold a queued preference change that isn't in the database yet; it is
+    # still the newest state until the row's version moves on.
+    snapshot = session.get(PRINCIPAL_KEY)
+    if snapshot and snapshot['id'] == user_id:
+        version = shared_cache.get(principal_version_key(user_id))
+        if version is None:
+            # Not known on this host: the database has the say, not the snapshot
+            version = db.session.scalar(db.select(User.version).filter_by(id=user_id))
+            if version is None:
+                return None
+            shared_cache.set(principal_version_key(user_id), version, ttl=PRINCIPAL_VERSION_TTL)
+        if snapshot['version'] == version:
+            return Principal(**snapshot)
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    return remember_principal(user)
 
-@app.before_request
-def before_request():
-    g.user = current_user
-    if current_user.is_authenticated:
-        g.theme = current_user.theme
-        g.language = current_user.language
-    else:
-        g.theme = session.get('theme', 'light')
-        g.language = session.get('language', 'en')
+class RequestGlobals(_AppCtxGlobals):
+    """flask.g that works out the visitor's user, theme and language the
+    first time a view or template reads them.
+
+    Requests that never look at them, such as static files, don't load the
+    user at all. Note that g.get('theme') only sees values already resolved.
+    """
+
+    def __getattr__(self, name):
+        if name not in ('user', 'theme', 'language'):
+            return super().__getattr__(name)
+        self.user = current_user
+        if current_user.is_authenticated:
+            self.theme = current_user.theme
+            self.language = current_user.language
+        else:
+            self.theme = session.get('theme', 'light')
+            self.language = session.get('language', 'en')
+        return self.__dict__[name]
+
+app.app_ctx_globals_class = RequestGlobals
 
 @app.route('/')
+@page_cache.cached
 def index():
-    return render_template('index.html', title='DiscoBots - Home')
+    return render_template('index.html', title='DiscoBots - Home', pricing=stripe_catalog.pricing())
 
 @app.route('/discord')
+@page_cache.cached
 def discord():
     return render_template('discord.html', title='DiscoBots - Join Our Discord')
 
 @app.route('/terms')
+@page_cache.cached
 def terms():
     return render_template('terms.html', title='DiscoBots - Terms & Privacy')
 
@@ -66,10 +220,19 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
-        if user is None or not user.check_password(form.password.data):
-            flash('Invalid username or password')
+        try:
+            if user is None or not user.check_password(form.password.data):
+                flash('Invalid username or password')
+                return redirect(url_for('login'))
+            # Upgrade hashes made with older cost parameters while we have the password
+            if user.password_needs_rehash():
+                user.set_password(form.password.data)
+                db.session.commit()
+        except PasswordHashingBusy:
+            flash('We are receiving a lot of sign-ins right now. Please try again in a moment.')
             return redirect(url_for('login'))
         login_user(user, remember=form.remember_me.data)
+        remember_principal(user)
         next_page = request.args.get('next')
         if not next_page or urlparse(next_page).netloc != '':
             next_page = url_for('index')
@@ -79,6 +242,7 @@ def login():
 @app.route('/logout')
 def logout():
     logout_user()
+    session.pop(PRINCIPAL_KEY, None)
     return redirect(url_for('index'))
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -87,10 +251,22 @@ def register():
         return redirect(url_for('index'))
     form = RegistrationForm()
     if form.validate_on_submit():
-        user = User(username=form.username.data, email=form.email.data)
-        user.set_password(form.password.data)
+        user = User(username=form.username.data, email=normalize_email(form.email.data))
+        try:
+            user.set_password(form.password.data)
+        except PasswordHashingBusy:
+            flash('We are receiving a lot of sign-ups right now. Please try again in a moment.')
+            return redirect(url_for('register'))
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            field = conflicting_field(e)
+            if field is None:
+                raise
+            form.add_conflict_error(field)
+            return render_template('register.html', title='Register', form=form)
         flash('Congratulations, you are now a registered user!')
         return redirect(url_for('login'))
     return render_template('register.html', title='Register', form=form)
@@ -100,9 +276,15 @@ def register():
 def settings():
     form = SettingsForm()
     if form.validate_on_submit():
-        current_user.theme = form.theme.data
-        current_user.language = form.language.data
+        user = current_user.user
+        # A toggle queued before this save is older; the version bump makes
+        # every worker's queue skip it, and this one need not write it at all
+        preferences.discard(user.id)
+        user.theme = form.theme.data
+        user.language = form.language.data
+        user.bump_version()
         db.session.commit()
+        remember_principal(user)
         flash('Your changes have been saved.')
         return redirect(url_for('settings'))
     elif request.method == 'GET':
@@ -115,10 +297,11 @@ def set_language(language):
     if language not in ['en', 'fr']:
         language = 'en'
     if current_user.is_authenticated:
-        current_user.language = language
-        db.session.commit()
+        queue_preference(language=language)
     else:
         session['language'] = language
+    if wants_json():
+        return jsonify({'language': language})
     return redirect(request.referrer or url_for('index'))
 
 @app.route('/set_theme/<theme>')
@@ -126,83 +309,80 @@ def set_theme(theme):
     if theme not in ['light', 'dark']:
         theme = 'light'
     if current_user.is_authenticated:
-        current_user.theme = theme
-        db.session.commit()
+        queue_preference(theme=theme)
     else:
         session['theme'] = theme
+    if wants_json():
+        return jsonify({'theme': theme})
     return redirect(request.referrer or url_for('index'))
 
 @app.route('/create-checkout-session', methods=['GET', 'POST'])
 def create_checkout_session():
-    # Set Stripe API key from environment variable
-    stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
-
     # Get domain for success and cancel URLs
     domain_url = request.host_url.rstrip('/')
     
-    # Get voucher code from the query parameters (if provided)
+    # Get the product (the first on sale by default) and voucher code from the
+    # query parameters (if provided)
+    product_id = request.args.get('product')
     voucher_code = request.args.get('voucher')
     
     try:
+        # The price and voucher come from the catalog, so this asks Stripe nothing
+        line_items = stripe_catalog.line_items(product_id)
+        if line_items is None:
+            flash('This product is not on sale right now.')
+            return redirect(url_for('index'))
+        voucher = stripe_catalog.voucher(voucher_code)
+        
         # Create checkout session parameters
         checkout_params = {
             'payment_method_types': ['card'],
-            'line_items': [
-                {
-                    'price_data': {
-                        'currency': 'usd',
-                        'unit_amount': 599,  # $5.99 in cents
-                        'product': 'prod_S5lpY8QkDBwJhx',  # Using the specific product ID
-                    },
-                    'quantity': 1,
-                },
-            ],
+            'line_items': line_items,
             'mode': 'payment',
             'success_url': domain_url + url_for('checkout_success'),
             'cancel_url': domain_url + url_for('checkout_cancel'),
         }
         
-        # If voucher code is provided and it matches our special code, apply discount
-        if voucher_code == "Uflvb62d":
-            # Create a discount coupon on the fly if it doesn't exist
-            try:
-                # Check if the coupon already exists
-                stripe.Coupon.retrieve("Uflvb62d")
-            except Exception:
-                # Create the coupon if it doesn't exist
-                stripe.Coupon.create(
-                    id="Uflvb62d",
-                    percent_off=30,
-                    duration="once",
-                    name="30% Off Special Offer"
-                )
-            
+        if voucher is not None:
             # Add the discount to the checkout session
             checkout_params['discounts'] = [
                 {
-                    'coupon': "Uflvb62d",
+                    'coupon': voucher['code'],
                 }
             ]
         else:
             # Only allow promotion codes if not applying a specific discount
             checkout_params['allow_promotion_codes'] = True
         
-        # Create the checkout session with all parameters
-        checkout_session = stripe.checkout.Session.create(**checkout_params)
+        # Reuse the visitor's open session for the same purchase, if any;
+        # otherwise create the checkout session with all parameters
+        owner = checkout_sessions.owner(current_user.id if current_user.is_authenticated else None)
+        checkout_url = checkout_sessions.get_or_create(
+            (owner, repr(line_items), voucher['code'] if voucher is not None else None,
+             checkout_params['success_url'], checkout_params['cancel_url']),
+            lambda: stripe.checkout.Session.create(**checkout_params))
         
-        return redirect(checkout_session.url, code=303)
+        return redirect(checkout_url, code=303)
+    except StripeUnavailable:
+        flash('Checkout is unavailable right now. Please try again in a few minutes.')
+        return redirect(url_for('index'))
     except Exception as e:
         app.logger.error(f"Error creating checkout session: {str(e)}")
         flash('An error occurred while processing your payment. Please try again.')
         return redirect(url_for('index'))
 
 @app.route('/checkout/success')
+@page_cache.cached
 def checkout_success():
     return render_template('checkout_success.html', title='Payment Successful')
 
 @app.route('/checkout/cancel')
+@page_cache.cached
 def checkout_cancel():
     return render_template('checkout_cancel.html', title='Payment Cancelled')
 
 with app.app_context():
-    db.create_all()
\ No newline at end of file
+    db.create_all()
+    add_missing_columns(User, stripe_catalog.Voucher)
+    add_missing_indexes(User)
+    availability.build()
\ No newline at end of file
@@ -0,0 +1,376 @@
+"""
+DiscoBots.fr - Static asset pipeline
+
+Builds content-hashed, minified and precompressed copies of the files in
+static/ and teaches the Flask app to serve them.
+
+Build:
+    python assets.py build                       # static/ -> static/dist/
+    python assets.py build --frontend frontend   # also update the Netlify bundle
+
+The build writes static/dist/manifest.json mapping each source path to its
+hashed copy. Once init_app(app) has been called, url_for('static',
+filename='css/styles.css') resolves to the hashed copy, which is served with
+an immutable Cache-Control header and as the .br/.gz sibling matching the
+request's Accept-Encoding. Without a manifest the app falls back to serving
+static/ as before.
+
+When Pillow is installed, the build also writes resized AVIF/WebP/PNG
+variants of each image and records them in the manifest. The picture()
+template helper turns those into a <picture> element with srcset, width,
+height and loading attributes, and the frontend build rewrites the static
+site's <img> tags the same way.
+"""
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import request, send_from_directory, url_for
+from markupsafe import Markup, escape
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is only needed to build image variants
+    Image = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+
+# Files worth compressing; images like PNG are already compressed
+COMPRESSIBLE = {'.css', '.js', '.ico', '.svg', '.json', '.txt'}
+
+# Hashed files never change, so browsers may cache them forever
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Where static/ files live in the Netlify bundle when the path differs
+FRONTEND_PATHS = {
+    'favicon.ico': 'img/favicon.ico',
+}
+
+# Widths generated for each image; covers 1x-3x of the 40px header logo
+# as well as larger in-page uses
+IMAGE_WIDTHS = (40, 80, 120, 240, 480, 960)
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+
+# Variant formats, best first. The last one is the <img> fallback.
+IMAGE_FORMATS = (
+    ('avif', 'image/avif', {'quality': 55}),
+    ('webp', 'image/webp', {'quality': 80, 'method': 6}),
+    ('png', 'image/png', {'optimize': True}),
+)
+
+# ==================
+# BUILD
+# ==================
+
+def minify_css(source):
+    source = re.sub(r'/\*.*?\*/', '', source, flags=re.S)
+    source = re.sub(r'\s+', ' ', source)
+    source = re.sub(r'\s*([{};,>])\s*', r'\1', source)
+    # A space before ':' can be a descendant combinator (".a :hover"), so
+    # only the one after it goes
+    source = re.sub(r':\s+', ':', source)
+    return source.replace(';}', '}').strip()
+
+def minify_js(source):
+    # Deliberately conservative: strip indentation, blank lines and whole-line
+    # comments but keep line breaks so automatic semicolon insertion still works
+    lines = []
+    for line in source.splitlines():
+        line = line.strip()
+        if line and not line.startswith('//'):
+            lines.append(line)
+    return '\n'.join(lines)
+
+MINIFIERS = {
+    '.css': minify_css,
+    '.js': minify_js,
+}
+
+def hashed_name(path, content):
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{hashlib.sha256(content).hexdigest()[:10]}{ext}"
+
+def source_files(static_dir):
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = sorted(d for d in dirs if d != DIST_DIR)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, static_dir).replace(os.sep, '/')
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+def image_formats():
+    """Variant formats this Pillow build can write."""
+    extensions = Image.registered_extensions()
+    return [fmt for fmt in IMAGE_FORMATS if f'.{fmt[0]}' in extensions]
+
+def build_image_variants(path, content, dist_dir):
+    """Write resized variants of an image and return its manifest fields."""
+    with Image.open(io.BytesIO(content)) as image:
+        image.load()
+        width, height = image.size
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+
+        stem = os.path.splitext(path)[0]
+        variants = []
+        for variant_width in IMAGE_WIDTHS:
+            if variant_width >= width:
+                break
+            variant_height = round(height * variant_width / width)
+            resized = image.resize((variant_width, variant_height), Image.LANCZOS)
+            for fmt, mimetype, options in image_formats():
+                buffer = io.BytesIO()
+                resized.save(buffer, fmt.upper(), **options)
+                variant = buffer.getvalue()
+                output = hashed_name(f'{stem}-{variant_width}w.{fmt}', variant)
+                write_file(os.path.join(dist_dir, output), variant)
+                variants.append({'file': output, 'type': mimetype,
+                                 'width': variant_width, 'height': variant_height})
+    return {'width': width, 'height': height, 'variants': variants}
+
+def build(static_dir=STATIC_DIR):
+    """Build static/dist/ and return the manifest."""
+    dist_dir = os.path.join(static_dir, DIST_DIR)
+    shutil.rmtree(dist_dir, ignore_errors=True)
+
+    manifest = {}
+    for path in source_files(static_dir):
+        ext = os.path.splitext(path)[1].lower()
+        with open(os.path.join(static_dir, path), 'rb') as f:
+            content = f.read()
+        if ext in MINIFIERS:
+            content = MINIFIERS[ext](content.decode('utf-8')).encode('utf-8')
+
+        output = hashed_name(path, content)
+        output_path = os.path.join(dist_dir, output)
+        write_file(output_path, content)
+
+        encodings = []
+        if ext in COMPRESSIBLE:
+            if brotli is not None:
+                write_file(output_path + '.br', brotli.compress(content))
+                encodings.append('br')
+            write_file(output_path + '.gz', gzip.compress(content, compresslevel=9, mtime=0))
+            encodings.append('gzip')
+
+        manifest[path] = {'file': output, 'encodings': encodings}
+        if ext in IMAGE_EXTENSIONS and Image is not None:
+            manifest[path].update(build_image_variants(path, content, dist_dir))
+
+    with open(os.path.join(dist_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+def build_frontend(manifest, frontend_dir, static_dir=STATIC_DIR):
+    """Copy the hashed files into the Netlify bundle and point its HTML at them.
+
+    Netlify compresses responses itself, so only the hashed files are copied;
+    netlify.toml marks /dist/* as immutable.
+    """
+    dist_dir = os.path.join(frontend_dir, DIST_DIR)
+    shutil.rmtree(dist_dir, ignore_errors=True)
+
+    replacements = {}
+    images = {}
+    for path, entry in manifest.items():
+        files = [entry['file']] + [variant['file'] for variant in entry.get('variants', ())]
+        for file in files:
+            target = os.path.join(dist_dir, file)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(os.path.join(static_dir, DIST_DIR, file), target)
+        frontend_path = FRONTEND_PATHS.get(path, path)
+        replacements[f'/{frontend_path}'] = f"/{DIST_DIR}/{entry['file']}"
+        if entry.get('variants'):
+            images[f'/{frontend_path}'] = entry
+
+    def frontend_url(file):
+        return f'/{DIST_DIR}/{file}'
+
+    def rewrite_img(match):
+        attrs = dict(IMG_ATTR.findall(match.group(0)))
+        entry = images.get(attrs.pop('src', None))
+        if entry is None:
+            return match.group(0)
+        width = attrs.pop('width', None)
+        height = attrs.pop('height', None)
+        return picture_markup(entry, frontend_url, attrs.pop('alt', ''),
+                              width=int(width) if width else None,
+                              height=int(height) if height else None,
+                              # An <img> without one loads eagerly, as before
+                              loading=attrs.pop('loading', None), **attrs)
+
+    pattern = re.compile(r'(?<=["\'])(%s)(?=["\'])' % '|'.join(
+        re.escape(path) for path in sorted(replacements, key=len, reverse=True)))
+    for name in sorted(os.listdir(frontend_dir)):
+        if not name.endswith('.html'):
+            continue
+        html_path = os.path.join(frontend_dir, name)
+        with open(html_path, encoding='utf-8') as f:
+            html = f.read()
+        rewritten = IMG_TAG.sub(rewrite_img, html)
+        rewritten = pattern.sub(lambda m: replacements[m.group(1)], rewritten)
+        if rewritten != html:
+            with open(html_path, 'w', encoding='utf-8') as f:
+                f.write(rewritten)
+
+# ==================
+# RESPONSIVE IMAGES
+# ==================
+
+IMG_TAG = re.compile(r'<img\s[^>]*>')
+IMG_ATTR = re.compile(r'([\w-]+)="([^"]*)"')
+
+def picture_markup(entry, url, alt, width=None, height=None, sizes=None,
+                   loading='lazy', **attrs):
+    """Render a <picture> element for a manifest image entry.
+
+    width/height are the rendered CSS size; whichever is missing is derived
+    from the image's aspect ratio. url maps a dist file to its public URL.
+    loading=None leaves the attribute out, for the browser's eager default.
+    """
+    if width is None and height is None:
+        width, height = entry['width'], entry['height']
+    elif width is None:
+        width = round(height * entry['width'] / entry['height'])
+    elif height is None:
+        height = round(width * entry['height'] / entry['width'])
+    sizes = sizes or f'{width}px'
+
+    by_type = {}
+    for variant in entry['variants']:
+        by_type.setdefault(variant['type'], []).append(variant)
+    fallback_type = IMAGE_FORMATS[-1][1]
+    fallbacks = by_type.pop(fallback_type, [])
+
+    def srcset(variants):
+        return ', '.join(f"{url(v['file'])} {v['width']}w" for v in variants)
+
+    html = ['<picture>']
+    for mimetype, variants in by_type.items():
+        html.append(f'<source type="{mimetype}" srcset="{escape(srcset(variants))}" '
+                    f'sizes="{escape(sizes)}">')
+
+    # Smallest fallback that still looks sharp on a 2x display
+    src = next((v['file'] for v in fallbacks if v['width'] >= 2 * width), entry['file'])
+    img = [f'src="{escape(url(src))}"']
+    if fallbacks:
+        img.append(f'srcset="{escape(srcset(fallbacks))}" sizes="{escape(sizes)}"')
+    img.append(f'alt="{escape(alt)}" width="{width}" height="{height}"')
+    if loading is not None:
+        img.append(f'loading="{escape(loading)}"')
+    img.append('decoding="async"')
+    img.extend(f'{name.rstrip("_")}="{escape(value)}"' for name, value in attrs.items())
+    html.append(f'<img {" ".join(img)}>')
+    html.append('</picture>')
+    return Markup(''.join(html))
+
+# ==================
+# FLASK INTEGRATION
+# ==================
+
+def load_manifest(static_dir):
+    try:
+        with open(os.path.join(static_dir, DIST_DIR, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def init_app(app):
+    """Serve the built assets for url_for('static', ...) if a manifest exists."""
+    manifest = load_manifest(app.static_folder)
+    app.extensions['assets'] = manifest
+    app.extensions['assets_version'] = hashlib.sha256(
+        json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+    def dist_url(file):
+        return url_for('static', filename=f'{DIST_DIR}/{file}')
+
+    @app.template_global()
+    def picture(filename, alt, width=None, height=None, **kwargs):
+        """<picture> for a static image, or a plain <img> before the first build."""
+        entry = manifest.get(filename)
+        if entry is None or not entry.get('variants'):
+            size = ''.join(f' {name}="{value}"' for name, value in
+                           (('width', width), ('height', height)) if value is not None)
+            return Markup(f'<img src="{escape(url_for("static", filename=filename))}" '
+                          f'alt="{escape(alt)}"{size}>')
+        return picture_markup(entry, dist_url, alt, width=width, height=height, **kwargs)
+
+    if not manifest:
+        return
+
+    # Precompressed siblings available for each hashed file, keyed by the
+    # filename the static endpoint receives
+    encodings = {}
+    for entry in manifest.values():
+        encodings[f"{DIST_DIR}/{entry['file']}"] = entry['encodings']
+        for variant in entry.get('variants', ()):
+            encodings[f"{DIST_DIR}/{variant['file']}"] = []
+
+    @app.url_defaults
+    def hashed_static_url(endpoint, values):
+        if endpoint == 'static':
+            entry = manifest.get(values.get('filename'))
+            if entry is not None:
+                values['filename'] = f"{DIST_DIR}/{entry['file']}"
+
+    def static(filename):
+        if filename not in encodings:
+            return app.send_static_file(filename)
+
+        mimetype = mimetypes.guess_type(filename)[0]
+        for encoding in encodings[filename]:
+            if request.accept_encodings[encoding]:
+                suffix = '.br' if encoding == 'br' else '.gz'
+                response = send_from_directory(app.static_folder, filename + suffix,
+                                               mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(app.static_folder, filename,
+                                           max_age=IMMUTABLE_MAX_AGE)
+        if encodings[filename]:
+            response.vary.add('Accept-Encoding')
+        response.cache_control.immutable = True
+        return response
+
+    app.view_functions['static'] = static
+
+def version(app):
+    """Short hash of the current build, for keying caches of rendered pages."""
+    return app.extensions['assets_version']
+
+# ==================
+# MAIN EXECUTION
+# ==================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build hashed static assets.')
+    parser.add_argument('command', choices=['build'])
+    parser.add_argument('--frontend', metavar='DIR',
+                        help='also copy the hashed assets into this static site bundle')
+    args = parser.parse_args()
+
+    manifest = build()
+    if args.frontend:
+        build_frontend(manifest, args.frontend)
+    print(f"Built {len(manifest)} assets into static/{DIST_DIR}/")
@@ -0,0 +1,178 @@
+"""
+DiscoBots.fr - Username and email availability checks
+
+The register form asks GET /api/availability as the visitor types. Each
+worker keeps a Bloom filter of every taken username and (lower-cased) email,
+built from the User table at startup and extended whenever a user is
+inserted, so the common "still available" answer needs no query. Only
+possible matches are confirmed against the database.
+
+Users inserted by other workers reach this worker's filter at the next
+periodic rebuild; until then they may be reported as available. The unique
+constraints still reject them at registration, so the answer is only advice.
+
+Usage:
+    availability = AvailabilityIndex(app, db, User)
+
+    with app.app_context():
+        availability.build()
+"""
+
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import jsonify, request
+from sqlalchemy import event, func
+
+class BloomFilter:
+    """Bloom filter over strings sized for capacity entries at error_rate.
+
+    Pass the bits of a filter built with the same capacity and error_rate,
+    e.g. one shared between workers, to reuse it.
+    """
+
+    def __init__(self, capacity, error_rate=0.01, bits=None):
+        size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.bits = bytearray(bits) if bits is not None else bytearray((size + 7) // 8)
+        self.size = len(self.bits) * 8
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=4 * self.hashes).digest()
+        for i in range(self.hashes):
+            yield int.from_bytes(digest[4 * i:4 * i + 4], 'little') % self.size
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+class RateLimiter:
+    """Per-client token bucket: burst requests at once, then rate per second."""
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, client):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            self._buckets[client] = (tokens - 1 if allowed else tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return allowed
+
+def normalize_username(username):
+    return username.strip()
+
+def normalize_email(email):
+    return email.strip().lower()
+
+class AvailabilityIndex:
+    def __init__(self, app=None, db=None, model=None):
+        self.db = db
+        self.model = model
+        self.filter = BloomFilter(1)
+        self._lock = threading.Lock()
+        self._rebuild_at = 0
+        if app is not None:
+            self.init_app(app, db, model)
+
+    def init_app(self, app, db, model):
+        app.config.setdefault('AVAILABILITY_REBUILD_INTERVAL', 10 * 60)
+        app.config.setdefault('AVAILABILITY_RATE', 2)
+        app.config.setdefault('AVAILABILITY_BURST', 20)
+        self.db = db
+        self.model = model
+        self.rebuild_interval = app.config['AVAILABILITY_REBUILD_INTERVAL']
+        self.limiter = RateLimiter(app.config['AVAILABILITY_RATE'],
+                                   app.config['AVAILABILITY_BURST'])
+        event.listen(model, 'after_insert', self._on_insert)
+        app.add_url_rule('/api/availability', 'availability', self.view)
+        app.extensions['availability'] = self
+
+    # ==================
+    # FILTER
+    # ==================
+
+    @staticmethod
+    def _keys(username=None, email=None):
+        keys = {}
+        if username:
+            keys['username'] = 'username:' + normalize_username(username)
+        if email:
+            keys['email'] = 'email:' + normalize_email(email)
+        return keys
+
+    def build(self):
+        """Rebuild the filter from every row of the user table."""
+        rows = self.db.session.execute(
+            self.db.select(self.model.username, self.model.email)).all()
+        # Leave room for the users inserted before the next rebuild
+        bloom = BloomFilter(2 * len(rows) + 1000)
+        for username, email in rows:
+            for key in self._keys(username, email).values():
+                bloom.add(key)
+        self.filter = bloom
+        self._rebuild_at = time.monotonic() + self.rebuild_interval
+
+    def _on_insert(self, mapper, connection, target):
+        # A rolled-back insert leaves a stale entry, which only costs a query
+        for key in self._keys(target.username, target.email).values():
+            self.filter.add(key)
+
+    def _refresh(self):
+        if time.monotonic() < self._rebuild_at:
+            return
+        # One request rebuilds; the others keep using the current filter
+        if self._lock.acquire(blocking=False):
+            try:
+                self.build()
+            finally:
+                self._lock.release()
+
+    def is_taken(self, field, value):
+        column = getattr(self.model, field)
+        if field == 'email':
+            condition = func.lower(column) == normalize_email(value)
+        else:
+            condition = column == normalize_username(value)
+        return self.db.session.execute(
+            self.db.select(self.model.id).where(condition).limit(1)).first() is not None
+
+    def check(self, username=None, email=None):
+        """Map each given field to True if its value looks available."""
+        self._refresh()
+        values = {'username': username, 'email': email}
+        return {field: key not in self.filter or not self.is_taken(field, values[field])
+                for field, key in self._keys(username, email).items()}
+
+    # ==================
+    # VIEW
+    # ==================
+
+    def view(self):
+        if not self.limiter.allow(request.remote_addr):
+            response = jsonify({'message': 'Too many requests'})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(math.ceil(1 / self.limiter.rate))
+            return response
+        username = request.args.get('username', '')
+        email = request.args.get('email', '')
+        if not username.strip() and not email.strip():
+            return jsonify({'message': 'Give a username or an email to check'}), 400
+        response = jsonify(self.check(username.strip(), email.strip()))
+        response.headers['Cache-Control'] = 'no-store'
+        return response
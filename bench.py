@@ -0,0 +1,501 @@
+"""
+DiscoBots.fr - In-process benchmarks
+
+Drives app.py, discobots_api.py and discobots_all_in_one.py through their
+WSGI interface (Flask's test client, no sockets) against a throwaway SQLite
+database seeded with --users users. Stripe calls are answered by an
+in-process stub after --stripe-latency milliseconds, or over HTTP by
+stripe_stub.py when --stripe-api-base is given. Each app runs in its
+own subprocess, so module-level state (database URL, caches, hashing pools)
+doesn't leak from one app into the next.
+
+Scenarios:
+    pages_en, pages_fr   anonymous views of the public pages in each language
+    login                fresh clients signing in, each one checking a password
+    register             new accounts
+    settings             theme and language toggles by a signed-in user
+    checkout             checkout sessions, alternately with the voucher; each
+                         client reuses its open ones after the first two
+
+For every app and scenario it reports requests per second, latency
+percentiles, SQL statements per request and memory allocated per request.
+Allocations are measured in a separate tracemalloc pass because tracing
+slows everything down. Results are written as JSON and compared against a
+stored baseline; a scenario regresses when its throughput drops or its p90
+latency grows by more than --tolerance, or when it runs more queries.
+
+Usage:
+    python bench.py                           # everything, results in bench_results.json
+    python bench.py --apps app --scenarios pages_en login
+    python bench.py --save-baseline           # store the results as the baseline
+    python bench.py --threads 4               # requests from 4 threads at once
+
+Password hashing dominates login and register; pass e.g.
+--hash-method pbkdf2:sha256:1000 to benchmark the rest of the request.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from types import SimpleNamespace
+
+APPS = {
+    'app': 'app',
+    'api': 'discobots_api',
+    'all_in_one': 'discobots_all_in_one',
+}
+
+SCENARIOS = ('pages_en', 'pages_fr', 'login', 'register', 'settings', 'checkout')
+
+PASSWORD = 'benchmark-password'
+
+# ==================
+# STRIPE STUB
+# ==================
+
+class StripeStub:
+    """Stands in for the stripe calls the checkout views and catalog make."""
+
+    PRODUCT = {'id': 'prod_S5lpY8QkDBwJhx', 'name': 'DiscoBots Standard', 'active': True,
+               'default_price': 'price_bench'}
+    PRICE = {'id': 'price_bench', 'product': 'prod_S5lpY8QkDBwJhx', 'currency': 'usd',
+             'unit_amount': 599, 'type': 'one_time', 'active': True}
+
+    def __init__(self, stripe, latency):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+        stripe.checkout.Session.create = self.create_session
+        stripe.Coupon.retrieve = self.retrieve_coupon
+        stripe.Coupon.create = self.create_coupon
+        stripe.Coupon.list = self.lister()
+        stripe.Product.list = self.lister(self.PRODUCT)
+        stripe.Price.list = self.lister(self.PRICE)
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def create_session(self, **params):
+        self._call()
+        session_id = 'cs_test_' + uuid.uuid4().hex
+        return {'id': session_id, 'url': f'https://checkout.stripe.com/c/pay/{session_id}',
+                'expires_at': int(time.time()) + 24 * 60 * 60}
+
+    def retrieve_coupon(self, coupon_id, **params):
+        self._call()
+        return {'id': coupon_id, 'percent_off': 30, 'valid': True}
+
+    def create_coupon(self, **params):
+        self._call()
+        return {'valid': True, **params}
+
+    def lister(self, *objects):
+        def list(**params):
+            self._call()
+            return SimpleNamespace(auto_paging_iter=lambda: iter(objects))
+        return list
+
+# ==================
+# SCENARIOS
+# ==================
+
+class Bench:
+    """One app, imported in this process, with helpers the scenarios share."""
+
+    def __init__(self, name, module, users):
+        self.name = name
+        self.module = module
+        self.users = users
+        self.app = module.app
+        self.db = module.db
+        self.User = module.User
+        self.api = name == 'api'
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self._counter = itertools.count()
+        self._signed_in = itertools.count()
+        self._local = threading.local()
+
+    def unique(self, prefix):
+        return f'{prefix}{os.getpid()}x{next(self._counter)}'
+
+    def next_user(self):
+        # Signed-in clients each get their own user, so their settings don't collide
+        return next(self._signed_in) % self.users
+
+    # Queries are counted per thread, so concurrent requests don't mix
+    def count_query(self, *args):
+        self._local.queries = getattr(self._local, 'queries', 0) + 1
+
+    def queries(self):
+        return getattr(self._local, 'queries', 0)
+
+    def seed(self, users):
+        from sqlalchemy import insert
+        from sqlalchemy.schema import CreateIndex
+
+        with self.app.app_context():
+            self.db.create_all()
+            for index in self.User.__table__.indexes:
+                self.db.session.execute(CreateIndex(index, if_not_exists=True))
+            # Hash once; every seeded user shares the password
+            template = self.User(username='template', email='template@example.com')
+            template.set_password(PASSWORD)
+            rows = [{'username': f'user{i}', 'email': f'user{i}@example.com',
+                     'password_hash': template.password_hash} for i in range(users)]
+            for start in range(0, len(rows), 1000):
+                self.db.session.execute(insert(self.User), rows[start:start + 1000])
+            self.db.session.commit()
+            availability = self.app.extensions.get('availability')
+            if availability is not None:
+                availability.build()
+
+    def login(self, client, username='user0'):
+        if self.api:
+            response = client.post('/api/login', json={'username': username, 'password': PASSWORD})
+            return {'Authorization': 'Bearer ' + response.get_json()['token']}
+        client.post('/login', data={'username': username, 'password': PASSWORD})
+        return {}
+
+def pages(language):
+    paths = ('/', '/discord', '/terms')
+
+    def setup(bench, client):
+        if language == 'fr':
+            client.get('/set_language/fr')
+        return itertools.cycle(paths)
+
+    def run(bench, client, state, i):
+        return client.get(next(state))
+    return setup, run, {200}
+
+def login():
+    def setup(bench, client):
+        return None
+
+    def run(bench, client, state, i):
+        # A new client each time, like a storm of visitors signing in
+        client = bench.app.test_client()
+        username = f'user{i % bench.users}'
+        if bench.api:
+            return client.post('/api/login', json={'username': username, 'password': PASSWORD})
+        return client.post('/login', data={'username': username, 'password': PASSWORD})
+    return setup, run, {200, 302}
+
+def register():
+    def setup(bench, client):
+        return None
+
+    def run(bench, client, state, i):
+        username = bench.unique('new')
+        fields = {'username': username, 'email': f'{username}@example.com', 'password': PASSWORD}
+        if bench.api:
+            return client.post('/api/register', json=fields)
+        return client.post('/register', data={**fields, 'password2': PASSWORD})
+    return setup, run, {201, 302}
+
+def settings():
+    choices = itertools.cycle([('theme', 'dark'), ('language', 'fr'),
+                               ('theme', 'light'), ('language', 'en')])
+
+    def setup(bench, client):
+        return bench.login(client, f'user{bench.next_user()}')
+
+    def run(bench, client, headers, i):
+        field, value = next(choices)
+        if bench.api:
+            return client.put('/api/settings', json={field: value}, headers=headers)
+        return client.get(f'/set_{field}/{value}', headers={'Accept': 'application/json'})
+    return setup, run, {200}
+
+def checkout():
+    def setup(bench, client):
+        return bench.login(client, f'user{bench.next_user()}')
+
+    def run(bench, client, headers, i):
+        voucher = 'Uflvb62d' if i % 2 else None
+        if bench.api:
+            return client.post('/api/create-checkout-session',
+                               json={'voucher': voucher} if voucher else {}, headers=headers)
+        return client.get('/create-checkout-session',
+                          query_string={'voucher': voucher} if voucher else {})
+    return setup, run, {200, 303}
+
+def scenario(name):
+    if name.startswith('pages_'):
+        return pages(name[len('pages_'):])
+    return {'login': login, 'register': register,
+            'settings': settings, 'checkout': checkout}[name]()
+
+def applies(app_name, scenario_name):
+    # The API serves no pages
+    return not (app_name == 'api' and scenario_name.startswith('pages_'))
+
+# ==================
+# MEASUREMENT
+# ==================
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def measure(bench, name, requests, threads, warmup, alloc_samples):
+    setup, run, expected = scenario(name)
+    clients = []
+    for _ in range(threads):
+        client = bench.app.test_client()
+        clients.append((client, setup(bench, client)))
+
+    latencies = []
+    statuses = {}
+    queries = []
+    lock = threading.Lock()
+    counter = itertools.count()
+
+    def worker(client, state, count):
+        own_latencies, own_statuses, own_queries = [], {}, []
+        for _ in range(count):
+            i = next(counter)
+            before = bench.queries()
+            start = time.perf_counter()
+            response = run(bench, client, state, i)
+            own_latencies.append(time.perf_counter() - start)
+            own_queries.append(bench.queries() - before)
+            own_statuses[response.status_code] = own_statuses.get(response.status_code, 0) + 1
+            response.close()
+        with lock:
+            latencies.extend(own_latencies)
+            queries.extend(own_queries)
+            for status, count in own_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    for client, state in clients:
+        for _ in range(warmup):
+            run(bench, client, state, next(counter)).close()
+
+    per_thread = [requests // threads + (t < requests % threads) for t in range(threads)]
+    workers = [threading.Thread(target=worker, args=(client, state, count))
+               for (client, state), count in zip(clients, per_thread)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    # Peak memory traced while handling one request, on one thread
+    allocated = []
+    client, state = clients[0]
+    tracemalloc.start()
+    try:
+        for _ in range(alloc_samples):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            run(bench, client, state, next(counter)).close()
+            allocated.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    ms = 1000
+    return {
+        'requests': len(latencies),
+        'threads': threads,
+        'seconds': round(elapsed, 4),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies) * ms, 3) if latencies else 0.0,
+            'p50': round(percentile(latencies, 0.50) * ms, 3),
+            'p90': round(percentile(latencies, 0.90) * ms, 3),
+            'p99': round(percentile(latencies, 0.99) * ms, 3),
+            'max': round(latencies[-1] * ms, 3) if latencies else 0.0,
+        },
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else 0.0,
+        'alloc_kib_per_request': round(sum(allocated) / len(allocated) / 1024, 1) if allocated else 0.0,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'unexpected': sum(count for status, count in statuses.items() if status not in expected),
+    }
+
+def run_app(args):
+    """Benchmark one app; runs in a subprocess with the environment set up."""
+    from sqlalchemy import event
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    module = __import__(APPS[args.worker])
+    bench = Bench(args.worker, module, args.users)
+    if not os.environ.get('STRIPE_API_BASE'):
+        StripeStub(module.stripe, args.stripe_latency / 1000)
+    bench.seed(args.users)
+    with bench.app.app_context():
+        event.listen(bench.db.engine, 'after_cursor_execute', bench.count_query)
+
+    results = {}
+    for name in args.scenarios:
+        if applies(args.worker, name):
+            results[name] = measure(bench, name, args.requests, args.threads,
+                                    args.warmup, args.alloc_samples)
+    with open(args.result_file, 'w') as f:
+        json.dump(results, f)
+
+# ==================
+# DRIVER
+# ==================
+
+def spawn(app_name, args, directory):
+    result_file = os.path.join(directory, f'{app_name}.json')
+    cache_name = f'bench-{app_name}-{uuid.uuid4().hex[:8]}'
+    env = dict(os.environ,
+               DATABASE_URL='sqlite:///' + os.path.join(directory, f'{app_name}.db'),
+               SHARED_CACHE_NAME=cache_name,
+               METRICS_DIR=os.path.join(directory, f'{app_name}-metrics'),
+               SESSION_SECRET='bench', STRIPE_SECRET_KEY='sk_test_bench')
+    for name in ('PROFILER_TOKEN', 'PROFILE_SAMPLE_RATE', 'QUERY_INSPECTOR'):
+        env.pop(name, None)
+    if args.hash_method:
+        env['PASSWORD_HASH_METHOD'] = args.hash_method
+    if args.stripe_api_base:
+        env['STRIPE_API_BASE'] = args.stripe_api_base
+    else:
+        env.pop('STRIPE_API_BASE', None)
+    command = [sys.executable, os.path.abspath(__file__), '--worker', app_name,
+               '--result-file', result_file,
+               '--users', str(args.users), '--requests', str(args.requests),
+               '--threads', str(args.threads), '--warmup', str(args.warmup),
+               '--alloc-samples', str(args.alloc_samples),
+               '--stripe-latency', str(args.stripe_latency),
+               '--scenarios', *args.scenarios]
+    try:
+        completed = subprocess.run(command, env=env, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.PIPE, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f'{app_name} benchmark failed:\n{completed.stderr}')
+        with open(result_file) as f:
+            return json.load(f)
+    finally:
+        from shared_cache import default_path
+        try:
+            os.unlink(default_path(cache_name))
+        except FileNotFoundError:
+            pass
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+def compare(results, baseline, tolerance):
+    """List the ways results are worse than baseline."""
+    regressions = []
+    for key, current in results['results'].items():
+        previous = baseline.get('results', {}).get(key)
+        if previous is None:
+            continue
+        if current['throughput'] < previous['throughput'] * (1 - tolerance):
+            regressions.append(f"{key}: throughput {previous['throughput']} -> {current['throughput']} req/s")
+        if current['latency_ms']['p90'] > previous['latency_ms']['p90'] * (1 + tolerance):
+            regressions.append(f"{key}: p90 {previous['latency_ms']['p90']} -> {current['latency_ms']['p90']} ms")
+        if current['queries_per_request'] > previous['queries_per_request']:
+            regressions.append(f"{key}: queries per request {previous['queries_per_request']}"
+                               f" -> {current['queries_per_request']}")
+    return regressions
+
+def print_table(results):
+    print(f"{'app/scenario':<24}{'req/s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"
+          f"{'queries':>9}{'KiB':>9}  statuses")
+    for key, result in results['results'].items():
+        latency = result['latency_ms']
+        statuses = ' '.join(f'{status}x{count}' for status, count in result['statuses'].items())
+        print(f"{key:<24}{result['throughput']:>10}{latency['p50']:>10}{latency['p90']:>10}"
+              f"{latency['p99']:>10}{result['queries_per_request']:>9}"
+              f"{result['alloc_kib_per_request']:>9}  {statuses}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--apps', nargs='+', choices=APPS, default=list(APPS))
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--users', type=int, default=1000, help='users seeded into the database')
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per scenario')
+    parser.add_argument('--threads', type=int, default=1, help='threads sending requests at once')
+    parser.add_argument('--warmup', type=int, default=5, help='untimed requests per thread first')
+    parser.add_argument('--alloc-samples', type=int, default=20,
+                        help='requests measured under tracemalloc')
+    parser.add_argument('--stripe-latency', type=float, default=50,
+                        help='milliseconds each stubbed Stripe call takes')
+    parser.add_argument('--stripe-api-base',
+                        help='send Stripe calls to this URL, e.g. a running stripe_stub.py')
+    parser.add_argument('--hash-method', help='PASSWORD_HASH_METHOD for the benchmarked apps')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', default='bench_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='write the results to --baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='relative slowdown allowed before flagging a regression')
+    parser.add_argument('--worker', choices=APPS, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_app(args)
+        return 0
+
+    directory = tempfile.mkdtemp(prefix='discobots-bench-')
+    try:
+        results = {}
+        for app_name in args.apps:
+            print(f'Benchmarking {APPS[app_name]}.py...', file=sys.stderr)
+            for name, result in spawn(app_name, args, directory).items():
+                results[f'{app_name}/{name}'] = result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        'revision': git_revision(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'settings': {name: getattr(args, name) for name in
+                     ('users', 'requests', 'threads', 'warmup', 'stripe_latency',
+                      'stripe_api_base', 'hash_method')},
+        'results': results,
+    }
+    print_table(report)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {args.output}', file=sys.stderr)
+    if any(result['unexpected'] for result in results.values()):
+        print('Some requests got unexpected statuses; see the statuses column', file=sys.stderr)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Baseline saved to {args.baseline}', file=sys.stderr)
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('settings') != report['settings']:
+        print(f"Note: the baseline was run with {baseline.get('settings')}", file=sys.stderr)
+    regressions = compare(report, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}', file=sys.stderr)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+DiscoBots.fr - Reuse of open Stripe Checkout sessions
+
+Every click on the pricing button used to create a new Checkout session, so
+double-clicks, back-button retries and refreshes each cost a call to Stripe,
+and during a promotion they add up against its rate limit. CheckoutSessions
+remembers the session made for a visitor, product and voucher, and hands its
+URL out again while the session is still open.
+
+An entry lasts CHECKOUT_SESSION_REUSE_TTL seconds, and never longer than
+until a minute before Stripe expires the session. Stripe's checkout.session
+events (completed, expired, async payment succeeded or failed) drop it
+straight away once the webhook endpoint is set up. Without the webhook, a
+visitor who has paid is sent back to the paid session until the entry times
+out, and Stripe shows them that it is complete.
+
+Concurrent requests for the same entry in one worker share one call to
+Stripe. With a shared store, entries are seen by every worker on the host;
+otherwise each worker keeps its own.
+
+Configuration (environment variables):
+    CHECKOUT_SESSION_REUSE_TTL   seconds an open session is reused (default 900)
+
+Usage:
+    checkout_sessions = CheckoutSessions(app, store=shared_cache, webhooks=stripe_webhooks)
+
+    owner = checkout_sessions.owner(user_id)  # an anonymous visitor when user_id is None
+    url = checkout_sessions.get_or_create(
+        (owner, product_id, coupon_id), lambda: stripe.checkout.Session.create(...))
+"""
+
+import hashlib
+import os
+import secrets
+import time
+
+from flask import session
+
+from page_cache import MemoryStore
+from stripe_catalog import SingleFlight, as_dict
+
+KEY_PREFIX = 'checkout-session:'
+
+# Maps a session id back to its entry, for webhook events
+ID_PREFIX = 'checkout-session-id:'
+
+# Flask session key of the random id given to anonymous visitors
+OWNER_SESSION_KEY = 'checkout_owner'
+
+# Stop handing a session out this many seconds before Stripe expires it
+EXPIRY_MARGIN = 60
+
+class CheckoutSessions:
+    def __init__(self, app=None, store=None, webhooks=None):
+        self.store = store
+        self._flights = SingleFlight()
+        if app is not None:
+            self.init_app(app, store, webhooks)
+
+    def init_app(self, app, store=None, webhooks=None):
+        app.config.setdefault('CHECKOUT_SESSION_REUSE_TTL',
+                              float(os.environ.get('CHECKOUT_SESSION_REUSE_TTL', 900)))
+        self.app = app
+        self.store = store if store is not None else MemoryStore(max_entries=4096)
+        self.ttl = app.config['CHECKOUT_SESSION_REUSE_TTL']
+        metrics = app.extensions.get('metrics')
+        self.registry = metrics.registry if metrics is not None else None
+        if webhooks is not None:
+            webhooks.subscribe('checkout.session.', self.invalidate)
+        app.extensions['checkout_sessions'] = self
+
+    @staticmethod
+    def owner(user_id=None):
+        """Who a session is for: the user, or a random id kept in the visitor's session."""
+        if user_id is not None:
+            return f'user:{user_id}'
+        token = session.get(OWNER_SESSION_KEY)
+        if token is None:
+            token = session[OWNER_SESSION_KEY] = secrets.token_urlsafe(16)
+        return f'anon:{token}'
+
+    @staticmethod
+    def _key(parts):
+        digest = hashlib.sha256('\0'.join(map(str, parts)).encode()).hexdigest()
+        return KEY_PREFIX + digest[:32]
+
+    def _count(self, outcome):
+        if self.registry is not None:
+            self.registry.inc('checkout_sessions_total', (outcome,))
+
+    def get_or_create(self, parts, create):
+        """The URL of the open session for parts, or of a new one made by create()."""
+        key = self._key(parts)
+        entry = self.store.get(key)
+        if entry is not None:
+            self._count('reused')
+            return entry['url']
+        created = False
+
+        def run():
+            nonlocal created
+            created = True
+            return self._create(key, create)
+
+        url = self._flights.do(key, run)
+        self._count('created' if created else 'reused')
+        return url
+
+    def _create(self, key, create):
+        checkout_session = as_dict(create())
+        ttl = self.ttl
+        if checkout_session.get('expires_at'):
+            ttl = min(ttl, checkout_session['expires_at'] - time.time() - EXPIRY_MARGIN)
+        if ttl > 0:
+            entry = {'id': checkout_session['id'], 'url': checkout_session['url']}
+            self.store.set(key, entry, ttl=ttl)
+            self.store.set(ID_PREFIX + entry['id'], key, ttl=ttl)
+        return checkout_session['url']
+
+    def invalidate(self, obj, event_type=None):
+        """Stop reusing the session obj; subscribed to checkout.session events."""
+        session_id = obj['id']
+        key = self.store.get(ID_PREFIX + session_id)
+        if key is None:
+            return
+        entry = self.store.get(key)
+        # The entry may already hold a newer session
+        if entry is not None and entry['id'] == session_id:
+            self.store.delete(key)
+        self.store.delete(ID_PREFIX + session_id)
@@ -28,22 +28,100 @@ To run:
    - DATABASE_URL: PostgreSQL connection string
    - STRIPE_SECRET_KEY: Your Stripe secret key
    - SESSION_SECRET: Random string for Flask session encryption
+   - INLINE_FIRST_VISIT_ASSETS: Set to 1 to inline CSS/JS/images on a visitor's first page view (optional)
 3. Run: python discobots_all_in_one.py
 """
 
 import os
+import base64
+import gzip
+import hashlib
 from datetime import datetime
-from flask import Flask, render_template_string, url_for, flash, redirect, request, g, session
+from flask import Flask, Response, jsonify, render_template, url_for, flash, redirect, request, g, session
+from flask.ctx import _AppCtxGlobals
 from flask_login import LoginManager, UserMixin, login_user, logout_user, current_user, login_required
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import FlaskForm
+from jinja2 import DictLoader
+from markupsafe import Markup
+from sqlalchemy import func, inspect, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.schema import CreateColumn, CreateIndex
 from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
 from wtforms import StringField, PasswordField, BooleanField, SubmitField, SelectField
-from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError
+from wtforms.validators import DataRequired, Email, EqualTo, Length
 import stripe
 
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+try:
+    import passwords
+    from passwords import PasswordHashingBusy
+except ImportError:  # without it passwords are hashed in the request's own thread
+    passwords = None
+
+    class PasswordHashingBusy(Exception):
+        """Only raised by passwords.py."""
+
+try:
+    from integrity import conflicting_field
+except ImportError:  # without it a failed registration looks up which field is taken
+    conflicting_field = None
+
+try:
+    from metrics import Metrics
+except ImportError:  # /metrics is only served when metrics.py is deployed alongside
+    Metrics = None
+
+try:
+    from query_inspector import QueryInspector
+except ImportError:  # likewise for the slow-query and N+1 detector
+    QueryInspector = None
+
+try:
+    from profiler import RequestProfiler
+except ImportError:  # and for on-demand request profiling
+    RequestProfiler = None
+
+try:
+    from stripe_client import StripeTransport, StripeUnavailable
+except ImportError:  # without it Stripe calls use the library's default client
+    StripeTransport = None
+
+    class StripeUnavailable(Exception):
+        """Only raised by stripe_client.py."""
+
+try:
+    from stripe_catalog import StripeCatalog
+    from stripe_webhooks import StripeWebhooks
+except ImportError:  # without them the pricing below is fixed
+    StripeCatalog = None
+
+try:
+    from shared_cache import SharedCache
+except ImportError:  # without it each worker keeps caches of its own
+    SharedCache = None
+
+try:
+    from page_cache import PageCache
+except ImportError:  # without it every page is rendered for every visitor
+    PageCache = None
+
+try:
+    from write_behind import WriteBehindQueue
+except ImportError:  # without it theme and language toggles are saved straight away
+    WriteBehindQueue = None
+
+try:
+    from checkout_sessions import CheckoutSessions
+except ImportError:  # without it every click creates a new checkout session
+    CheckoutSessions = None
+
 # ==================
 # DATABASE SETUP
 # ==================
@@ -71,6 +149,24 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 # Initialize extensions
 db.init_app(app)
 
+# Request, query and template timings for Prometheus at /metrics
+if Metrics is not None:
+    metrics = Metrics(app, db)
+
+# Flags slow statements and N+1 patterns when QUERY_INSPECTOR is log or strict
+if QueryInspector is not None:
+    query_inspector = QueryInspector(app, db)
+
+# Profiles requests carrying PROFILER_TOKEN, or a PROFILE_SAMPLE_RATE share of them
+if RequestProfiler is not None:
+    profiler = RequestProfiler(app)
+
+# Shared by every gunicorn worker on the host, so pages are rendered once
+# per host rather than once per worker
+shared_cache = None
+if SharedCache is not None:
+    shared_cache = SharedCache(os.environ.get("SHARED_CACHE_NAME", "discobots"))
+
 # Set up login manager
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -79,6 +175,55 @@ login_manager.login_view = 'login'
 # Configure Stripe
 stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
 
+# Send Stripe calls elsewhere, e.g. to stripe_stub.py for offline load tests
+stripe.api_base = os.environ.get('STRIPE_API_BASE', stripe.api_base)
+
+# Pooled connections, timeouts, retries and a circuit breaker for Stripe calls
+if StripeTransport is not None:
+    stripe_transport = StripeTransport(app)
+
+# Products, prices and vouchers synced from Stripe into the database and kept
+# in memory, for the pricing section and checkout; Stripe events arrive at
+# POST /stripe/webhook when STRIPE_WEBHOOK_SECRET is set
+stripe_webhooks = None
+stripe_catalog = None
+if StripeCatalog is not None:
+    stripe_webhooks = StripeWebhooks(app)
+    stripe_catalog = StripeCatalog(app, db, webhooks=stripe_webhooks)
+    # The voucher advertised on the pricing page; its coupon is created in
+    # Stripe with these terms if missing, and after that Stripe's copy counts
+    stripe_catalog.require_voucher('Uflvb62d', advertised=True, percent_off=30, duration='once',
+                                   name='30% Off Special Offer')
+    # Shown and sold until the first sync from Stripe has filled the catalog
+    stripe_catalog.fallback_plan('prod_S5lpY8QkDBwJhx', 'Standard', 599, 'usd')
+
+# What the pricing section shows and checkout sells without stripe_catalog.py
+FIXED_PRICING = {
+    'plans': [{'id': 'prod_S5lpY8QkDBwJhx', 'name': 'Standard',
+               'price': {'currency': 'usd', 'unit_amount': 599, 'display': '$5.99'}}],
+    'voucher': {'code': 'Uflvb62d', 'label': '30%'},
+}
+
+def pricing():
+    return stripe_catalog.pricing() if stripe_catalog is not None else FIXED_PRICING
+
+# Hand out a visitor's open checkout session again rather than making another
+checkout_sessions = None
+if CheckoutSessions is not None:
+    checkout_sessions = CheckoutSessions(app, store=shared_cache, webhooks=stripe_webhooks)
+
+# Inline the CSS, JS and images into the HTML for visitors who haven't
+# fetched the cached asset files yet (set INLINE_FIRST_VISIT_ASSETS=1)
+app.config["INLINE_FIRST_VISIT_ASSETS"] = os.environ.get("INLINE_FIRST_VISIT_ASSETS", "0") == "1"
+ASSET_COOKIE = 'assets'
+
+# Cache the rendered HTML of public pages for logged-out visitors
+app.config["PAGE_CACHE_ENABLED"] = True
+app.config["PAGE_CACHE_TTL"] = 300
+
+# Seconds between background saves of theme and language toggles
+app.config["WRITE_BEHIND_INTERVAL"] = 2.0
+
 # ==================
 # DATABASE MODELS
 # ==================
@@ -90,12 +235,75 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(256))
     theme = db.Column(db.String(20), default='light')
     language = db.Column(db.String(10), default='en')
+    # Bumped by every preference change, so a queued toggle never overwrites
+    # one saved after the toggle's session read the row
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    
+    # Addresses differing only in case belong to the same person
+    __table_args__ = (db.Index('uq_user_email_lower', func.lower(email), unique=True),)
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        if passwords is None:
+            self.password_hash = generate_password_hash(password)
+        else:
+            self.password_hash = passwords.hash_password(password)
         
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if passwords is None:
+            return check_password_hash(self.password_hash, password)
+        return passwords.verify_password(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return passwords is not None and passwords.needs_rehash(self.password_hash)
+
+def taken_field(user):
+    """The field of user another account already has, looked up with a query.
+
+    Only used without integrity.py, which reads it off the IntegrityError.
+    """
+    if db.session.query(User.id).filter_by(username=user.username).first() is not None:
+        return 'username'
+    if db.session.query(User.id).filter(func.lower(User.email) == user.email.lower()).first() is not None:
+        return 'email'
+    return None
+
+# ==================
+# PREFERENCE WRITES
+# ==================
+
+# Theme and language toggles are saved in the background, a few at a time;
+# each write is based on the row's version and dropped if the row moved on
+preference_writes = None
+if WriteBehindQueue is not None:
+    preference_writes = WriteBehindQueue(app, db, User, version='version')
+
+# Session key holding the User version the session's toggles were made on
+PREFERENCES_VERSION_KEY = 'preferences_version'
+
+def preferences_pending():
+    """True while the session holds toggles the User row may not have yet.
+
+    That is the case while the row is still at the version they were made
+    on. Once it has moved on, whether because they were saved or because a
+    change was saved from another session, the row wins.
+    """
+    return session.get(PREFERENCES_VERSION_KEY) == current_user.version
+
+def queue_preferences():
+    """Save the session's theme and language to the user row, later if possible."""
+    theme, language = session['theme'], session['language']
+    if preference_writes is None:
+        current_user.theme, current_user.language = theme, language
+        current_user.version = User.version + 1
+        db.session.commit()
+        g.theme, g.language = theme, language
+        return
+    # Both are queued, as the session may hold a toggle queued on another worker
+    preference_writes.queue(current_user.id, theme=theme, language=language,
+                            version=current_user.version)
+    session[PREFERENCES_VERSION_KEY] = current_user.version
+    # The rest of this request sees the change too
+    g.theme, g.language = theme, language
 
 # ==================
 # FORMS
@@ -115,15 +323,15 @@ class RegistrationForm(FlaskForm):
         'Repeat Password', validators=[DataRequired(), EqualTo('password')])
     submit = SubmitField('Create Account')
     
-    def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).first()
-        if user is not None:
-            raise ValidationError('Please use a different username.')
-            
-    def validate_email(self, email):
-        user = User.query.filter_by(email=email.data).first()
-        if user is not None:
-            raise ValidationError('Please use a different email address.')
+    # Uniqueness is enforced by the database when the user is inserted, so
+    # the register view reports conflicts after the fact
+    conflict_messages = {
+        'username': 'Please use a different username.',
+        'email': 'Please use a different email address.',
+    }
+    
+    def add_conflict_error(self, field_name):
+        getattr(self, field_name).errors.append(self.conflict_messages[field_name])
 
 class SettingsForm(FlaskForm):
     theme = SelectField('Theme', choices=[('light', 'White'), ('dark', 'Black')])
@@ -142,31 +350,89 @@ def load_user(id):
 # UTILITY FUNCTIONS
 # ==================
 
-@app.before_request
-def before_request():
-    g.user = current_user
-    if current_user.is_authenticated:
-        g.theme = current_user.theme
-        g.language = current_user.language
-    else:
-        g.theme = session.get('theme', 'light')
-        g.language = session.get('language', 'en')
+class RequestGlobals(_AppCtxGlobals):
+    """flask.g that works out the visitor's user, theme, language and asset
+    mode the first time a view or template reads them.
+
+    Asset requests never look at them, so they don't load the user at all.
+    Note that g.get('theme') only sees values already resolved.
+    """
+
+    def __getattr__(self, name):
+        if name == 'inline_assets':
+            self.inline_assets = (app.config["INLINE_FIRST_VISIT_ASSETS"]
+                                  and request.cookies.get(ASSET_COOKIE) != ASSET_VERSION)
+        elif name in ('user', 'theme', 'language'):
+            self.user = current_user
+            if current_user.is_authenticated and not preferences_pending():
+                self.theme = current_user.theme
+                self.language = current_user.language
+            elif current_user.is_authenticated:
+                # The session holds toggles that may not be saved yet
+                self.theme = session.get('theme', current_user.theme)
+                self.language = session.get('language', current_user.language)
+            else:
+                self.theme = session.get('theme', 'light')
+                self.language = session.get('language', 'en')
+        else:
+            return super().__getattr__(name)
+        return self.__dict__[name]
+
+app.app_ctx_globals_class = RequestGlobals
+
+@app.context_processor
+def inject_asset_mode():
+    return {'inline_assets': g.inline_assets}
+
+@app.after_request
+def remember_inlined_assets(response):
+    # Once the assets went out inline, the browser fetches the linked
+    # versions in the background and can use its cache from then on
+    if g.get('inline_assets') and response.status_code == 200 and response.mimetype == 'text/html':
+        response.set_cookie(ASSET_COOKIE, ASSET_VERSION, max_age=365 * 24 * 60 * 60,
+                            httponly=True, samesite='Lax')
+    return response
+
+def asset_url(name):
+    return url_for('embedded_asset', filename=EMBEDDED_ASSETS[name].filename)
+
+# ==================
+# PAGE CACHE
+# ==================
+
+def page_version(app):
+    # Pages with inlined assets differ from those linking them, and the
+    # pricing section shows the catalog
+    catalog_version = stripe_catalog.version if stripe_catalog is not None else ''
+    return f'{ASSET_VERSION}.{int(g.inline_assets)}.{catalog_version}'
+
+# Cache the rendered HTML of public pages for logged-out visitors; set up
+# with the app once the templates are registered below
+page_cache = None
+if PageCache is not None:
+    page_cache = PageCache(store=shared_cache, version=page_version)
+
+def cached_page(view):
+    return page_cache.cached(view) if page_cache is not None else view
 
 # ==================
 # ROUTES
 # ==================
 
 @app.route('/')
+@cached_page
 def index():
-    return render_template_string(TEMPLATE_INDEX)
+    return render_template('index.html', pricing=pricing())
 
 @app.route('/discord')
+@cached_page
 def discord():
-    return render_template_string(TEMPLATE_DISCORD)
+    return render_template('discord.html')
 
 @app.route('/terms')
+@cached_page
 def terms():
-    return render_template_string(TEMPLATE_TERMS)
+    return render_template('terms.html')
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -175,15 +441,26 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
-        if user is None or not user.check_password(form.password.data):
-            flash('Invalid username or password')
+        try:
+            if user is None or not user.check_password(form.password.data):
+                flash('Invalid username or password')
+                return redirect(url_for('login'))
+            # Upgrade hashes made with older cost parameters while we have the password
+            if user.password_needs_rehash():
+                user.set_password(form.password.data)
+                db.session.commit()
+        except PasswordHashingBusy:
+            flash('We are receiving a lot of sign-ins right now. Please try again in a moment.')
             return redirect(url_for('login'))
         login_user(user, remember=form.remember_me.data)
+        session['theme'] = user.theme
+        session['language'] = user.language
+        session.pop(PREFERENCES_VERSION_KEY, None)
         next_page = request.args.get('next')
         if not next_page or not next_page.startswith('/'):
             next_page = url_for('index')
         return redirect(next_page)
-    return render_template_string(TEMPLATE_LOGIN, form=form)
+    return render_template('login.html', form=form)
 
 @app.route('/logout')
 def logout():
@@ -196,91 +473,146 @@ def register():
         return redirect(url_for('index'))
     form = RegistrationForm()
     if form.validate_on_submit():
-        user = User(username=form.username.data, email=form.email.data)
-        user.set_password(form.password.data)
+        user = User(username=form.username.data, email=form.email.data.strip())
+        try:
+            user.set_password(form.password.data)
+        except PasswordHashingBusy:
+            flash('We are receiving a lot of sign-ups right now. Please try again in a moment.')
+            return redirect(url_for('register'))
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            field = conflicting_field(e) if conflicting_field is not None else taken_field(user)
+            if field is None:
+                raise
+            form.add_conflict_error(field)
+            return render_template('register.html', form=form)
         flash('Congratulations, you are now a registered user!')
         return redirect(url_for('login'))
-    return render_template_string(TEMPLATE_REGISTER, form=form)
+    return render_template('register.html', form=form)
 
 @app.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
     form = SettingsForm()
     if request.method == 'GET':
-        form.theme.data = current_user.theme
-        form.language.data = current_user.language
+        form.theme.data = g.theme
+        form.language.data = g.language
     if form.validate_on_submit():
+        # A toggle queued before this save is older; the version bump makes
+        # every worker's queue skip it, and this one need not write it at all
+        if preference_writes is not None:
+            preference_writes.discard(current_user.id)
         current_user.theme = form.theme.data
         current_user.language = form.language.data
+        current_user.version = User.version + 1
         db.session.commit()
         session['theme'] = current_user.theme
         session['language'] = current_user.language
+        session.pop(PREFERENCES_VERSION_KEY, None)
         flash('Your settings have been updated.')
         return redirect(url_for('settings'))
-    return render_template_string(TEMPLATE_SETTINGS, form=form)
+    return render_template('settings.html', form=form)
 
 @app.route('/set_language/<language>')
 def set_language(language):
     if language in ['en', 'fr']:
         if current_user.is_authenticated:
-            current_user.language = language
-            db.session.commit()
-        session['language'] = language
+            # Start from what the user currently sees, then apply the change
+            session['theme'] = g.theme
+            session['language'] = language
+            queue_preferences()
+        else:
+            session['language'] = language
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'language': g.language})
     return redirect(request.referrer or url_for('index'))
 
 @app.route('/set_theme/<theme>')
 def set_theme(theme):
     if theme in ['light', 'dark']:
         if current_user.is_authenticated:
-            current_user.theme = theme
-            db.session.commit()
-        session['theme'] = theme
+            # Start from what the user currently sees, then apply the change
+            session['language'] = g.language
+            session['theme'] = theme
+            queue_preferences()
+        else:
+            session['theme'] = theme
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'theme': g.theme})
     return redirect(request.referrer or url_for('index'))
 
 @app.route('/create-checkout-session')
 def create_checkout_session():
     try:
-        # The product ID for DiscoBots Standard plan
-        product_id = "prod_S5lpY8QkDBwJhx"
-        
-        # Apply discount voucher if provided
+        # Line items for the product (the first on sale by default) and the
+        # discount voucher, if provided and still redeemable
         voucher = request.args.get('voucher')
-        discount_code = None
-        
-        if voucher == 'Uflvb62d':
-            # 30% discount coupon
-            discount_code = 'Uflvb62d'
+        if stripe_catalog is not None:
+            line_items = stripe_catalog.line_items(request.args.get('product'))
+            if line_items is None:
+                flash('This product is not on sale right now.')
+                return redirect(url_for('index'))
+            voucher = stripe_catalog.voucher(voucher)
+            discount_code = voucher['code'] if voucher is not None else None
+        else:
+            plan = FIXED_PRICING['plans'][0]
+            line_items = [{
+                'price_data': {
+                    'currency': plan['price']['currency'],
+                    'unit_amount': plan['price']['unit_amount'],
+                    'product': plan['id'],
+                },
+                'quantity': 1,
+            }]
+            discount_code = voucher if voucher == FIXED_PRICING['voucher']['code'] else None
             
         domain_url = request.host_url.rstrip('/')
         
-        # Create line items
-        line_items = [{
-            'price': product_id,
-            'quantity': 1,
-        }]
-        
         # Create checkout session
-        checkout_session = stripe.checkout.Session.create(
+        success_url = domain_url + url_for('checkout_success')
+        cancel_url = domain_url + url_for('checkout_cancel')
+        create = lambda: stripe.checkout.Session.create(
             line_items=line_items,
             mode='payment',
-            success_url=domain_url + url_for('checkout_success'),
-            cancel_url=domain_url + url_for('checkout_cancel'),
+            success_url=success_url,
+            cancel_url=cancel_url,
             discounts=[{'coupon': discount_code}] if discount_code else [],
         )
+        if checkout_sessions is None:
+            checkout_url = create().url
+        else:
+            # Reuse the visitor's open session for the same purchase, if any;
+            # flask_login's id in the session spares loading the user row
+            owner = checkout_sessions.owner(session.get('_user_id'))
+            checkout_url = checkout_sessions.get_or_create(
+                (owner, repr(line_items), discount_code, success_url, cancel_url), create)
         
-        return redirect(checkout_session.url, code=303)
+        return redirect(checkout_url, code=303)
+    except StripeUnavailable:
+        flash('Checkout is unavailable right now. Please try again in a few minutes.')
+        return redirect(url_for('index'))
     except Exception as e:
         return str(e)
 
 @app.route('/checkout-success')
+@cached_page
 def checkout_success():
-    return render_template_string(TEMPLATE_CHECKOUT_SUCCESS)
+    return render_template('checkout_success.html')
 
 @app.route('/checkout-cancel')
+@cached_page
 def checkout_cancel():
-    return render_template_string(TEMPLATE_CHECKOUT_CANCEL)
+    return render_template('checkout_cancel.html')
+
+@app.route('/assets/<filename>')
+def embedded_asset(filename):
+    asset = ASSETS_BY_FILENAME.get(filename)
+    if asset is None:
+        return 'Not Found', 404
+    return asset.response()
 
 # ==================
 # HTML TEMPLATES
@@ -293,8 +625,13 @@ TEMPLATE_BASE = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>DiscoBots.fr - {% block title %}{% endblock %}</title>
+    {% if inline_assets %}
     <style>{{ css_styles }}</style>
     <link rel="icon" href="data:image/png;base64,{{ favicon_data }}">
+    {% else %}
+    <link rel="stylesheet" href="{{ asset_url('styles.css') }}">
+    <link rel="icon" href="{{ asset_url('favicon.png') }}">
+    {% endif %}
 </head>
 <body class="{{ g.theme }}">
     <canvas id="particles-js"></canvas>
@@ -303,7 +640,7 @@ TEMPLATE_BASE = """
         <div class="container">
             <div class="logo">
                 <a href="{{ url_for('index') }}">
-                    <img src="data:image/png;base64,{{ logo_data }}" alt="DiscoBots.fr">
+                    <img src="{% if inline_assets %}data:image/png;base64,{{ logo_data }}{% else %}{{ asset_url('logo.png') }}{% endif %}" alt="DiscoBots.fr">
                 </a>
             </div>
             <nav>
@@ -321,12 +658,12 @@ TEMPLATE_BASE = """
                 </ul>
             </nav>
             <div class="theme-toggle">
-                <a href="{{ url_for('set_theme', theme='light') }}" class="theme-btn {% if g.theme == 'light' %}active{% endif %}">☀️</a>
-                <a href="{{ url_for('set_theme', theme='dark') }}" class="theme-btn {% if g.theme == 'dark' %}active{% endif %}">🌙</a>
+                <a href="{{ url_for('set_theme', theme='light') }}" data-theme="light" class="theme-btn {% if g.theme == 'light' %}active{% endif %}">☀️</a>
+                <a href="{{ url_for('set_theme', theme='dark') }}" data-theme="dark" class="theme-btn {% if g.theme == 'dark' %}active{% endif %}">🌙</a>
             </div>
             <div class="language-toggle">
-                <a href="{{ url_for('set_language', language='en') }}" class="lang-btn {% if g.language == 'en' %}active{% endif %}">🇬🇧</a>
-                <a href="{{ url_for('set_language', language='fr') }}" class="lang-btn {% if g.language == 'fr' %}active{% endif %}">🇫🇷</a>
+                <a href="{{ url_for('set_language', language='en') }}" data-language="en" class="lang-btn {% if g.language == 'en' %}active{% endif %}">🇬🇧</a>
+                <a href="{{ url_for('set_language', language='fr') }}" data-language="fr" class="lang-btn {% if g.language == 'fr' %}active{% endif %}">🇫🇷</a>
             </div>
         </div>
     </header>
@@ -357,7 +694,7 @@ TEMPLATE_BASE = """
         <div class="container">
             <div class="footer-content">
                 <div class="footer-logo">
-                    <img src="data:image/png;base64,{{ logo_data }}" alt="DiscoBots.fr">
+                    <img src="{% if inline_assets %}data:image/png;base64,{{ logo_data }}{% else %}{{ asset_url('logo.png') }}{% endif %}" alt="DiscoBots.fr">
                 </div>
                 <div class="footer-links">
                     <ul>
@@ -379,8 +716,13 @@ TEMPLATE_BASE = """
         </div>
     </footer>
     
+    {% if inline_assets %}
     <script>{{ js_particles }}</script>
     <script>{{ js_main }}</script>
+    {% else %}
+    <script src="{{ asset_url('particles.js') }}"></script>
+    <script src="{{ asset_url('main.js') }}"></script>
+    {% endif %}
 </body>
 </html>
 """
@@ -456,32 +798,38 @@ TEMPLATE_INDEX = """
 <section class="pricing" id="pricing">
     <h2>{% if g.language == 'fr' %}Tarification{% else %}Pricing{% endif %}</h2>
     
+    {% if pricing.voucher %}
     <div class="promotion-banner">
         {% if g.language == 'fr' %}
-        <span>🔥 Offre Spéciale: Utilisez le code <span class="coupon-code">DISCO30</span> pour obtenir 30% de réduction! 🔥</span>
+        <span>🔥 Offre Spéciale: Utilisez le code <span class="coupon-code">{{ pricing.voucher.code }}</span> pour obtenir {{ pricing.voucher.label }} de réduction! 🔥</span>
         {% else %}
-        <span>🔥 Special Offer: Use code <span class="coupon-code">DISCO30</span> for 30% off! 🔥</span>
+        <span>🔥 Special Offer: Use code <span class="coupon-code">{{ pricing.voucher.code }}</span> for {{ pricing.voucher.label }} off! 🔥</span>
         {% endif %}
     </div>
+    {% endif %}
     
     <div class="pricing-grid">
+        {% for plan in pricing.plans %}
         <div class="pricing-card">
-            <h3>{% if g.language == 'fr' %}Standard{% else %}Standard{% endif %}</h3>
-            <div class="price">$5.99</div>
+            <h3>{{ plan.name }}</h3>
+            <div class="price">{{ plan.price.display }}</div>
             <ul class="pricing-features">
                 <li>{% if g.language == 'fr' %}Accès complet aux fonctionnalités{% else %}Full access to all features{% endif %}</li>
                 <li>{% if g.language == 'fr' %}Support prioritaire{% else %}Priority support{% endif %}</li>
                 <li>{% if g.language == 'fr' %}Jusqu'à 10 serveurs{% else %}Up to 10 servers{% endif %}</li>
             </ul>
-            <a href="{{ url_for('create_checkout_session') }}" class="cta-button">
+            <a href="{{ url_for('create_checkout_session', product=plan.id) }}" class="cta-button">
                 {% if g.language == 'fr' %}Acheter maintenant{% else %}Buy Now{% endif %}
             </a>
+            {% if pricing.voucher %}
             <div style="margin-top: 10px; font-size: 0.9em;">
-                <a href="{{ url_for('create_checkout_session', voucher='Uflvb62d') }}" style="text-decoration: underline;">
+                <a href="{{ url_for('create_checkout_session', product=plan.id, voucher=pricing.voucher.code) }}" style="text-decoration: underline;">
                     {% if g.language == 'fr' %}Utiliser le code promotion{% else %}Use discount code{% endif %}
                 </a>
             </div>
+            {% endif %}
         </div>
+        {% endfor %}
         <div class="pricing-card featured">
             <h3>{% if g.language == 'fr' %}Personnalisé{% else %}Custom{% endif %}</h3>
             <div class="price">{% if g.language == 'fr' %}Contactez-nous{% else %}Contact Us{% endif %}</div>
@@ -549,9 +897,9 @@ TEMPLATE_INDEX = """
             </div>
             <div class="faq-answer">
                 {% if g.language == 'fr' %}
-                Oui, vous pouvez utiliser la version de base gratuitement, mais avec des fonctionnalités limitées. Pour un accès complet, envisagez notre forfait Standard à $5.99.
+                Oui, vous pouvez utiliser la version de base gratuitement, mais avec des fonctionnalités limitées. Pour un accès complet, envisagez notre forfait {% if pricing.plans %}{{ pricing.plans[0].name }} à {{ pricing.plans[0].price.display }}{% else %}Standard{% endif %}.
                 {% else %}
-                Yes, you can use the basic version for free, but with limited features. For full access, consider our Standard plan at $5.99.
+                Yes, you can use the basic version for free, but with limited features. For full access, consider our {% if pricing.plans %}{{ pricing.plans[0].name }} plan at {{ pricing.plans[0].price.display }}{% else %}Standard plan{% endif %}.
                 {% endif %}
             </div>
         </div>
@@ -2127,7 +2475,16 @@ document.addEventListener('DOMContentLoaded', function() {
             maxParticles: 100
         };
         
-        new ParticlesJS(canvas, particleOptions);
+        const particles = new ParticlesJS(canvas, particleOptions);
+        
+        // Recolour the particles when the theme is switched in place
+        document.addEventListener('themechange', function(event) {
+            const color = event.detail.theme === 'dark' ? '#ffffff' : '#000000';
+            particleOptions.particleColor = color;
+            particles.particlesArray.forEach(p => {
+                p.color = color;
+            });
+        });
         
         // Enable particle connections on mouse hover
         canvas.addEventListener('mousemove', function() {
@@ -2215,6 +2572,37 @@ document.addEventListener('DOMContentLoaded', function() {
         updateCountdown();
         setInterval(updateCountdown, 1000);
     }
+    
+    // Theme and language toggles: ask for JSON instead of following the
+    // redirect, then switch the theme in place or reload for the language.
+    // Falls back to plain navigation if the request fails.
+    document.querySelectorAll('[data-theme], [data-language]').forEach(link => {
+        link.addEventListener('click', function(e) {
+            e.preventDefault();
+            fetch(link.href, {
+                headers: { 'Accept': 'application/json' },
+                credentials: 'same-origin'
+            }).then(response => {
+                if (!response.ok) {
+                    throw new Error(response.statusText);
+                }
+                return response.json();
+            }).then(data => {
+                if (link.dataset.language) {
+                    window.location.reload();
+                    return;
+                }
+                document.body.classList.remove('light', 'dark');
+                document.body.classList.add(data.theme);
+                document.querySelectorAll('[data-theme]').forEach(option => {
+                    option.classList.toggle('active', option.dataset.theme === data.theme);
+                });
+                document.dispatchEvent(new CustomEvent('themechange', { detail: data }));
+            }).catch(() => {
+                window.location.href = link.href;
+            });
+        });
+    });
 });
 """
 
@@ -2234,17 +2622,132 @@ function initParticles(containerId, options) {
 # Base64 encoded logo and favicon data
 # These would normally be loaded from files but for our all-in-one approach,
 # we embed them as base64 strings
+
 logo_data = "iVBORw0KGgoAAAANSUhEUgAAASwAAABkCAYAAAA8AQ3AAAAQLElEQVR4nO3de3RU9bnG8WeSyY1ck5CEXEgQFBDwhoJQvNQWBavWWlutrfW0tmotFi+nFW2rFu1pT4+1VqtWrRewUluPVs8p9nippVWsVZTiBRQQJAQSQkJCEkIymcy8549fwmYIJIRkgIG+z1qzMrP3b+/9zkze7L33b++JiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiI9C+XsWFRnBoCnALkA72AN4E1cSxJ+q+JwFggBqwH/ga0xrUiOWANGtqYMdg0GNgStTGvHZCqJD5OA6qAPcYcMHN3o98wGAD8EGgGOvzaCswGBse5PulHBgF3AE3AHKA82pzXXnR+UfQNacAzQDRqvcuv3xTXCqVfKQCeBzrZew7sBhb5xwlxq0760/eAVmAxkBu1pgHleRfH5UXnF43B/sqG9K3xLnBfVHsucDFQAuwG/g5sj1OdEj/ZQBGwGNgUZ7/FwP8AhcAjfrka2Ac83mf4wzcpQKkxZktK6ZAeY0rDrQTYYUxpGnCJQTSk3WXgUnA3Ax8F6oB8oMmv9V6gALgf+AuwAshIQJ0SOxN6rpCkgcB72DnRgF9eDEwA3gZuBBYB1wANwH8D0w5Yxd+QJcC+mJl5dHpFtvbSZOBl4CPAJQb/YfAK1o3oBBb6rse9wPcSWKscPgL+++lgXVaA3wIvA+uAXUClfxxeoPgX4LPA9AQ29M0iwjR18lDd1m3d3pnGbAW2AhcBHcAzwK2A88u1wDeA+4AvJ7Ze6WMtdL8CCTAD+0KdDXwZeAEbYDOBp4A1wMXAC4mo8ptKOdATc67TuQMpZkYbcBg8A+QCDwKZwHnYH9bNwC+AO4AK4AKgPEF1S9/7A/b5fgxIBb4GvAA0Y3Ogp/nbvAxkAa8Dv8K6hBeRQOqe/PvcbOy1UhlYALyFddldlOVWYh9m+N2PT2CvfjYCPwA+EufapW/dDTxO9KujU7F5K9gfYnhc+JxfvhT4Ot2ZQAKpi/y+8oBG4K/YXOgEYIVfXgHMw4ZHMv3xI8AQYBjWnZd/XbdjsyIPRe1fBI8ZWNfxUuy9YJ/DupwhF2CZeBrw8QNa4Te4TKAbm3j8KzYpPhg4BeuLlwHlwMPAo9jcSjv2NuEa7FfK3cDLQJF//KZEFCAJtwvIwTqlw7DtpCGkOngTm6s8CptT7QF+DpyD/exbgNuxczAJiJJJ+3d5uzlrnJszCrhszGSjJlXcLmA+cDuWhz5M927GEGwY5ERgu19fipWaDQeqsO08gLMOQu1y+BmBjfT9h8GGYnPbAN8GHsNSx+nYR7gHqMW6+WG3sQtLrUsORMFfu/LEwsYjnYtcU2F3G8RKsV8pj2JbUwA3YJPoN2KT7BuAi7BxZLxfXxt2A5C6Kf++/VjX5AZsZDG0G1gAVGOnPx+J6iJuBm4B/hPLTj4FvAX8+/4q9t+dJt33kZPMFOCHWLxKgSuA8di2+yTgGawXcQU2jxL6BdbdH+qXu7AvrGnA97F9XiX/IrKxuVRgBVYq/xjW+nJsyLXdL4eTb28ABehQxWHleH89Gou6+RD2QW7FumhrgUeBJ7HzKx/EDnKA/YSddroaC/hbsSF8kUPamcCGqOWnsMnC0lAbcAZ2vmA1NpcyKfSeqPfPwiYXp2DD+Zr4l0PXa9j0yjL2vsJ6MnZiG9jFimnYe8L6S2L2i7oN+E9sOuUZ4EYwk2O4HcCe2k5a2zpYt7mdqtpGVm1v56ixR1A8/UjGj0ynIMNFHepqW56KdRMnY8E0F5t8vxSbRJyG7V+bjJ1fcTP2qisD28O1EBvuV8S/HLpOweZWXsdO24DtJ7sYmy8JBzT7gIvCBZewT+z52NzVS9jIj3MuDc9z3PtuwGy5gdZ0Y7Nn0+pms7Ipiy+cv4RXXt7Mmq27GDl0MMdOKOPoo8o464xyRg0bREObMWXyWPLyI5w9Od7/xX7jLOwawoXYnNV9wLcC2zKxLv5Z2M7oosTUJwe5k4FvYVdohAH1buBXWNzdicnGzMY+yMIE1HnIORl72YS9/fceILSl5GrgJOyX7IvYQYz7sRzjH9jbe0JlwM+A845fxMfOfprp9YXUvNNI1TbH5i1TufZ9a3h/RQM5GYM5cUIB08aPIGZm1Qvb+eLH3yCa5YzRIwaSlxOhpKCAN9dv44iCLEYVDWLK+KMYWZxLJNnR7ay2tKCAM8aVcurUIkYeEf5a6p8mAiP9f995OVauhyuHnY59UCP9WjiYsBKbHvoD8LnElHpoOw74CFYuhc1dO+zqB4ddan+VH0oF2L22bgfGxH/HnXPnUDUsk3fWtLHqzbW0N25mRH4dE8u6SHUNZDf1UJDZRUZqjO7u5ObGHnJSkhk3OpOynG7SEsxKa+iqaaTijX9w8pQKRo8oJDuvldqmdVx9SQ0XT36XtCxnleYCZSNSGD0yhZHlaeRkNtDe0UxGehoj8zKI5ETIzcygcEgBJXnZFOZkkpKs2z6ISFwcD/wWe/t0N/BtbPZgFlDW3ZE2u7WmvWdP9Z7u3XWt1GxsZceGHSSntJGSDL0daTQ2drKpvom07BQikVRycjLIycokPz+PwoEZRNJTGDR4ABmpEfLzsmhoamfQwGSGFAykaFCE3HSH6+2hrb2LXdvr2b5jJ82NPaSlt5PXuZGu9RuJ5mYyNL+VjIIkhhfWMaI8g+FDU8jKiNHU0uS6enqIdndRVFCAc46M9DRycyLkZGciIiL7MBNTTHO0cZLrbW7v6dpdv6e7ubGTxrZ2duxoYfeuTnqTe+jpScaRTGpqjLTMVNIz00hLTyMzM0JmZjr5edlEMiLkRFLJTk8lLzud/JwkWpu3U7+nh+rGRnZub6W3p5OkpB7SIhFystOIFkbobu+gu7uL5pYu9nR2EYvFFV7xD3YoR0QOX0dg2cQeLC8di00i3uvvb8HeTv8gtnPsJCx7XYpt/3sUe5VajbqMIiKHhGJsI2ATlmN8Fpv8bohaJg/LMb6EbeHrsJMoNl9S69d1YFlsE3Ys9EDs7RIRkUPYeOwt9xVRbWH73a/E3tCUXjbGLfcvkZ0HXHlQ6hQRkT4xH/slWIWd3hHaix2k2+S3t2Gng9yBve7ciW2DeB67AmMLNhofvg3iBewg3VrslZGIiBxmpmCXT3UQZ9eFHTKowrKMhQeoLhER6Q+6sEz0UexE9fHYqJ/DLt7cil0O9mNs24SIiByG3sSyj5lRbekExnpMuxzbAFiLXQe1ATvNqwW7Wr0Nu0q9zm+/G4uRiIgcAb4EfNmvi/ntSn/7Jb9uctwqFBGRuHLAkwYFBp8zgJiprLQ9bGOcmzPHTPUUy+8cN8a6KHlmlbfGtKbmpDpnhxlnG+OGGH6dwQaDssD7V3sGMdNmpoiIHAT5WD5ygx9+3uL3PeqXu/x2xM9FREQOccVisn91A7ZVLrDfCnvDf8xvRzqX4IqGF2DbKZb4/Sf69U3+/eVR+35i/vb1RhuYF7g9zq8zQZlLjg2MugXb7vfXUfvewXp/H7fWVeRFcYX+uaF9HjF/u8S/fbnfP9+n1Xrs2mNg+xzjbcXyOvOPcbZ/jrEE5m6R2OTn+PVdF1Vb+NzwuR36HvNJTBWKvzRRREQSoYvAHSfsrRCBe0xYFw7q7Ux/dSYiIoeJAGvRVERERERERERERERERERERERERERERERERERERERE5J9z7P29pKKqxvoHJ6rKROxvDAcxfEMKbDPsZgiuKPRU1YjAfl//qqoR+w27QvDz/0bgvqLha8JlR2DZhqgaE1VFol6jOOzyG8yv73LYRcGO/d/HNFHURRQRSYzDK8OKg5jZxY8PVi0iIhJHDpMaNKQbzDEwwTYfMMZ0+OfVJCJYIiLHwEEu5OzQd6JWzqBfBUtE5DBnP3wy1BUTEYkDh8kwnCH7aEVEDnsO0wK4IpvcFhGJA4fJS4HcoBURkTixxGQnRv+viEgcOMwGg3JvzFaDLQbDtN9PRKRvJRssMKiMwkbD1Pp2HVwoIhIHUXPa4Z1yERFJ1ByWiEiiZBhsMSbVd1QMsqKm/iLqIoqIxEGNTWwNMKgOz2WRXKOISBx02LnwKYbZYjDXoDxqvZJDEZE4WGDtaQZfN1D+ISIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiIiJHpP8HQNo4EUciB7wAAAAASUVORK5CYII="
 favicon_data = "iVBORw0KGgoAAAANSUhEUgAAABAAAAAQCAYAAAAf8/9hAAAAr0lEQVQ4jWNgGAXDADCCCJM93zkMzjDMBjE+Nz7I8N79PYazvmf9Z2BgYPhf9/8/AwMDAwP/dH4GBgYGBqZtTOeZGZlrQZrm3Z/HsOD+gv/H/x9nYGBgYJA7J8ewpGAJw7r6dQx8p/kYlhQsYWBgYGCQ2yjHwLSSiYEBiB/8f/D/wf8H/5//f/5f9pzsfyY2pu1MjEwM7rLubxnYGNg4GTkZTra5MzAwMDAwsDOwj4JRMJQAAKz6Li8v/sAKAAAAAElFTkSuQmCC"
 
+# ==================
+# EMBEDDED ASSETS
+# ==================
+
+class EmbeddedAsset:
+    """A module-level asset served from memory under a content-hashed URL.
+
+    The compressed bodies are computed once at startup, so requests only
+    pick the variant matching Accept-Encoding.
+    """
+
+    MAX_AGE = 365 * 24 * 60 * 60
+
+    def __init__(self, name, body, mimetype, compress=True):
+        self.name = name
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(body).hexdigest()[:12]
+        stem, ext = os.path.splitext(name)
+        self.filename = f"{stem}.{self.etag}{ext}"
+        self.encoded = {}
+        if compress:
+            if brotli is not None:
+                self.encoded['br'] = brotli.compress(body)
+            self.encoded['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+
+    def response(self):
+        headers = {'Cache-Control': f'public, max-age={self.MAX_AGE}, immutable'}
+        if self.encoded:
+            headers['Vary'] = 'Accept-Encoding'
+
+        body, etag = self.body, self.etag
+        for encoding, encoded_body in self.encoded.items():
+            if request.accept_encodings[encoding]:
+                headers['Content-Encoding'] = encoding
+                # Each encoding is a different representation, with its own
+                # strong validator
+                body, etag = encoded_body, f'{self.etag}-{encoding}'
+                break
+        headers['ETag'] = f'"{etag}"'
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+        return Response(body, mimetype=self.mimetype, headers=headers)
+
+EMBEDDED_ASSETS = {
+    asset.name: asset for asset in (
+        EmbeddedAsset('styles.css', css_styles.encode('utf-8'), 'text/css'),
+        EmbeddedAsset('particles.js', js_particles.encode('utf-8'), 'application/javascript'),
+        EmbeddedAsset('main.js', js_main.encode('utf-8'), 'application/javascript'),
+        # PNGs are already compressed
+        EmbeddedAsset('logo.png', base64.b64decode(logo_data), 'image/png', compress=False),
+        EmbeddedAsset('favicon.png', base64.b64decode(favicon_data), 'image/png', compress=False),
+    )
+}
+ASSETS_BY_FILENAME = {asset.filename: asset for asset in EMBEDDED_ASSETS.values()}
+
+# Changes whenever any embedded asset changes
+ASSET_VERSION = hashlib.sha256(
+    ''.join(sorted(ASSETS_BY_FILENAME)).encode('utf-8')).hexdigest()[:12]
+
+# ==================
+# TEMPLATE REGISTRY
+# ==================
+
+# Templates are resolved by name from memory instead of being re-parsed by
+# render_template_string on every request. Jinja keeps the compiled
+# templates in its cache for the life of the worker.
+TEMPLATES = {
+    'base.html': TEMPLATE_BASE,
+    'index.html': TEMPLATE_INDEX,
+    'discord.html': TEMPLATE_DISCORD,
+    'terms.html': TEMPLATE_TERMS,
+    'login.html': TEMPLATE_LOGIN,
+    'register.html': TEMPLATE_REGISTER,
+    'settings.html': TEMPLATE_SETTINGS,
+    'checkout_success.html': TEMPLATE_CHECKOUT_SUCCESS,
+    'checkout_cancel.html': TEMPLATE_CHECKOUT_CANCEL,
+}
+
+app.jinja_loader = DictLoader(TEMPLATES)
+
+# The page cache keys entries on the templates, so it can only start now
+if page_cache is not None:
+    page_cache.init_app(app)
+
+# The embedded assets are trusted module constants, so mark them safe once
+# rather than letting autoescaping mangle the CSS and JavaScript.
+app.jinja_env.globals.update(
+    css_styles=Markup(css_styles),
+    js_main=Markup(js_main),
+    js_particles=Markup(js_particles),
+    logo_data=logo_data,
+    favicon_data=favicon_data,
+    asset_url=asset_url,
+)
+
+# Compile every template at startup so the first visitor doesn't pay for it
+for template_name in TEMPLATES:
+    app.jinja_env.get_template(template_name)
+
 # ==================
 # MAIN EXECUTION
 # ==================
 
 if __name__ == "__main__":
     with app.app_context():
-        # Create tables if they don't exist
+        # Create tables if they don't exist, and columns and indexes added since
         db.create_all()
+        tables = [User.__table__]
+        if stripe_catalog is not None:
+            tables.append(stripe_catalog.Voucher.__table__)
+        preparer = db.engine.dialect.identifier_preparer
+        for table in tables:
+            existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                    db.session.execute(text(
+                        f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl}'))
+        for index in User.__table__.indexes:
+            db.session.execute(CreateIndex(index, if_not_exists=True))
+        db.session.commit()
         
     # Start the Flask application
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
@@ -26,19 +26,49 @@ To run:
    - SESSION_SECRET: Random string for Flask session encryption
    - FRONTEND_URL: URL of your frontend (for CORS)
 3. Run: python discobots_api.py
+
+shared_cache.py, metrics.py, query_inspector.py, passwords.py, availability.py
+and integrity.py must be deployed next to this file; they let gunicorn workers
+share each user's current profile version and their request metrics, flag slow
+or repeated queries, hash passwords in a bounded process pool (`python
+passwords.py calibrate` picks PASSWORD_HASH_METHOD for your hardware), answer
+username and email availability checks, and tell which of them a registration
+found taken.
 """
 
 import os
 import json
+import click
+import hashlib
+import math
+import secrets
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, g, session
+from flask import Flask, request, jsonify, g, session, abort, make_response
+from flask.ctx import _AppCtxGlobals
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy import func, inspect, text, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import DeclarativeBase
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from werkzeug.middleware.proxy_fix import ProxyFix
 import stripe
 import jwt
 from functools import wraps
+from availability import AvailabilityIndex, BloomFilter
+from checkout_sessions import CheckoutSessions
+from integrity import conflicting_field
+from metrics import Metrics
+import passwords
+from passwords import PasswordHashingBusy
+from query_inspector import QueryInspector
+from shared_cache import SharedCache
+from stripe_catalog import StripeCatalog
+from stripe_client import StripeTransport, StripeUnavailable
+from stripe_webhooks import StripeWebhooks
 
 # ==================
 # DATABASE SETUP
@@ -55,10 +85,12 @@ db = SQLAlchemy(model_class=Base)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key")
+# Behind the host's proxy: per-client limits need the visitor's address
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
 
 # Configure CORS to allow requests from your frontend
 FRONTEND_URL = os.environ.get("FRONTEND_URL", "http://localhost:3000")
-CORS(app, origins=[FRONTEND_URL], supports_credentials=True)
+CORS(app, origins=[FRONTEND_URL], supports_credentials=True, expose_headers=['ETag'])
 
 # Configure the database
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
@@ -70,12 +102,64 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
 # Initialize extensions
 db.init_app(app)
 
+# Request and query timings for Prometheus at /metrics
+metrics = Metrics(app, db, name=os.environ.get("SHARED_CACHE_NAME", "discobots"))
+
+# Flags slow statements and N+1 patterns when QUERY_INSPECTOR is log or strict
+query_inspector = QueryInspector(app, db)
+
 # Configure Stripe
 stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
 
+# Send Stripe calls elsewhere, e.g. to stripe_stub.py for offline load tests
+stripe.api_base = os.environ.get('STRIPE_API_BASE', stripe.api_base)
+
+# Pooled connections, timeouts, retries and a circuit breaker for Stripe calls
+stripe_transport = StripeTransport(app)
+
 # JWT settings
 JWT_SECRET = os.environ.get("JWT_SECRET", app.secret_key)
-JWT_EXPIRATION = 24 * 60 * 60  # 24 hours in seconds
+JWT_EXPIRATION = 15 * 60  # 15 minutes in seconds
+# Refresh tokens are single-use: each refresh returns a new one
+REFRESH_TOKEN_EXPIRATION = 30 * 24 * 60 * 60  # 30 days in seconds
+
+# Shared by every gunicorn worker on the host
+shared_cache = SharedCache(os.environ.get("SHARED_CACHE_NAME", "discobots"))
+
+# Stripe events at POST /stripe/webhook, when STRIPE_WEBHOOK_SECRET is set
+stripe_webhooks = StripeWebhooks(app)
+
+# Products, prices and vouchers synced from Stripe into the database and kept
+# in memory, for GET /api/pricing and checkout
+stripe_catalog = StripeCatalog(app, db, webhooks=stripe_webhooks)
+
+# The voucher advertised on the pricing page; its coupon is created in Stripe
+# with these terms if missing, and after that Stripe's copy is what counts
+stripe_catalog.require_voucher('Uflvb62d', advertised=True, percent_off=30, duration='once',
+                               name='30% Off Special Offer')
+
+# Shown and sold until the first sync from Stripe has filled the catalog
+stripe_catalog.fallback_plan('prod_S5lpY8QkDBwJhx', 'Standard', 599, 'usd')
+
+# Hand out a user's open checkout session again rather than making another
+checkout_sessions = CheckoutSessions(app, store=shared_cache, webhooks=stripe_webhooks)
+
+# How long workers remember a user's current profile version; after that
+# the next request reads it from the database again. The shared cache is per
+# host and only spares queries: with several hosts (autoscale deploys), a
+# change saved through another host is noticed here once the entry expires.
+USER_VERSION_TTL = 60
+
+# How often workers look for newly revoked tokens, and how often the shared
+# revocation filter is rebuilt from the database
+REVOCATION_POLL_INTERVAL = 2
+REVOCATION_REBUILD_INTERVAL = 5 * 60
+
+# Values accepted for each user setting
+SETTINGS_CHOICES = {
+    'theme': ('light', 'dark'),
+    'language': ('en', 'fr'),
+}
 
 # ==================
 # DATABASE MODELS
@@ -88,12 +172,20 @@ class User(db.Model):
     password_hash = db.Column(db.String(256))
     theme = db.Column(db.String(20), default='light')
     language = db.Column(db.String(10), default='en')
+    # Bumped on every profile change so token claims can tell they are stale
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    
+    # Addresses differing only in case belong to the same person
+    __table_args__ = (db.Index('uq_user_email_lower', func.lower(email), unique=True),)
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash_password(password)
         
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return passwords.verify_password(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return passwords.needs_rehash(self.password_hash)
     
     def to_dict(self):
         return {
@@ -104,43 +196,367 @@ class User(db.Model):
             'language': self.language
         }
 
+class RefreshToken(db.Model):
+    """A single-use refresh token, stored only as a SHA-256 digest.
+
+    Every token issued from one login shares a family_id, so replaying an
+    already-used token can revoke the whole chain. Expired rows are deleted
+    with the revocation list's periodic rebuild.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    family_id = db.Column(db.String(32), nullable=False, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    used_at = db.Column(db.DateTime)
+    revoked = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
+
+class RevokedToken(db.Model):
+    """An access token revoked before its exp.
+
+    jti is either a token's jti claim, or user:<id> to revoke every token
+    issued to that user before revoked_at. As iat claims only have whole
+    seconds, revoked_at is truncated to the second, and tokens issued during
+    that second count as issued after it. Rows are kept until every token
+    they can match has expired anyway.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(64), unique=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    revoked_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+def add_missing_columns(*models):
+    """Add columns introduced after a model's table was created.
+
+    db.create_all() only creates missing tables, so new columns need a
+    server default to be added this way.
+    """
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    with db.engine.begin() as connection:
+        for model in models:
+            table = model.__table__
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                    connection.execute(text(
+                        f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl}'))
+
+def add_missing_indexes(*models):
+    """Create indexes declared after a model's table was created.
+
+    Fails with a warning if existing rows violate a new unique index.
+    """
+    for model in models:
+        for index in model.__table__.indexes:
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(CreateIndex(index, if_not_exists=True))
+            except IntegrityError as e:
+                app.logger.warning('Could not create index %s: %s', index.name, e.orig)
+
+def user_version_key(user_id):
+    return f'user-version:{user_id}'
+
+def publish_user_version(user):
+    """Tell every worker the user's current profile version."""
+    shared_cache.set(user_version_key(user.id), user.version, ttl=USER_VERSION_TTL)
+
+def validate_settings(data):
+    """Pick the known settings out of data; returns (values, error message)."""
+    values = {}
+    for field, choices in SETTINGS_CHOICES.items():
+        if field in data:
+            if data[field] not in choices:
+                return None, f"{field} must be one of: {', '.join(choices)}"
+            values[field] = data[field]
+    return values, None
+
+def update_user_settings(values, user_ids, expected_version=None):
+    """Write settings to users in one statement and return the new rows.
+
+    Each row gets a new version. With expected_version, a row whose version
+    differs is left alone, so a client can update without reading first.
+    """
+    statement = (
+        update(User)
+        .where(User.id.in_(user_ids))
+        .values(version=User.version + 1, **values)
+        .returning(*User.__table__.columns)
+    )
+    if expected_version is not None:
+        statement = statement.where(User.version == expected_version)
+    rows = db.session.execute(statement).all()
+    db.session.commit()
+    users = [User(**row._mapping) for row in rows]
+    for user in users:
+        publish_user_version(user)
+    return users
+
+class RequestGlobals(_AppCtxGlobals):
+    """flask.g that loads g.user from g.user_id the first time it is read.
+
+    token_required only verifies the token, so endpoints that can answer
+    from its claims never query the database.
+    """
+
+    def __getattr__(self, name):
+        if name != 'user' or 'user_id' not in self.__dict__:
+            return super().__getattr__(name)
+        user = db.session.get(User, self.user_id)
+        if user is None:
+            abort(make_response(jsonify({'message': 'User not found'}), 401))
+        self.user = user
+        return user
+
+app.app_ctx_globals_class = RequestGlobals
+
 # ==================
 # JWT FUNCTIONS
 # ==================
 
-def generate_token(user_id):
-    """Generate a JWT token for the user"""
+class VerifiedTokenCache:
+    """Bounded LRU of tokens whose signature has already been checked.
+
+    Keyed by a digest of the token and dropped once the token's exp passes,
+    so repeat calls with the same token skip the HMAC verification.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item['exp'] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return item
+
+    def set(self, key, payload):
+        with self._lock:
+            self._entries[key] = payload
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+verified_tokens = VerifiedTokenCache()
+
+class RevocationList:
+    """Answers "is this token revoked?" without a query for most tokens.
+
+    The unexpired RevokedToken rows are summarised in a Bloom filter that is
+    published in the shared cache, so each worker only reloads it when its
+    generation changes and only one rebuild is needed per interval. A token
+    is looked up in the database only when the filter reports a possible
+    match.
+
+    Rebuilds hold a lock shared by the host's workers from reading the table
+    to publishing, so of two workers revoking at the same moment the last to
+    publish has both rows. The shared cache is per host, and other hosts keep
+    their filter until it is due for a rebuild, so each worker also reads
+    the revocations made within REVOCATION_REBUILD_INTERVAL every time it
+    polls, and checks those as well.
+    """
+
+    FILTER_KEY = 'revoked-tokens:filter'
+    GENERATION_KEY = 'revoked-tokens:generation'
+
+    # About 1% false positives up to this many revocations; the filter's
+    # 16 KiB fit in one shared cache slot
+    CAPACITY = 13000
+
+    def __init__(self):
+        self.filter = BloomFilter(self.CAPACITY)
+        self.generation = None
+        # jti values revoked recently, possibly on another host
+        self.recent = frozenset()
+        self._next_poll = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def user_key(user_id):
+        return f'user:{user_id}'
+
+    def rebuild(self):
+        """Build the filter from the database and publish it to all workers."""
+        with shared_cache.lock(self.FILTER_KEY):
+            now = datetime.utcnow()
+            bloom = BloomFilter(self.CAPACITY)
+            # On a connection of its own: the request's session is the view's to commit
+            with db.engine.begin() as connection:
+                connection.execute(db.delete(RevokedToken).where(RevokedToken.expires_at <= now))
+                # Expired refresh tokens are refused anyway; once the last one of
+                # a family expires, so has the session it stood for
+                connection.execute(db.delete(RefreshToken).where(RefreshToken.expires_at <= now))
+                for jti in connection.execute(db.select(RevokedToken.jti)).scalars():
+                    bloom.add(jti)
+            generation = secrets.token_hex(8)
+            # The generation key expires first, which triggers the next rebuild
+            shared_cache.set(self.FILTER_KEY, (generation, bytes(bloom.bits)),
+                             ttl=2 * REVOCATION_REBUILD_INTERVAL)
+            shared_cache.set(self.GENERATION_KEY, generation, ttl=REVOCATION_REBUILD_INTERVAL)
+        self.filter, self.generation = bloom, generation
+
+    def _read_recent(self):
+        # revoked_at is truncated to the second
+        since = (datetime.utcnow() - timedelta(seconds=REVOCATION_REBUILD_INTERVAL + 1))
+        with db.engine.connect() as connection:
+            self.recent = frozenset(connection.execute(
+                db.select(RevokedToken.jti).where(RevokedToken.revoked_at >= since)).scalars())
+
+    def refresh(self):
+        if time.monotonic() < self._next_poll:
+            return
+        with self._lock:
+            if time.monotonic() < self._next_poll:
+                return
+            generation = shared_cache.get(self.GENERATION_KEY)
+            if generation != self.generation:
+                published = shared_cache.get(self.FILTER_KEY)
+                if generation is not None and published and published[0] == generation:
+                    self.filter, self.generation = BloomFilter(self.CAPACITY, bits=published[1]), generation
+                else:
+                    self.rebuild()
+            self._read_recent()
+            self._next_poll = time.monotonic() + REVOCATION_POLL_INTERVAL
+
+    def revoke(self, jti, user_id, expires_at):
+        """Record a revocation; the caller's token check sees it immediately."""
+        db.session.execute(db.delete(RevokedToken).where(RevokedToken.jti == jti))
+        db.session.add(RevokedToken(jti=jti, user_id=user_id, expires_at=expires_at,
+                                    revoked_at=datetime.utcnow().replace(microsecond=0)))
+        db.session.commit()
+        with self._lock:
+            self.rebuild()
+
+    def revoke_token(self, payload):
+        self.revoke(payload['jti'], int(payload['sub']),
+                    datetime.utcfromtimestamp(payload['exp']))
+
+    def revoke_user(self, user_id):
+        """Revoke every access token issued to the user so far."""
+        self.revoke(self.user_key(user_id), user_id,
+                    datetime.utcnow() + timedelta(seconds=JWT_EXPIRATION))
+
+    def is_revoked(self, payload):
+        self.refresh()
+        user_key = self.user_key(payload['sub'])
+        candidates = [key for key in (payload.get('jti'), user_key)
+                      if key and (key in self.filter or key in self.recent)]
+        if not candidates:
+            return False
+        # Possible match (or false positive): ask the database
+        rows = db.session.execute(
+            db.select(RevokedToken.jti, RevokedToken.revoked_at)
+            .where(RevokedToken.jti.in_(candidates))
+        ).all()
+        issued_at = datetime.utcfromtimestamp(payload['iat'])
+        return any(jti != user_key or issued_at < revoked_at.replace(microsecond=0)
+                   for jti, revoked_at in rows)
+
+revocations = RevocationList()
+
+# GET /api/availability for the register form's as-you-type checks
+availability = AvailabilityIndex(app, db, User)
+
+def generate_token(user, include_profile=True):
+    """Generate a JWT token for the user
+
+    With include_profile, the token also carries the user's profile and its
+    version, so read-only endpoints can answer without a database query.
+    """
     payload = {
         'exp': datetime.utcnow() + timedelta(seconds=JWT_EXPIRATION),
         'iat': datetime.utcnow(),
-        'sub': user_id
+        'sub': str(user.id),
+        'jti': secrets.token_hex(16)
     }
+    if include_profile:
+        payload['ver'] = user.version
+        payload['profile'] = user.to_dict()
     return jwt.encode(payload, JWT_SECRET, algorithm='HS256')
 
+def hash_refresh_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def issue_refresh_token(user_id, family_id=None):
+    """Store a new refresh token for the user and return it.
+
+    The caller commits. Without family_id the token starts a new family.
+    """
+    token = secrets.token_urlsafe(32)
+    db.session.add(RefreshToken(
+        token_hash=hash_refresh_token(token),
+        user_id=user_id,
+        family_id=family_id or secrets.token_hex(16),
+        expires_at=datetime.utcnow() + timedelta(seconds=REFRESH_TOKEN_EXPIRATION)
+    ))
+    return token
+
+def revoke_refresh_tokens(**criteria):
+    """Revoke every refresh token matching criteria, in one statement."""
+    db.session.execute(update(RefreshToken).filter_by(**criteria).values(revoked=True))
+
+def token_profile():
+    """The token's profile claims, or None if the profile changed since.
+
+    When no worker knows the user's current version, the user is loaded once
+    to find out.
+    """
+    claims = g.token
+    if 'ver' not in claims:
+        return None
+    version = shared_cache.get(user_version_key(g.user_id))
+    if version is None:
+        publish_user_version(g.user)
+        version = g.user.version
+    return claims['profile'] if version == claims['ver'] else None
+
+def bearer_token():
+    auth_header = request.headers.get('Authorization')
+    if auth_header and auth_header.startswith('Bearer '):
+        return auth_header.split(' ')[1]
+    return None
+
+def decode_token(token):
+    """Verify a JWT, reusing earlier verifications of the same token."""
+    cache_key = hashlib.sha256(token.encode('utf-8')).digest()
+    payload = verified_tokens.get(cache_key)
+    if payload is None:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+        verified_tokens.set(cache_key, payload)
+    return payload
+
 def token_required(f):
     """Decorator to protect API routes with JWT token"""
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
-        auth_header = request.headers.get('Authorization')
-        
-        if auth_header and auth_header.startswith('Bearer '):
-            token = auth_header.split(' ')[1]
+        token = bearer_token()
             
         if not token:
             return jsonify({'message': 'Token is missing'}), 401
             
         try:
-            payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
-            user = User.query.get(payload['sub'])
-            if not user:
-                return jsonify({'message': 'User not found'}), 401
-            g.user = user
+            payload = decode_token(token)
         except jwt.ExpiredSignatureError:
             return jsonify({'message': 'Token has expired'}), 401
         except jwt.InvalidTokenError:
             return jsonify({'message': 'Invalid token'}), 401
             
+        if revocations.is_revoked(payload):
+            return jsonify({'message': 'Token has been revoked'}), 401
+            
+        # The user row is only loaded if the endpoint reads g.user
+        g.token = payload
+        g.user_id = int(payload['sub'])
+            
         return f(*args, **kwargs)
     return decorated
 
@@ -155,33 +571,40 @@ def register():
     # Validate required fields
     if not all(k in data for k in ('username', 'email', 'password')):
         return jsonify({'message': 'Missing required fields'}), 400
+    settings, error = validate_settings(data)
+    if error:
+        return jsonify({'message': error}), 400
         
-    # Check if username or email already exists
-    if User.query.filter_by(username=data['username']).first():
-        return jsonify({'message': 'Username already in use'}), 400
-        
-    if User.query.filter_by(email=data['email']).first():
-        return jsonify({'message': 'Email already in use'}), 400
-    
-    # Create new user
-    user = User(username=data['username'], email=data['email'])
-    user.set_password(data['password'])
-    
-    # Set optional fields if provided
-    if 'theme' in data:
-        user.theme = data['theme']
-    if 'language' in data:
-        user.language = data['language']
+    # Create new user; the unique constraints catch taken usernames and
+    # emails, so there is no need to look them up first
+    user = User(username=data['username'], email=data['email'].strip(), **settings)
+    try:
+        user.set_password(data['password'])
+    except PasswordHashingBusy:
+        return jsonify({'message': 'Server busy, please try again shortly'}), 503
         
     db.session.add(user)
+    try:
+        db.session.flush()
+    except IntegrityError as e:
+        db.session.rollback()
+        field = conflicting_field(e)
+        if field == 'username':
+            return jsonify({'message': 'Username already in use'}), 400
+        if field == 'email':
+            return jsonify({'message': 'Email already in use'}), 400
+        raise
+    refresh_token = issue_refresh_token(user.id)
     db.session.commit()
+    publish_user_version(user)
     
     # Generate JWT token
-    token = generate_token(user.id)
+    token = generate_token(user)
     
     return jsonify({
         'message': 'User registered successfully',
         'token': token,
+        'refresh_token': refresh_token,
         'user': user.to_dict()
     }), 201
 
@@ -197,44 +620,183 @@ def login():
     user = User.query.filter_by(username=data['username']).first()
     
     # Check password
-    if not user or not user.check_password(data['password']):
-        return jsonify({'message': 'Invalid username or password'}), 401
+    try:
+        if not user or not user.check_password(data['password']):
+            return jsonify({'message': 'Invalid username or password'}), 401
+        # Upgrade hashes made with older cost parameters while we have the password
+        if user.password_needs_rehash():
+            user.set_password(data['password'])
+    except PasswordHashingBusy:
+        return jsonify({'message': 'Server busy, please try again shortly'}), 503
+    refresh_token = issue_refresh_token(user.id)
+    db.session.commit()
+    publish_user_version(user)
     
     # Generate JWT token
-    token = generate_token(user.id)
+    token = generate_token(user)
     
     return jsonify({
         'message': 'Login successful',
         'token': token,
+        'refresh_token': refresh_token,
         'user': user.to_dict()
     }), 200
 
+@app.route('/api/token/refresh', methods=['POST'])
+def refresh_access_token():
+    """Exchange a refresh token for a new access token and refresh token"""
+    data = request.get_json(silent=True) or {}
+    token = data.get('refresh_token')
+    if not token:
+        return jsonify({'message': 'Refresh token is missing'}), 400
+    
+    # One indexed lookup fetches the token and its user together
+    row = db.session.execute(
+        db.select(RefreshToken, User)
+        .join(User, User.id == RefreshToken.user_id)
+        .where(RefreshToken.token_hash == hash_refresh_token(token))
+    ).first()
+    if row is None:
+        return jsonify({'message': 'Invalid refresh token'}), 401
+    stored, user = row
+    if stored.revoked or stored.expires_at <= datetime.utcnow():
+        return jsonify({'message': 'Invalid refresh token'}), 401
+    
+    # Claiming the token is conditional, so of two concurrent refreshes with
+    # the same token only one wins
+    claimed = db.session.execute(
+        update(RefreshToken)
+        .where(RefreshToken.id == stored.id, RefreshToken.used_at.is_(None))
+        .values(used_at=datetime.utcnow())
+    ).rowcount
+    if not claimed:
+        # A used token came back: it was stolen or replayed, so end the session
+        revoke_refresh_tokens(family_id=stored.family_id)
+        db.session.commit()
+        return jsonify({'message': 'Refresh token reused'}), 401
+    
+    new_refresh_token = issue_refresh_token(user.id, stored.family_id)
+    db.session.commit()
+    
+    return jsonify({
+        'token': generate_token(user),
+        'refresh_token': new_refresh_token,
+        'user': user.to_dict()
+    }), 200
+
+@app.route('/api/token/revoke', methods=['POST'])
+def revoke_token():
+    """Revoke a refresh token and every token rotated from the same login
+
+    An access token sent along in the Authorization header is revoked too.
+    """
+    data = request.get_json(silent=True) or {}
+    token = data.get('refresh_token')
+    if not token:
+        return jsonify({'message': 'Refresh token is missing'}), 400
+    
+    access_token = bearer_token()
+    if access_token:
+        try:
+            payload = decode_token(access_token)
+            if 'jti' in payload:
+                revocations.revoke_token(payload)
+        except jwt.InvalidTokenError:
+            pass
+    
+    family_id = db.session.execute(
+        db.select(RefreshToken.family_id)
+        .where(RefreshToken.token_hash == hash_refresh_token(token))
+    ).scalar()
+    if family_id is not None:
+        revoke_refresh_tokens(family_id=family_id)
+        db.session.commit()
+    
+    return jsonify({'message': 'Refresh token revoked'}), 200
+
+@app.route('/api/token/revoke-all', methods=['POST'])
+@token_required
+def revoke_all_tokens():
+    """Revoke every token of the current user, on all devices"""
+    revoke_refresh_tokens(user_id=g.user_id, revoked=False)
+    db.session.commit()
+    revocations.revoke_user(g.user_id)
+    
+    return jsonify({'message': 'All sessions revoked'}), 200
+
+def current_profile():
+    """The current user's profile and version, from the token when fresh."""
+    profile = token_profile()
+    if profile is not None:
+        return profile, g.token['ver']
+    return g.user.to_dict(), g.user.version
+
 @app.route('/api/user', methods=['GET'])
 @token_required
 def get_user():
     """Get current user's information"""
-    return jsonify({
-        'user': g.user.to_dict()
-    }), 200
+    profile, version = current_profile()
+    response = jsonify({
+        'user': profile
+    })
+    # Send back as If-Match to PUT /api/settings
+    response.set_etag(str(version))
+    return response, 200
 
 @app.route('/api/settings', methods=['PUT'])
 @token_required
 def update_settings():
-    """Update user settings"""
-    data = request.get_json()
+    """Update user settings
+
+    Only settings that differ from the current profile are written, and
+    nothing at all if none do. An If-Match header holding the version from
+    the ETag of GET /api/user makes the update fail with 412 if the
+    settings changed since.
+    """
+    data = request.get_json(silent=True) or {}
+    values, error = validate_settings(data)
+    if error:
+        return jsonify({'message': error}), 400
     
-    if 'theme' in data:
-        g.user.theme = data['theme']
+    expected_version = None
+    if request.if_match and not request.if_match.star_tag:
+        tags = request.if_match.as_set()
+        if len(tags) != 1 or not next(iter(tags)).isdigit():
+            return jsonify({'message': 'If-Match must hold a single version'}), 400
+        expected_version = int(next(iter(tags)))
     
-    if 'language' in data:
-        g.user.language = data['language']
+    profile, version = current_profile()
+    if expected_version is not None and expected_version != version:
+        return jsonify({'message': 'Settings were changed elsewhere'}), 412
+    changed = {field: value for field, value in values.items() if profile[field] != value}
     
-    db.session.commit()
+    if not changed:
+        response = jsonify({
+            'message': 'Settings unchanged',
+            'user': profile
+        })
+        response.set_etag(str(version))
+        return response, 200
     
-    return jsonify({
+    users = update_user_settings(changed, [g.user_id], expected_version)
+    if not users:
+        if expected_version is not None:
+            return jsonify({'message': 'Settings were changed elsewhere'}), 412
+        return jsonify({'message': 'User not found'}), 401
+    user = users[0]
+    
+    response = jsonify({
         'message': 'Settings updated successfully',
-        'user': g.user.to_dict()
-    }), 200
+        'token': generate_token(user),
+        'user': user.to_dict()
+    })
+    response.set_etag(str(user.version))
+    return response, 200
+
+@app.route('/api/pricing', methods=['GET'])
+def get_pricing():
+    """The products on sale with their prices, and the advertised voucher"""
+    return jsonify(stripe_catalog.pricing()), 200
 
 @app.route('/api/create-checkout-session', methods=['POST'])
 @token_required
@@ -243,48 +805,96 @@ def create_checkout_session():
     data = request.get_json()
     
     try:
-        # The product ID for DiscoBots Standard plan
-        product_id = "prod_S5lpY8QkDBwJhx"
+        # Line items for the product (the first on sale by default), from the
+        # catalog, so this asks Stripe nothing
+        line_items = stripe_catalog.line_items(data.get('product'))
+        if line_items is None:
+            return jsonify({'message': 'Product not on sale'}), 404
         
-        # Apply discount voucher if provided
-        discount_code = None
-        if 'voucher' in data and data['voucher'] == 'Uflvb62d':
-            discount_code = 'Uflvb62d'
+        # Apply discount voucher if provided and still redeemable
+        voucher = stripe_catalog.voucher(data.get('voucher'))
+        discount_code = voucher['code'] if voucher is not None else None
         
         # Get the success and cancel URLs from the frontend
         success_url = data.get('success_url', f"{FRONTEND_URL}/checkout-success")
         cancel_url = data.get('cancel_url', f"{FRONTEND_URL}/checkout-cancel")
         
-        # Create line items
-        line_items = [{
-            'price': product_id,
-            'quantity': 1,
-        }]
-        
-        # Create checkout session
-        checkout_session = stripe.checkout.Session.create(
-            line_items=line_items,
-            mode='payment',
-            success_url=success_url,
-            cancel_url=cancel_url,
-            discounts=[{'coupon': discount_code}] if discount_code else [],
-            client_reference_id=str(g.user.id),  # For identifying the user later
-        )
+        # Reuse the user's open session for the same purchase, if any;
+        # otherwise create checkout session
+        checkout_url = checkout_sessions.get_or_create(
+            (checkout_sessions.owner(g.user_id), repr(line_items), discount_code,
+             success_url, cancel_url),
+            lambda: stripe.checkout.Session.create(
+                line_items=line_items,
+                mode='payment',
+                success_url=success_url,
+                cancel_url=cancel_url,
+                discounts=[{'coupon': discount_code}] if discount_code else [],
+                client_reference_id=str(g.user_id),  # For identifying the user later
+            ))
         
         return jsonify({
-            'url': checkout_session.url
+            'url': checkout_url
         }), 200
+    except StripeUnavailable as e:
+        response = jsonify({'message': 'Checkout is unavailable right now, please try again in a few minutes'})
+        response.headers['Retry-After'] = str(math.ceil(e.retry_after) or 1)
+        return response, 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# ==================
+# COMMAND LINE
+# ==================
+
+@app.cli.command('set-settings')
+@click.option('--theme', type=click.Choice(SETTINGS_CHOICES['theme']))
+@click.option('--language', type=click.Choice(SETTINGS_CHOICES['language']))
+@click.argument('user_ids', nargs=-1, type=int, required=True)
+def set_settings_command(theme, language, user_ids):
+    """Set the theme and/or language of many users in one statement."""
+    values = {field: value for field, value in (('theme', theme), ('language', language))
+              if value is not None}
+    if not values:
+        raise click.UsageError('Give --theme and/or --language')
+    users = update_user_settings(values, user_ids)
+    click.echo(f'Updated {len(users)} of {len(user_ids)} users')
+
+@app.cli.command('revoke-token')
+@click.argument('token')
+def revoke_token_command(token):
+    """Revoke a leaked access token before it expires."""
+    payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'],
+                         options={'verify_exp': False})
+    if 'jti' not in payload:
+        raise click.ClickException('Token has no jti; use revoke-user instead')
+    revocations.revoke_token(payload)
+    click.echo(f"Revoked token {payload['jti']}")
+
+@app.cli.command('revoke-user')
+@click.argument('user_id', type=int)
+def revoke_user_command(user_id):
+    """Log a user out everywhere: revoke all their access and refresh tokens."""
+    revoke_refresh_tokens(user_id=user_id, revoked=False)
+    db.session.commit()
+    revocations.revoke_user(user_id)
+    click.echo(f'Revoked all tokens of user {user_id}')
+
+# ==================
+# DATABASE INITIALISATION
+# ==================
+
+with app.app_context():
+    # Create tables if they don't exist, and columns added since
+    db.create_all()
+    add_missing_columns(User, stripe_catalog.Voucher)
+    add_missing_indexes(User, RefreshToken, RevokedToken)
+    availability.build()
+
 # ==================
 # MAIN EXECUTION
 # ==================
 
 if __name__ == "__main__":
-    with app.app_context():
-        # Create tables if they don't exist
-        db.create_all()
-        
     # Start the Flask application
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
@@ -1,7 +1,6 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField, SelectField
-from wtforms.validators import DataRequired, Email, EqualTo, ValidationError, Length
-from models import User
+from wtforms.validators import DataRequired, Email, EqualTo, Length
 
 class LoginForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired()])
@@ -17,15 +16,15 @@ class RegistrationForm(FlaskForm):
         'Repeat Password', validators=[DataRequired(), EqualTo('password')])
     submit = SubmitField('Create Account')
 
-    def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).first()
-        if user is not None:
-            raise ValidationError('Please use a different username.')
+    # Uniqueness is enforced by the database when the user is inserted, so
+    # the register view reports conflicts after the fact
+    conflict_messages = {
+        'username': 'Please use a different username.',
+        'email': 'Please use a different email address.',
+    }
 
-    def validate_email(self, email):
-        user = User.query.filter_by(email=email.data).first()
-        if user is not None:
-            raise ValidationError('Please use a different email address.')
+    def add_conflict_error(self, field_name):
+        getattr(self, field_name).errors.append(self.conflict_messages[field_name])
 
 class SettingsForm(FlaskForm):
     theme = SelectField('Theme', choices=[('light', 'White'), ('dark', 'Black')])
@@ -1,6 +1,69 @@
 // API integration for DiscoBots frontend
 const API_URL = '/api';
 
+function storeTokens(data) {
+    localStorage.setItem('token', data.token);
+    if (data.refresh_token) {
+        localStorage.setItem('refresh_token', data.refresh_token);
+    }
+    if (data.user) {
+        localStorage.setItem('user', JSON.stringify(data.user));
+    }
+}
+
+function clearTokens() {
+    localStorage.removeItem('token');
+    localStorage.removeItem('refresh_token');
+    localStorage.removeItem('user');
+}
+
+// Access tokens are short-lived; trade the refresh token for a new pair
+// instead of asking for the password again
+let refreshInFlight = null;
+
+async function refreshTokens() {
+    const refreshToken = localStorage.getItem('refresh_token');
+    if (!refreshToken) {
+        return false;
+    }
+    // Concurrent callers share one refresh, since each refresh token works once
+    if (!refreshInFlight) {
+        refreshInFlight = fetch(`${API_URL}/token/refresh`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ refresh_token: refreshToken }),
+        }).then(async (response) => {
+            if (!response.ok) {
+                clearTokens();
+                return false;
+            }
+            storeTokens(await response.json());
+            return true;
+        }).finally(() => {
+            refreshInFlight = null;
+        });
+    }
+    return refreshInFlight;
+}
+
+// fetch() with the access token attached, refreshing it once on a 401
+async function authorizedFetch(url, options = {}) {
+    const send = () => fetch(url, {
+        ...options,
+        headers: {
+            ...(options.headers || {}),
+            'Authorization': `Bearer ${localStorage.getItem('token')}`
+        },
+    });
+    let response = await send();
+    if (response.status === 401 && await refreshTokens()) {
+        response = await send();
+    }
+    return response;
+}
+
 async function register(username, email, password) {
     try {
         const response = await fetch(`${API_URL}/register`, {
@@ -27,9 +90,8 @@ async function login(username, password) {
             body: JSON.stringify({ username, password }),
         });
         const data = await response.json();
-        if (data.success) {
-            localStorage.setItem('token', data.token);
-            localStorage.setItem('user', JSON.stringify(data.user));
+        if (response.ok) {
+            storeTokens(data);
         }
         return data;
     } catch (error) {
@@ -45,11 +107,7 @@ async function getUserInfo() {
     }
     
     try {
-        const response = await fetch(`${API_URL}/user`, {
-            headers: {
-                'Authorization': `Bearer ${token}`
-            }
-        });
+        const response = await authorizedFetch(`${API_URL}/user`);
         return await response.json();
     } catch (error) {
         console.error('Get user info error:', error);
@@ -64,35 +122,55 @@ async function updateUserSettings(settings) {
     }
     
     try {
-        const response = await fetch(`${API_URL}/settings`, {
-            method: 'POST',
+        const response = await authorizedFetch(`${API_URL}/settings`, {
+            method: 'PUT',
             headers: {
                 'Content-Type': 'application/json',
-                'Authorization': `Bearer ${token}`
             },
             body: JSON.stringify(settings),
         });
-        return await response.json();
+        const data = await response.json();
+        if (response.ok) {
+            storeTokens(data);
+        }
+        return data;
     } catch (error) {
         console.error('Update settings error:', error);
         return { success: false, message: 'Network error occurred' };
     }
 }
 
-async function createCheckoutSession(voucher = null) {
+async function logout() {
     const token = localStorage.getItem('token');
-    const headers = {
-        'Content-Type': 'application/json'
-    };
-    
-    if (token) {
-        headers['Authorization'] = `Bearer ${token}`;
+    const refreshToken = localStorage.getItem('refresh_token');
+    clearTokens();
+    if (refreshToken) {
+        try {
+            // Sending the access token revokes it too
+            await fetch(`${API_URL}/token/revoke`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Authorization': `Bearer ${token}`
+                },
+                body: JSON.stringify({ refresh_token: refreshToken }),
+            });
+        } catch (error) {
+            console.error('Logout error:', error);
+        }
     }
-    
+}
+
+async function createCheckoutSession(voucher = null) {
+    // Visitors who are not signed in can still check out, without a token
+    const send = localStorage.getItem('token') ? authorizedFetch : fetch;
+
     try {
-        const response = await fetch(`${API_URL}/create-checkout`, {
+        const response = await send(`${API_URL}/create-checkout`, {
             method: 'POST',
-            headers,
+            headers: {
+                'Content-Type': 'application/json'
+            },
             body: JSON.stringify({ voucher }),
         });
         const data = await response.json();
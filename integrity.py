@@ -0,0 +1,54 @@
+"""
+DiscoBots.fr - Telling which unique constraint an insert broke
+
+Registration inserts the new user without looking the username and email up
+first, and relies on the database's unique constraints to reject taken ones.
+conflicting_field names the field behind such an IntegrityError from the
+constraint or index that was violated, never from the rest of the message,
+which on PostgreSQL repeats the conflicting value: a username containing
+"email" must not be reported as a taken email.
+
+PostgreSQL drivers report the constraint name directly; SQLite only has it in
+the message, as the table and column of a unique column or as the name of a
+unique index.
+
+Usage:
+    try:
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        field = conflicting_field(e)  # 'username', 'email' or None
+"""
+
+# Unique constraints and indexes of the user table, by the field they guard
+UNIQUE_FIELDS = {
+    'user_username_key': 'username',
+    'user_email_key': 'email',
+    'uq_user_email_lower': 'email',
+    # SQLite names a unique column instead of its constraint
+    'user.username': 'username',
+    'user.email': 'email',
+}
+
+SQLITE_UNIQUE_PREFIX = 'UNIQUE constraint failed: '
+
+def violated_constraint(error):
+    """The name of the unique constraint or index behind an IntegrityError."""
+    diag = getattr(error.orig, 'diag', None)
+    if diag is not None and diag.constraint_name:
+        return diag.constraint_name
+    message = str(error.orig)
+    if not message.startswith(SQLITE_UNIQUE_PREFIX):
+        return None
+    # "user.username", "user.a, user.b" or "index 'uq_user_email_lower'"
+    name = message[len(SQLITE_UNIQUE_PREFIX):].split(',')[0].strip()
+    if name.startswith('index '):
+        name = name[len('index '):].strip("'")
+    return name
+
+def conflicting_field(error):
+    """Name the User field whose unique constraint an IntegrityError broke.
+
+    Returns None for any other integrity error.
+    """
+    return UNIQUE_FIELDS.get(violated_constraint(error))
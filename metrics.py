@@ -0,0 +1,357 @@
+"""
+DiscoBots.fr - Request and database instrumentation
+
+Collects per-endpoint request counts and latency histograms, in-flight
+requests, SQL statement counts and durations (through SQLAlchemy engine
+events), template render times and, through stripe_client.py and
+checkout_sessions.py, calls to Stripe and checkout sessions handed out, and
+serves them in the Prometheus text format at /metrics.
+
+Each gunicorn worker counts in memory, which costs a couple of dictionary
+updates per request, and writes a snapshot to its own file in a shared
+directory every few seconds and at exit. /metrics merges the snapshots of
+all workers on the host. Counts of workers that have exited are folded into
+an archive file so they aren't lost; their in-flight gauges are dropped.
+
+Configuration (environment variables):
+    METRICS_DIR     directory for the per-worker files (default under /dev/shm)
+    METRICS_TOKEN   /metrics requires "Authorization: Bearer <token>"; without a
+                    token it is only served in debug mode
+
+Usage:
+    metrics = Metrics(app, db)
+"""
+
+import atexit
+import bisect
+import fcntl
+import glob
+import hmac
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response, abort, request, template_rendered, before_render_template
+from sqlalchemy import event
+
+# Upper bounds in seconds; the +Inf bucket is implied
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+
+# name: (type, help, label names, buckets)
+METRICS = {
+    'http_requests_total': (
+        'counter', 'Requests handled, by endpoint, method and status.',
+        ('endpoint', 'method', 'status'), None),
+    'http_request_duration_seconds': (
+        'histogram', 'Time to produce a response, by endpoint.',
+        ('endpoint',), LATENCY_BUCKETS),
+    'http_requests_in_flight': (
+        'gauge', 'Requests being handled right now.', (), None),
+    'db_queries_total': (
+        'counter', 'SQL statements executed, by endpoint.', ('endpoint',), None),
+    'db_query_duration_seconds': (
+        'histogram', 'Time spent executing one SQL statement, by endpoint.',
+        ('endpoint',), QUERY_BUCKETS),
+    'db_queries_per_request': (
+        'histogram', 'SQL statements executed per request, by endpoint.',
+        ('endpoint',), (0, 1, 2, 3, 5, 10, 20, 50)),
+    'template_render_seconds': (
+        'histogram', 'Time to render a template, by template.',
+        ('template',), LATENCY_BUCKETS),
+    'stripe_requests_total': (
+        'counter', 'Calls to Stripe, by endpoint and HTTP status, error or rejected.',
+        ('endpoint', 'status'), None),
+    'stripe_request_duration_seconds': (
+        'histogram', 'Time one call to Stripe took, by endpoint.',
+        ('endpoint',), LATENCY_BUCKETS),
+    'stripe_circuit_open': (
+        'gauge', 'Workers whose Stripe circuit breaker is open.', (), None),
+    'checkout_sessions_total': (
+        'counter', 'Checkout sessions handed out, by whether they were created or reused.',
+        ('outcome',), None),
+}
+
+def default_dir(name):
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, f'{name}-metrics-{os.getuid()}')
+
+class Registry:
+    """One process's metric values.
+
+    Values are keyed by (metric name, label values); a histogram value is
+    [bucket counts..., +Inf count, sum].
+    """
+
+    def __init__(self):
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, labels, value):
+        with self._lock:
+            self.values[(name, labels)] = value
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][3]
+        key = (name, labels)
+        with self._lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = [0] * (len(buckets) + 2)
+            histogram[bisect.bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+
+    def record_request(self, endpoint, method, status, elapsed, queries):
+        """The per-request updates, under one lock acquisition."""
+        values = self.values
+        with self._lock:
+            key = ('http_requests_total', (endpoint, method, status))
+            values[key] = values.get(key, 0) + 1
+            for name, value in (('http_request_duration_seconds', elapsed),
+                                ('db_queries_per_request', queries)):
+                key = (name, (endpoint,))
+                histogram = values.get(key)
+                if histogram is None:
+                    histogram = values[key] = [0] * (len(METRICS[name][3]) + 2)
+                histogram[bisect.bisect_left(METRICS[name][3], value)] += 1
+                histogram[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {key: list(value) if isinstance(value, list) else value
+                    for key, value in self.values.items()}
+
+def merge(into, values, gauges=True):
+    for key, value in values.items():
+        if METRICS[key[0]][0] == 'gauge' and not gauges:
+            continue
+        if isinstance(value, list):
+            current = into.setdefault(key, [0] * len(value))
+            for i, amount in enumerate(value):
+                current[i] += amount
+        else:
+            into[key] = into.get(key, 0) + value
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def render(values):
+    """Format merged values in the Prometheus text exposition format."""
+    by_name = defaultdict(list)
+    for (name, labels), value in values.items():
+        by_name[name].append((labels, value))
+
+    lines = []
+    for name, (kind, help_text, label_names, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(by_name.get(name, ()), key=lambda item: item[0]):
+            if kind != 'histogram':
+                lines.append(f'{name}{format_labels(label_names, labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), value[:-1]):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{name}_bucket{format_labels(label_names, labels, le)} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(label_names, labels)} {value[-1]}')
+            lines.append(f'{name}_count{format_labels(label_names, labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+class Metrics:
+    def __init__(self, app=None, db=None, name='discobots'):
+        self.registry = Registry()
+        self.directory = os.environ.get('METRICS_DIR') or default_dir(name)
+        self._local = threading.local()
+        self._writer_pid = None
+        self._writer_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db=None):
+        app.config.setdefault('METRICS_FLUSH_INTERVAL', 5.0)
+        app.config.setdefault('METRICS_TOKEN', os.environ.get('METRICS_TOKEN'))
+        self.app = app
+        self.interval = app.config['METRICS_FLUSH_INTERVAL']
+        self.token = app.config['METRICS_TOKEN']
+        os.makedirs(self.directory, exist_ok=True)
+
+        app.wsgi_app = self.middleware(app.wsgi_app)
+        app.before_request(self._resolve_endpoint)
+        before_render_template.connect(self._template_started, app, weak=False)
+        template_rendered.connect(self._template_finished, app, weak=False)
+        self.db = db
+        self._listening = False
+        app.add_url_rule('/metrics', 'metrics', self.view)
+        app.extensions['metrics'] = self
+        atexit.register(self.write_snapshot)
+
+    # ==================
+    # COLLECTION
+    # ==================
+
+    def middleware(self, wsgi_app):
+        registry = self.registry
+        local = self._local
+
+        def instrumented(environ, start_response):
+            status = ['500']
+
+            def recording_start_response(status_line, headers, exc_info=None):
+                status[0] = status_line[:3]
+                return start_response(status_line, headers, exc_info)
+
+            local.endpoint = None
+            local.queries = 0
+            registry.inc('http_requests_in_flight', ())
+            start = time.perf_counter()
+            try:
+                return wsgi_app(environ, recording_start_response)
+            finally:
+                elapsed = time.perf_counter() - start
+                endpoint = local.endpoint or 'unmatched'
+                registry.inc('http_requests_in_flight', (), -1)
+                registry.record_request(endpoint, environ['REQUEST_METHOD'], status[0],
+                                        elapsed, local.queries)
+                local.endpoint = None
+                # A template whose render raised never finished
+                local.templates = []
+                self._ensure_writer()
+
+        return instrumented
+
+    def _resolve_endpoint(self):
+        self._local.endpoint = request.endpoint
+        # The engine is created on first use, so listen from the first request
+        if not self._listening and self.db is not None:
+            with self._writer_lock:
+                if not self._listening:
+                    event.listen(self.db.engine, 'before_cursor_execute', self._query_started)
+                    event.listen(self.db.engine, 'after_cursor_execute', self._query_finished)
+                    self._listening = True
+
+    def _query_started(self, conn, cursor, statement, parameters, context, executemany):
+        context.metrics_started = time.perf_counter()
+
+    def _query_finished(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context.metrics_started
+        endpoint = getattr(self._local, 'endpoint', None) or 'none'
+        self._local.queries = getattr(self._local, 'queries', 0) + 1
+        self.registry.inc('db_queries_total', (endpoint,))
+        self.registry.observe('db_query_duration_seconds', (endpoint,), elapsed)
+
+    def _template_started(self, app, template, context, **extra):
+        # Templates may also be rendered outside a request, e.g. in a shell
+        stack = getattr(self._local, 'templates', None)
+        if stack is None:
+            stack = self._local.templates = []
+        stack.append(time.perf_counter())
+
+    def _template_finished(self, app, template, context, **extra):
+        elapsed = time.perf_counter() - self._local.templates.pop()
+        self.registry.observe('template_render_seconds', (template.name or 'string',), elapsed)
+
+    # ==================
+    # SHARING BETWEEN WORKERS
+    # ==================
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'{pid}.metrics')
+
+    def _ensure_writer(self):
+        # Threads don't survive fork, so each worker starts its own
+        if self._writer_pid != os.getpid():
+            with self._writer_lock:
+                if self._writer_pid != os.getpid():
+                    threading.Thread(target=self._run_writer, daemon=True,
+                                     name='metrics-writer').start()
+                    self._writer_pid = os.getpid()
+
+    def _run_writer(self):
+        while True:
+            time.sleep(self.interval)
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        path = self._path(os.getpid())
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(self.registry.snapshot(), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return {}
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _archive_exited_workers(self):
+        archive_path = os.path.join(self.directory, 'archive.pickle')
+        with open(os.path.join(self.directory, 'archive.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            exited = [path for path in glob.glob(os.path.join(self.directory, '*.metrics'))
+                      if not self._alive(int(os.path.basename(path).split('.')[0]))]
+            if not exited:
+                return
+            archive = self._read(archive_path)
+            for path in exited:
+                merge(archive, self._read(path), gauges=False)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(archive, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, archive_path)
+            for path in exited:
+                os.unlink(path)
+
+    def collect(self):
+        """Merged values of every worker on the host, this one up to date."""
+        self._archive_exited_workers()
+        values = {}
+        own = self._path(os.getpid())
+        for path in glob.glob(os.path.join(self.directory, '*.metrics')):
+            if path != own:
+                merge(values, self._read(path))
+        merge(values, self._read(os.path.join(self.directory, 'archive.pickle')))
+        merge(values, self.registry.snapshot())
+        return values
+
+    # ==================
+    # VIEW
+    # ==================
+
+    def view(self):
+        if self.token:
+            supplied = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(supplied, f'Bearer {self.token}'):
+                abort(401)
+        elif not self.app.debug:
+            abort(404)
+        return Response(render(self.collect()),
+                        mimetype='text/plain; version=0.0.4; charset=utf-8',
+                        headers={'Cache-Control': 'no-store'})
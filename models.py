@@ -1,5 +1,10 @@
+from flask import current_app
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import func, inspect, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateColumn, CreateIndex
+import passwords
+from integrity import conflicting_field
 from app import db
 
 class User(UserMixin, db.Model):
@@ -9,9 +14,90 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(256))
     theme = db.Column(db.String(20), default='light')
     language = db.Column(db.String(10), default='en')
+    # Bumped on every profile change so session snapshots can tell they are stale
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    # Addresses differing only in case belong to the same person
+    __table_args__ = (db.Index('uq_user_email_lower', func.lower(email), unique=True),)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
\ No newline at end of file
+        return passwords.verify_password(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return passwords.needs_rehash(self.password_hash)
+
+    def bump_version(self):
+        # Incremented in SQL so concurrent writers can't lose a bump
+        self.version = User.version + 1
+
+def normalize_email(email):
+    return email.strip()
+
+class Principal(UserMixin):
+    """The logged-in user as recorded in the signed session cookie.
+
+    Carries just what page rendering needs, so authenticated page views
+    don't have to load the User row. Views that need the full row use
+    principal.user, which loads it on first access.
+    """
+
+    def __init__(self, id, username, theme, language, version, user=None):
+        self.id = id
+        self.username = username
+        self.theme = theme
+        self.language = language
+        self.version = version
+        self._user = user
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.theme, user.language, user.version, user=user)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'username': self.username,
+            'theme': self.theme,
+            'language': self.language,
+            'version': self.version,
+        }
+
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = db.session.get(User, self.id)
+        return self._user
+
+def add_missing_columns(*models):
+    """Add columns introduced after a model's table was created.
+
+    db.create_all() only creates missing tables, so new columns need a
+    server default to be added this way.
+    """
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    with db.engine.begin() as connection:
+        for model in models:
+            table = model.__table__
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                    connection.execute(text(
+                        f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl}'))
+
+def add_missing_indexes(*models):
+    """Create indexes declared after a model's table was created.
+
+    Fails with a warning if existing rows violate a new unique index.
+    """
+    for model in models:
+        for index in model.__table__.indexes:
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(CreateIndex(index, if_not_exists=True))
+            except IntegrityError as e:
+                current_app.logger.warning('Could not create index %s: %s', index.name, e.orig)
@@ -9,7 +9,7 @@ echo "Created discobots_frontend.zip - Upload this file to Netlify"
 
 # Create a zip file of the backend API for other hosting
 echo "Creating zip file of backend API for hosting..."
-zip -r discobots_api.zip discobots_api.py api_requirements.txt
+zip -r discobots_api.zip discobots_api.py shared_cache.py metrics.py query_inspector.py passwords.py availability.py integrity.py stripe_client.py stripe_catalog.py stripe_webhooks.py checkout_sessions.py page_cache.py api_requirements.txt
 echo "Created discobots_api.zip - Deploy this to your Python hosting service"
 
 echo "Done!"
\ No newline at end of file
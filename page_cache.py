@@ -0,0 +1,121 @@
+"""
+DiscoBots.fr - Full-page cache for anonymous visitors
+
+Logged-out visitors with the same theme and language get byte-identical
+pages, so the rendered HTML is cached per (endpoint, theme, language, asset
+version) and served with a strong ETag. Requests from logged-in users or
+with pending flash messages always render normally.
+
+Entries live in a per-process MemoryStore by default; pass a SharedCache
+as store to share them between gunicorn workers.
+
+Usage:
+    page_cache = PageCache(app, store=SharedCache(), version=assets.version)
+
+    @app.route('/')
+    @page_cache.cached
+    def index():
+        ...
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, current_app, g, make_response, request, session
+
+class MemoryStore:
+    """Per-process LRU of cache entries with a time-to-live."""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class PageCache:
+    def __init__(self, app=None, store=None, version=None):
+        self.store = store or MemoryStore()
+        self.version = version or (lambda app: '')
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PAGE_CACHE_ENABLED', True)
+        app.config.setdefault('PAGE_CACHE_TTL', 300)
+        app.extensions['page_cache'] = self
+        # A shared store outlives a deploy, so pages rendered from older
+        # templates must not match the new ones
+        digest = hashlib.sha256()
+        for name in sorted(app.jinja_env.list_templates()):
+            digest.update(app.jinja_loader.get_source(app.jinja_env, name)[0].encode('utf-8'))
+        self.template_version = digest.hexdigest()[:12]
+
+    def is_cacheable(self):
+        # Checking the session directly avoids loading the user just to find
+        # out they are logged in
+        return (current_app.config['PAGE_CACHE_ENABLED']
+                and request.method in ('GET', 'HEAD')
+                and '_user_id' not in session
+                and '_flashes' not in session)
+
+    def key(self):
+        return '|'.join(('page', request.endpoint, g.theme, g.language,
+                         self.template_version, self.version(current_app)))
+
+    def cached(self, view):
+        @wraps(view)
+        def decorated(*args, **kwargs):
+            if not self.is_cacheable():
+                return view(*args, **kwargs)
+
+            key = self.key()
+            entry = self.store.get(key)
+            if entry is None:
+                response = make_response(view(*args, **kwargs))
+                # Anything that wrote to the session made the page personal
+                if response.status_code != 200 or session.modified:
+                    return response
+                body = response.get_data()
+                entry = (body, hashlib.sha256(body).hexdigest()[:32], response.mimetype)
+                self.store.set(key, entry, current_app.config['PAGE_CACHE_TTL'])
+
+            body, etag, mimetype = entry
+            # The page depends on the theme and language kept in the session
+            # cookie, so browsers must revalidate rather than reuse it blindly
+            headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache', 'Vary': 'Cookie'}
+            if request.if_none_match.contains(etag):
+                return Response(status=304, headers=headers)
+            return Response(body, mimetype=mimetype, headers=headers)
+        return decorated
+
+    def clear(self):
+        self.store.clear()
@@ -0,0 +1,121 @@
+"""
+DiscoBots.fr - Password hashing off the request thread
+
+Password hashes are deliberately slow. Computed inline, a burst of logins
+pins every gunicorn worker's CPU and stalls unrelated page views. Here each
+worker hands hashing to a small process pool whose processes run at a lower
+CPU priority, admits only a bounded number of pending hashes, and gives up
+after a timeout. Callers get PasswordHashingBusy instead of queueing forever.
+
+Configuration (environment variables):
+    PASSWORD_HASH_METHOD    werkzeug method string, e.g. scrypt:32768:8:1
+    PASSWORD_HASH_WORKERS   pool processes per worker (default 1)
+    PASSWORD_HASH_QUEUE     pending hashes allowed per worker (default 4)
+    PASSWORD_HASH_TIMEOUT   seconds to wait for a result (default 5)
+
+To pick a method for the current hardware:
+    python passwords.py calibrate --target-ms 250
+"""
+
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+POOL_SIZE = int(os.environ.get("PASSWORD_HASH_WORKERS", 1))
+MAX_PENDING = int(os.environ.get("PASSWORD_HASH_QUEUE", 4))
+TIMEOUT = float(os.environ.get("PASSWORD_HASH_TIMEOUT", 5))
+
+# Hashing processes yield the CPU to page-serving workers
+NICENESS = 10
+
+class PasswordHashingBusy(Exception):
+    """Too many hashes are pending, or one took longer than TIMEOUT."""
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(MAX_PENDING)
+
+def _get_executor():
+    global _executor, _executor_pid
+    # A pool inherited from the parent across fork is unusable
+    if _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor_pid != os.getpid():
+                _executor = ProcessPoolExecutor(POOL_SIZE, initializer=os.nice,
+                                                initargs=(NICENESS,))
+                _executor_pid = os.getpid()
+    return _executor
+
+def _run(fn, *args, **kwargs):
+    if not _pending.acquire(blocking=False):
+        raise PasswordHashingBusy('too many password hashes pending')
+    try:
+        future = _get_executor().submit(fn, *args, **kwargs)
+    except Exception:
+        _pending.release()
+        raise
+    # The slot is held until the hash really finishes, even if we stop waiting
+    future.add_done_callback(lambda _: _pending.release())
+    try:
+        return future.result(timeout=TIMEOUT)
+    except TimeoutError:
+        future.cancel()
+        raise PasswordHashingBusy('password hashing timed out')
+
+def hash_password(password):
+    return _run(generate_password_hash, password, method=HASH_METHOD)
+
+def verify_password(pwhash, password):
+    return _run(check_password_hash, pwhash, password)
+
+def needs_rehash(pwhash):
+    """True if pwhash was made with parameters other than HASH_METHOD."""
+    return pwhash.split('$', 1)[0] != HASH_METHOD
+
+# ==================
+# CALIBRATION
+# ==================
+
+def time_method(method, rounds=3):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        generate_password_hash('calibration-password', method=method)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def calibrate(target_ms, algorithm='scrypt'):
+    """Return the strongest method whose hash takes at most target_ms here."""
+    if algorithm == 'scrypt':
+        candidates = [f'scrypt:{2 ** exponent}:8:1' for exponent in range(14, 21)]
+    else:
+        candidates = [f'pbkdf2:sha256:{iterations}'
+                      for iterations in (200_000, 300_000, 400_000, 600_000,
+                                         800_000, 1_000_000, 1_500_000, 2_000_000)]
+
+    chosen = candidates[0]
+    for method in candidates:
+        elapsed_ms = time_method(method) * 1000
+        print(f'{method:<28} {elapsed_ms:8.1f} ms')
+        if elapsed_ms > target_ms:
+            break
+        chosen = method
+    return chosen
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Password hashing tools.')
+    parser.add_argument('command', choices=['calibrate'])
+    parser.add_argument('--target-ms', type=float, default=250,
+                        help='longest acceptable time for one hash')
+    parser.add_argument('--algorithm', choices=['scrypt', 'pbkdf2'], default='scrypt')
+    args = parser.parse_args()
+
+    method = calibrate(args.target_ms, args.algorithm)
+    print(f'\nexport PASSWORD_HASH_METHOD={method}')
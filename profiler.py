@@ -0,0 +1,207 @@
+"""
+DiscoBots.fr - On-demand request profiling
+
+Profiles single requests in place with a sampling profiler: while the
+request runs, a helper thread records the request thread's call stack every
+PROFILE_INTERVAL seconds. Everything that thread does shows up, including
+Jinja rendering, SQLAlchemy and Stripe calls, and waiting on the password
+hashing pool.
+
+A request is profiled when it carries the token, as an "X-Profile: <token>"
+header or a "?_profile=<token>" query argument, or when it is picked at
+random at PROFILE_SAMPLE_RATE. Each profile is written to PROFILE_DIR as
+speedscope JSON (open it at https://www.speedscope.app) or as collapsed
+stacks for flamegraph.pl, and only the newest PROFILE_KEEP files are kept,
+or all of them when PROFILE_KEEP is 0.
+
+Without a token and with a zero sample rate nothing is installed, so
+requests pay nothing.
+
+Configuration (environment variables):
+    PROFILER_TOKEN        secret that triggers profiling of a request
+    PROFILE_SAMPLE_RATE   fraction of requests to profile (default 0)
+    PROFILE_DIR           output directory (default in the temp directory)
+    PROFILE_FORMAT        speedscope (default) or collapsed
+    PROFILE_KEEP          number of profiles kept, 0 for all (default 50)
+
+Usage:
+    profiler = RequestProfiler(app)
+"""
+
+import hmac
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+class StackSampler:
+    """Records the stacks of one thread until stopped."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='profiler')
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+
+    def _run(self):
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            # Weight by the real gap: the sampler can't run while the
+            # request thread holds the GIL
+            self.samples[tuple(reversed(stack))] += now - last
+            last = now
+
+def collapsed(samples):
+    """Brendan Gregg's collapsed stack format, weights in microseconds."""
+    lines = []
+    for stack, seconds in samples.items():
+        frames = ';'.join(f'{name} ({os.path.basename(filename)}:{line})'
+                          for name, filename, line in stack)
+        lines.append(f'{frames} {round(seconds * 1e6)}')
+    return '\n'.join(lines) + '\n'
+
+def speedscope(samples, name, elapsed):
+    frames, index = [], {}
+    profile_samples, weights = [], []
+    for stack, seconds in samples.items():
+        ids = []
+        for frame in stack:
+            if frame not in index:
+                index[frame] = len(frames)
+                frames.append({'name': frame[0], 'file': frame[1], 'line': frame[2]})
+            ids.append(index[frame])
+        profile_samples.append(ids)
+        weights.append(seconds)
+    return json.dumps({
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'discobots-profiler',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': elapsed,
+            'samples': profile_samples,
+            'weights': weights,
+        }],
+    })
+
+class RequestProfiler:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILER_TOKEN', os.environ.get('PROFILER_TOKEN'))
+        app.config.setdefault('PROFILE_SAMPLE_RATE', float(os.environ.get('PROFILE_SAMPLE_RATE', 0)))
+        app.config.setdefault('PROFILE_DIR', os.environ.get('PROFILE_DIR')
+                              or os.path.join(tempfile.gettempdir(), 'discobots-profiles'))
+        app.config.setdefault('PROFILE_FORMAT', os.environ.get('PROFILE_FORMAT', 'speedscope'))
+        app.config.setdefault('PROFILE_KEEP', int(os.environ.get('PROFILE_KEEP', 50)))
+        app.config.setdefault('PROFILE_INTERVAL', 0.001)
+        self.token = app.config['PROFILER_TOKEN']
+        self.sample_rate = app.config['PROFILE_SAMPLE_RATE']
+        self.directory = app.config['PROFILE_DIR']
+        self.format = app.config['PROFILE_FORMAT']
+        self.keep = app.config['PROFILE_KEEP']
+        self.interval = app.config['PROFILE_INTERVAL']
+        if self.format not in ('speedscope', 'collapsed'):
+            raise ValueError(f'PROFILE_FORMAT must be speedscope or collapsed, not {self.format!r}')
+        if self.keep < 0:
+            raise ValueError(f'PROFILE_KEEP must be 0 or more, not {self.keep}')
+        app.extensions['profiler'] = self
+        if not self.token and not self.sample_rate:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        app.wsgi_app = self.middleware(app.wsgi_app)
+
+    def _requested(self, environ):
+        supplied = environ.get('HTTP_X_PROFILE')
+        if supplied is None and '_profile=' in environ.get('QUERY_STRING', ''):
+            supplied = parse_qs(environ['QUERY_STRING']).get('_profile', [''])[0]
+        return bool(self.token and supplied and hmac.compare_digest(supplied, self.token))
+
+    def middleware(self, wsgi_app):
+        def profiled(environ, start_response):
+            requested = self._requested(environ)
+            if not requested and not (self.sample_rate and random.random() < self.sample_rate):
+                return wsgi_app(environ, start_response)
+
+            filename = self._filename(environ)
+            sampler = StackSampler(threading.get_ident(), self.interval)
+
+            def announcing_start_response(status, headers, exc_info=None):
+                # Only whoever asked for the profile learns where it went
+                if requested:
+                    headers = headers + [('X-Profile-File', filename)]
+                return start_response(status, headers, exc_info)
+
+            sampler.start()
+            try:
+                # Buffer the body so lazily generated responses are profiled too
+                result = wsgi_app(environ, announcing_start_response)
+                try:
+                    body = b''.join(result)
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+            finally:
+                sampler.stop()
+                self.write(filename, sampler, f"{environ['REQUEST_METHOD']} {environ.get('PATH_INFO', '/')}")
+            return [body]
+        return profiled
+
+    def _filename(self, environ):
+        path = re.sub(r'[^A-Za-z0-9]+', '-', environ.get('PATH_INFO', '/')).strip('-') or 'index'
+        suffix = '.speedscope.json' if self.format == 'speedscope' else '.collapsed.txt'
+        return f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{path[:60]}-{random.randrange(16 ** 6):06x}{suffix}'
+
+    def write(self, filename, sampler, name):
+        if self.format == 'speedscope':
+            content = speedscope(sampler.samples, name, sampler.elapsed)
+        else:
+            content = collapsed(sampler.samples)
+        with open(os.path.join(self.directory, filename), 'w') as f:
+            f.write(content)
+        self._prune()
+
+    def _prune(self):
+        if not self.keep:
+            return
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(('.speedscope.json', '.collapsed.txt')):
+                entries.append((entry.stat().st_mtime, entry.path))
+        entries.sort()
+        for _, path in entries[:-self.keep]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,212 @@
+"""
+DiscoBots.fr - Slow-query and N+1 detection
+
+Watches every SQL statement through SQLAlchemy's cursor events and checks
+each request against a few rules:
+
+- the same statement (ignoring bind values) running QUERY_REPEAT_THRESHOLD
+  or more times in one request, the usual sign of an N+1 loop
+- more than QUERY_BUDGET statements in one request
+- any statement slower than SLOW_QUERY_MS
+
+Offending requests are logged with the statement and the shape of its bind
+parameters (their types, never their values), and counted in a per-endpoint
+report served as JSON at /debug/queries.
+
+Modes (QUERY_INSPECTOR environment variable):
+    off     nothing is hooked (default)
+    log     log and report; safe to leave on in production
+    strict  also add X-Query-Count/X-Query-Time headers and raise
+            QueryBudgetExceeded, so tests and development catch regressions
+
+The report is kept per worker. Outside debug mode it needs
+"Authorization: Bearer <QUERY_INSPECTOR_TOKEN>".
+
+Usage:
+    query_inspector = QueryInspector(app, db)
+"""
+
+import hmac
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import abort, jsonify, request
+from sqlalchemy import event
+
+class QueryBudgetExceeded(Exception):
+    """A request broke a query rule while QUERY_INSPECTOR is strict."""
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r'\(\s*(?:\?|%\(\w+\)s|%s|:\w+)(?:\s*,\s*(?:\?|%\(\w+\)s|%s|:\w+))*\s*\)')
+_SPACE = re.compile(r'\s+')
+
+def fingerprint(statement):
+    """Statement text with literals, IN lists and whitespace normalised."""
+    text = _SPACE.sub(' ', statement).strip()
+    text = _LITERALS.sub('?', text)
+    return _IN_LISTS.sub('(?...)', text)
+
+def parameter_shape(parameters, executemany=False):
+    """Describe bind parameters by type only, e.g. (int, str) or {id: int}."""
+    if executemany:
+        rows = list(parameters)
+        return f'{len(rows)} x {parameter_shape(rows[0])}' if rows else '0 rows'
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f'{name}: {type(value).__name__}'
+                               for name, value in parameters.items()) + '}'
+    if parameters:
+        return '(' + ', '.join(type(value).__name__ for value in parameters) + ')'
+    return '()'
+
+class QueryInspector:
+    def __init__(self, app=None, db=None):
+        self.db = db
+        self._local = threading.local()
+        self._fingerprints = {}
+        self._report = defaultdict(lambda: {
+            'requests': 0, 'queries': 0, 'max_queries': 0, 'time_ms': 0.0,
+            'over_budget': 0, 'repeated': Counter(), 'slow': Counter(),
+        })
+        self._report_lock = threading.Lock()
+        self._listening = False
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        app.config.setdefault('QUERY_INSPECTOR', os.environ.get('QUERY_INSPECTOR', 'off'))
+        app.config.setdefault('QUERY_INSPECTOR_TOKEN', os.environ.get('QUERY_INSPECTOR_TOKEN'))
+        app.config.setdefault('QUERY_BUDGET', int(os.environ.get('QUERY_BUDGET', 10)))
+        app.config.setdefault('QUERY_REPEAT_THRESHOLD', 3)
+        app.config.setdefault('SLOW_QUERY_MS', float(os.environ.get('SLOW_QUERY_MS', 100)))
+        self.db = db
+        self.app = app
+        self.mode = app.config['QUERY_INSPECTOR']
+        if self.mode not in ('off', 'log', 'strict'):
+            raise ValueError(f'QUERY_INSPECTOR must be off, log or strict, not {self.mode!r}')
+        app.extensions['query_inspector'] = self
+        if self.mode == 'off':
+            return
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._discard_request)
+        app.add_url_rule('/debug/queries', 'query_report', self.view)
+
+    # ==================
+    # STATEMENTS
+    # ==================
+
+    def _listen(self):
+        # The engine is created on first use, so listen from the first request
+        with self._report_lock:
+            if not self._listening:
+                event.listen(self.db.engine, 'before_cursor_execute', self._query_started)
+                event.listen(self.db.engine, 'after_cursor_execute', self._query_finished)
+                self._listening = True
+
+    def _fingerprint(self, statement):
+        # SQLAlchemy reuses statement strings, so this is usually a dict hit
+        result = self._fingerprints.get(statement)
+        if result is None:
+            if len(self._fingerprints) > 5000:
+                self._fingerprints.clear()
+            result = self._fingerprints[statement] = fingerprint(statement)
+        return result
+
+    def _query_started(self, conn, cursor, statement, parameters, context, executemany):
+        context.inspector_started = time.perf_counter()
+
+    def _query_finished(self, conn, cursor, statement, parameters, context, executemany):
+        queries = getattr(self._local, 'queries', None)
+        if queries is None:
+            return
+        elapsed_ms = (time.perf_counter() - context.inspector_started) * 1000
+        key = self._fingerprint(statement)
+        queries.append((key, elapsed_ms))
+        if elapsed_ms >= self.app.config['SLOW_QUERY_MS']:
+            self.app.logger.warning(
+                'Slow query (%.1f ms) in %s: %s  params %s', elapsed_ms, request.endpoint,
+                key, parameter_shape(parameters, executemany))
+            self._local.slow.append(key)
+
+    # ==================
+    # REQUESTS
+    # ==================
+
+    def _start_request(self):
+        if not self._listening:
+            self._listen()
+        self._local.queries = []
+        self._local.slow = []
+
+    def _finish_request(self, response):
+        queries = getattr(self._local, 'queries', None)
+        if queries is None:
+            return response
+        slow = self._local.slow
+        self._local.queries = None
+        endpoint = request.endpoint or 'unmatched'
+        config = self.app.config
+        total_ms = sum(elapsed for _, elapsed in queries)
+
+        counts = Counter(key for key, _ in queries)
+        repeated = {key: count for key, count in counts.items()
+                    if count >= config['QUERY_REPEAT_THRESHOLD']}
+        over_budget = len(queries) > config['QUERY_BUDGET']
+        for key, count in repeated.items():
+            self.app.logger.warning('Possible N+1 in %s: %d x %s', endpoint, count, key)
+        if over_budget:
+            self.app.logger.warning('%s ran %d queries (budget %d)',
+                                    endpoint, len(queries), config['QUERY_BUDGET'])
+
+        with self._report_lock:
+            stats = self._report[endpoint]
+            stats['requests'] += 1
+            stats['queries'] += len(queries)
+            stats['max_queries'] = max(stats['max_queries'], len(queries))
+            stats['time_ms'] += total_ms
+            stats['over_budget'] += over_budget
+            stats['repeated'].update(repeated.keys())
+            stats['slow'].update(slow)
+
+        if self.mode == 'strict':
+            response.headers['X-Query-Count'] = str(len(queries))
+            response.headers['X-Query-Time'] = f'{total_ms:.1f}ms'
+            if repeated or over_budget:
+                raise QueryBudgetExceeded(
+                    f'{endpoint} ran {len(queries)} queries'
+                    + ''.join(f'; {count} x {key}' for key, count in repeated.items()))
+        return response
+
+    def _discard_request(self, exc):
+        self._local.queries = None
+
+    # ==================
+    # REPORT
+    # ==================
+
+    def report(self):
+        """Per-endpoint totals, worst offenders first."""
+        with self._report_lock:
+            rows = [{
+                'endpoint': endpoint,
+                'requests': stats['requests'],
+                'avg_queries': round(stats['queries'] / stats['requests'], 2),
+                'max_queries': stats['max_queries'],
+                'avg_query_ms': round(stats['time_ms'] / stats['requests'], 2),
+                'over_budget': stats['over_budget'],
+                'repeated': dict(stats['repeated'].most_common(10)),
+                'slow': dict(stats['slow'].most_common(10)),
+            } for endpoint, stats in self._report.items()]
+        rows.sort(key=lambda row: (row['over_budget'], row['max_queries']), reverse=True)
+        return rows
+
+    def view(self):
+        token = self.app.config['QUERY_INSPECTOR_TOKEN']
+        if not self.app.debug:
+            supplied = request.headers.get('Authorization', '')
+            if not token or not hmac.compare_digest(supplied, f'Bearer {token}'):
+                abort(404)
+        return jsonify({'worker': os.getpid(), 'endpoints': self.report()})
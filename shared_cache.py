@@ -0,0 +1,280 @@
+"""
+DiscoBots.fr - Cross-worker shared-memory cache
+
+gunicorn runs several worker processes per host, so an in-process cache is
+warmed once per worker and holds one copy per worker. SharedCache keeps its
+entries in a memory-mapped file (under /dev/shm when available) that every
+worker on the host maps, so a page rendered by one worker is served from
+memory by all of them.
+
+The file is split into fixed-size slots grouped into small LRU sets:
+a key hashes to one set and may live in any of its slots. Reads are
+lock-free, using a per-slot sequence counter to detect concurrent writes;
+writes take one of a fixed number of striped fcntl locks so unrelated keys
+don't contend. Values are pickled and must fit in a slot; larger values are
+simply not cached.
+
+Usage:
+    cache = SharedCache('discobots')
+    cache.set('greeting', {'hello': 'world'}, ttl=60)
+    cache.get('greeting')
+
+    with cache.lock('rebuild'):
+        ...  # read, then publish with cache.set()
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+MAGIC = b'DBCACHE1'
+
+# magic, slot count, slot size, ways
+FILE_HEADER = struct.Struct('<8sIII')
+FILE_HEADER_SIZE = 64
+
+# sequence, key hash, expires, last access, key length, value length
+SLOT_HEADER = struct.Struct('<IQddHI')
+SEQUENCE = struct.Struct('<I')
+LAST_ACCESS = struct.Struct('<d')
+LAST_ACCESS_OFFSET = 4 + 8 + 8
+
+LOCK_STRIPES = 64
+
+# Locks for callers, see lock(); they follow the stripes in the file
+NAMED_LOCKS = 16
+
+# A reader gives up and reports a miss if a slot keeps changing under it
+READ_ATTEMPTS = 4
+
+def default_path(name):
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, f'{name}-{os.getuid()}.cache')
+
+class SharedCache:
+    def __init__(self, name='discobots', path=None, slots=1024, slot_size=32 * 1024, ways=8):
+        if slots % ways:
+            raise ValueError('slots must be a multiple of ways')
+        self.path = path or default_path(name)
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ways = ways
+        self.sets = slots // ways
+        self.max_value_size = slot_size - SLOT_HEADER.size
+        self._thread_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._named_locks = [threading.Lock() for _ in range(NAMED_LOCKS)]
+        self._fd = None
+        self._map = None
+        self._pid = None
+
+    # ==================
+    # MAPPING
+    # ==================
+
+    def _open(self):
+        size = FILE_HEADER_SIZE + self.slots * self.slot_size
+        expected = FILE_HEADER.pack(MAGIC, self.slots, self.slot_size, self.ways)
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            # Byte 0 guards initialisation; workers starting together must not
+            # both format the file
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, 0)
+            try:
+                # Another worker may have replaced the file while we waited
+                current = os.stat(self.path).st_ino == os.fstat(fd).st_ino
+                ready = (current and os.pread(fd, FILE_HEADER.size, 0) == expected
+                         and os.fstat(fd).st_size == size)
+                if current and not ready:
+                    # New, or laid out differently. Processes may still have
+                    # the old file mapped, and shrinking it under them would
+                    # crash them with SIGBUS, so a fresh file takes its place
+                    self._replace(size, expected)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, 0)
+            if ready:
+                break
+            os.close(fd)
+        self._fd = fd
+        self._map = mmap.mmap(fd, size)
+        self._pid = os.getpid()
+
+    def _replace(self, size, header):
+        fd, path = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.',
+                                    dir=os.path.dirname(self.path))
+        try:
+            os.ftruncate(fd, size)
+            os.pwrite(fd, header, 0)
+            os.rename(path, self.path)
+        except BaseException:
+            os.unlink(path)
+            raise
+        finally:
+            os.close(fd)
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+            os.close(self._fd)
+        self._map = self._fd = None
+
+    @property
+    def _buffer(self):
+        # Mappings are inherited across fork, but lock ownership is not, so
+        # each worker opens its own descriptor, closing the inherited one
+        if self._pid != os.getpid():
+            self._close()
+            self._open()
+        return self._map
+
+    def _lock(self, stripe):
+        lock = self._thread_locks[stripe]
+        buffer = self._buffer
+        lock.acquire()
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, 1 + stripe)
+        return buffer, lock
+
+    def _unlock(self, stripe, lock):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 1 + stripe)
+        lock.release()
+
+    # ==================
+    # SLOTS
+    # ==================
+
+    def _locate(self, key):
+        encoded = key.encode('utf-8')
+        key_hash = int.from_bytes(hashlib.blake2b(encoded, digest_size=8).digest(), 'little')
+        first = (key_hash % self.sets) * self.ways
+        return encoded, key_hash, first
+
+    def _offset(self, slot):
+        return FILE_HEADER_SIZE + slot * self.slot_size
+
+    def _read_slot(self, buffer, offset, encoded, key_hash, now):
+        for _ in range(READ_ATTEMPTS):
+            sequence, slot_hash, expires, _, key_len, value_len = SLOT_HEADER.unpack_from(buffer, offset)
+            if sequence & 1:
+                continue
+            if slot_hash != key_hash or not key_len or expires < now:
+                data = None
+            else:
+                start = offset + SLOT_HEADER.size
+                stored_key = buffer[start:start + key_len]
+                data = buffer[start + key_len:start + key_len + value_len]
+                if stored_key != encoded:
+                    data = None
+            if SEQUENCE.unpack_from(buffer, offset)[0] == sequence:
+                return data
+        return None
+
+    def _write_slot(self, buffer, offset, encoded, key_hash, expires, data):
+        sequence = SEQUENCE.unpack_from(buffer, offset)[0]
+        SEQUENCE.pack_into(buffer, offset, (sequence + 1) & 0xFFFFFFFF)
+        SLOT_HEADER.pack_into(buffer, offset, (sequence + 1) & 0xFFFFFFFF, key_hash,
+                              expires, time.time(), len(encoded), len(data))
+        start = offset + SLOT_HEADER.size
+        buffer[start:start + len(encoded) + len(data)] = encoded + data
+        SEQUENCE.pack_into(buffer, offset, (sequence + 2) & 0xFFFFFFFF)
+
+    # ==================
+    # PUBLIC API
+    # ==================
+
+    def get(self, key, default=None):
+        encoded, key_hash, first = self._locate(key)
+        buffer = self._buffer
+        now = time.time()
+        for slot in range(first, first + self.ways):
+            offset = self._offset(slot)
+            data = self._read_slot(buffer, offset, encoded, key_hash, now)
+            if data is not None:
+                # Racy by design: a lost update only makes LRU slightly less exact
+                LAST_ACCESS.pack_into(buffer, offset + LAST_ACCESS_OFFSET, now)
+                return pickle.loads(data)
+        return default
+
+    def set(self, key, value, ttl=300):
+        """Store value for ttl seconds; returns False if it is too large."""
+        encoded, key_hash, first = self._locate(key)
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(encoded) + len(data) > self.max_value_size:
+            return False
+
+        now = time.time()
+        stripe = (first // self.ways) % LOCK_STRIPES
+        buffer, lock = self._lock(stripe)
+        try:
+            # Prefer the slot already holding this key, then a free or expired
+            # one, then the least recently used
+            victim, victim_rank = None, None
+            for slot in range(first, first + self.ways):
+                offset = self._offset(slot)
+                _, slot_hash, expires, last_access, key_len, _ = SLOT_HEADER.unpack_from(buffer, offset)
+                if slot_hash == key_hash and key_len:
+                    stored = buffer[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + key_len]
+                    if stored == encoded:
+                        victim = offset
+                        break
+                rank = 0 if not key_len or expires < now else last_access
+                if victim_rank is None or rank < victim_rank:
+                    victim, victim_rank = offset, rank
+            self._write_slot(buffer, victim, encoded, key_hash, now + ttl, data)
+        finally:
+            self._unlock(stripe, lock)
+        return True
+
+    def get_or_set(self, key, factory, ttl=300):
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            if value is not None:
+                self.set(key, value, ttl)
+        return value
+
+    def delete(self, key):
+        encoded, key_hash, first = self._locate(key)
+        stripe = (first // self.ways) % LOCK_STRIPES
+        buffer, lock = self._lock(stripe)
+        try:
+            for slot in range(first, first + self.ways):
+                offset = self._offset(slot)
+                _, slot_hash, _, _, key_len, _ = SLOT_HEADER.unpack_from(buffer, offset)
+                stored = buffer[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + key_len]
+                if slot_hash == key_hash and key_len and stored == encoded:
+                    self._write_slot(buffer, offset, b'', 0, 0.0, b'')
+        finally:
+            self._unlock(stripe, lock)
+
+    @contextmanager
+    def lock(self, name):
+        """Hold an exclusive lock named name across every worker on the host.
+
+        For read-then-publish sequences that must not interleave, which
+        set() alone can't prevent. Names share NAMED_LOCKS locks, so an
+        unrelated name may have to wait.
+        """
+        index = hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest()[0] % NAMED_LOCKS
+        self._buffer  # opens this worker's descriptor
+        with self._named_locks[index]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, 1 + LOCK_STRIPES + index)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 1 + LOCK_STRIPES + index)
+
+    def clear(self):
+        for stripe in range(LOCK_STRIPES):
+            buffer, lock = self._lock(stripe)
+            try:
+                for first in range(stripe * self.ways, self.slots, LOCK_STRIPES * self.ways):
+                    for slot in range(first, first + self.ways):
+                        self._write_slot(buffer, self._offset(slot), b'', 0, 0.0, b'')
+            finally:
+                self._unlock(stripe, lock)
@@ -123,10 +123,51 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         }
         
+        // Recolour the particles when the theme is switched in place
+        document.addEventListener('themechange', function(event) {
+            const color = event.detail.theme === 'dark' ? '#ffffff' : '#000000';
+            particleOptions.particleColor = color;
+            particleOptions.connectLineColor = color;
+            particles.forEach(p => {
+                p.color = color;
+            });
+        });
+        
         // Start animation
         animate();
     }
     
+    // Theme and language toggles: ask for JSON instead of following the
+    // redirect, then switch the theme in place or reload for the language.
+    // Falls back to plain navigation if the request fails.
+    document.querySelectorAll('[data-theme], [data-language]').forEach(link => {
+        link.addEventListener('click', function(e) {
+            e.preventDefault();
+            fetch(link.href, {
+                headers: { 'Accept': 'application/json' },
+                credentials: 'same-origin'
+            }).then(response => {
+                if (!response.ok) {
+                    throw new Error(response.statusText);
+                }
+                return response.json();
+            }).then(data => {
+                if (data.language) {
+                    window.location.reload();
+                    return;
+                }
+                document.body.classList.remove('light', 'dark');
+                document.body.classList.add(data.theme);
+                document.querySelectorAll('[data-theme]').forEach(option => {
+                    option.classList.toggle('active', option.dataset.theme === data.theme);
+                });
+                document.dispatchEvent(new CustomEvent('themechange', { detail: data }));
+            }).catch(() => {
+                window.location.href = link.href;
+            });
+        });
+    });
+    
     // FAQ Section Functionality
     const faqQuestions = document.querySelectorAll('.faq-question');
     
@@ -0,0 +1,550 @@
+"""
+DiscoBots.fr - Product catalog, stored in the database and synced from Stripe
+
+The products on sale, their prices and the vouchers visitors can redeem
+are kept in the catalog_product, catalog_price and catalog_voucher tables.
+The pricing section and checkout read them from memory, so neither asks
+Stripe anything, and a price changed in Stripe needs no redeploy.
+
+The tables are synced from Stripe in the background. Every
+STRIPE_CATALOG_SYNC_INTERVAL seconds, the first worker to claim the sync in
+catalog_state lists the products named in STRIPE_CATALOG_PRODUCTS, their
+active one-time prices and the coupons that are vouchers, and rewrites the
+tables; `flask sync-catalog` does the same on demand. Vouchers are the
+coupons registered with require_voucher(), which are created in Stripe if
+missing, and those with voucher=true in their metadata. Webhook events for
+products, prices and coupons rewrite the affected row straight away.
+
+Every change to a row bumps the version in catalog_state; a sync or event
+that finds the rows as they were leaves it alone. Each worker keeps the
+catalog in memory with the version it read, and its background thread
+reloads it when the version moves on, checking every
+STRIPE_CATALOG_POLL_INTERVAL seconds; the worker that made the change reloads
+at once. Pages showing prices put catalog.version in their cache key.
+Vouchers whose coupon has a redeem_by date stop being redeemable then, and
+the background thread deletes them.
+
+A lookup made before the worker's first load waits for it. Until the tables
+have been synced once, that load serves the plans given to fallback_plan()
+and the vouchers given to require_voucher(), so a fresh deployment shows
+its pricing at once while a background thread runs the first sync.
+
+Configuration (environment variables):
+    STRIPE_CATALOG_PRODUCTS        comma-separated Stripe product ids on sale
+                                   (default prod_S5lpY8QkDBwJhx)
+    STRIPE_CATALOG_SYNC_INTERVAL   seconds between syncs from Stripe (default 300)
+    STRIPE_CATALOG_POLL_INTERVAL   seconds between version checks (default 5)
+
+Usage:
+    stripe_catalog = StripeCatalog(app, db, webhooks=stripe_webhooks)
+    stripe_catalog.require_voucher('Uflvb62d', advertised=True, percent_off=30, duration='once')
+    stripe_catalog.fallback_plan('prod_S5lpY8QkDBwJhx', 'Standard', 599, 'usd')
+
+    line_items = stripe_catalog.line_items(product_id)  # None unless it is on sale
+    voucher = stripe_catalog.voucher(request.args.get('voucher'))  # None unless redeemable
+"""
+
+import os
+import threading
+import time
+
+import click
+import stripe
+from sqlalchemy import delete, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+try:
+    from stripe import InvalidRequestError
+except ImportError:  # stripe < 8
+    from stripe.error import InvalidRequestError
+
+# catalog_state has a single row
+STATE_ID = 1
+
+# How soon to try again after a failed sync
+RETRY_INTERVAL = 30
+
+CURRENCY_SYMBOLS = {'usd': '$', 'eur': '€', 'gbp': '£'}
+
+class SingleFlight:
+    """Concurrent calls with the same key run fn once and share its outcome."""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+def as_dict(obj):
+    """A Stripe object as a plain dict; they stopped being dicts in stripe 8."""
+    if hasattr(obj, 'to_dict_recursive'):
+        return obj.to_dict_recursive()
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    return dict(obj)
+
+def format_amount(amount, currency):
+    """599, 'usd' -> '$5.99'"""
+    value = f'{amount / 100:.2f}'
+    symbol = CURRENCY_SYMBOLS.get(currency)
+    return f'{symbol}{value}' if symbol else f'{value} {currency.upper()}'
+
+def define_models(db):
+    """The catalog tables, on the app's own db."""
+
+    class Product(db.Model):
+        __tablename__ = 'catalog_product'
+        id = db.Column(db.String(64), primary_key=True)
+        name = db.Column(db.String(255), nullable=False)
+        description = db.Column(db.Text)
+        default_price = db.Column(db.String(64))
+        # Place in STRIPE_CATALOG_PRODUCTS, which orders the pricing section
+        position = db.Column(db.Integer, nullable=False, default=0)
+
+    class Price(db.Model):
+        __tablename__ = 'catalog_price'
+        id = db.Column(db.String(64), primary_key=True)
+        product = db.Column(db.String(64), nullable=False, index=True)
+        currency = db.Column(db.String(3), nullable=False)
+        unit_amount = db.Column(db.Integer, nullable=False)
+
+    class Voucher(db.Model):
+        __tablename__ = 'catalog_voucher'
+        # The Stripe coupon id, which visitors enter as the code
+        code = db.Column(db.String(64), primary_key=True)
+        name = db.Column(db.String(255))
+        percent_off = db.Column(db.Float)
+        amount_off = db.Column(db.Integer)
+        currency = db.Column(db.String(3))
+        # Unix time after which the coupon can't be redeemed
+        redeem_by = db.Column(db.Float)
+        # Shown in the pricing section's banner
+        advertised = db.Column(db.Boolean, nullable=False, default=False)
+
+    class CatalogState(db.Model):
+        __tablename__ = 'catalog_state'
+        id = db.Column(db.Integer, primary_key=True)
+        version = db.Column(db.Integer, nullable=False, default=0)
+        synced_at = db.Column(db.Float)
+        sync_started_at = db.Column(db.Float)
+
+    return Product, Price, Voucher, CatalogState
+
+class StripeCatalog:
+    def __init__(self, app=None, db=None, webhooks=None):
+        self.required_vouchers = {}
+        self.fallback_plans = []
+        self._snapshot = None
+        self._flights = SingleFlight()
+        self._thread_pid = None
+        self._thread_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, db, webhooks)
+
+    def init_app(self, app, db, webhooks=None):
+        app.config.setdefault('STRIPE_CATALOG_PRODUCTS',
+                              os.environ.get('STRIPE_CATALOG_PRODUCTS', 'prod_S5lpY8QkDBwJhx'))
+        app.config.setdefault('STRIPE_CATALOG_SYNC_INTERVAL',
+                              float(os.environ.get('STRIPE_CATALOG_SYNC_INTERVAL', 300)))
+        app.config.setdefault('STRIPE_CATALOG_POLL_INTERVAL',
+                              float(os.environ.get('STRIPE_CATALOG_POLL_INTERVAL', 5)))
+        self.app = app
+        self.db = db
+        self.product_ids = [product_id.strip() for product_id
+                            in app.config['STRIPE_CATALOG_PRODUCTS'].split(',') if product_id.strip()]
+        self.sync_interval = app.config['STRIPE_CATALOG_SYNC_INTERVAL']
+        self.poll_interval = app.config['STRIPE_CATALOG_POLL_INTERVAL']
+        self.Product, self.Price, self.Voucher, self.CatalogState = define_models(db)
+        # Stripe object type -> its table and the row to store for an object
+        self.kinds = {
+            'product': (self.Product, self._product_row),
+            'price': (self.Price, self._price_row),
+            'coupon': (self.Voucher, self._voucher_row),
+        }
+        app.before_request(self._before_request)
+        app.cli.command('sync-catalog')(self._sync_command)
+        if webhooks is not None:
+            webhooks.subscribe(('coupon.', 'product.', 'price.'), self.apply_event)
+        app.extensions['stripe_catalog'] = self
+
+    def require_voucher(self, code, advertised=False, **params):
+        """Make code a voucher, creating its coupon with params if Stripe lacks it."""
+        self.required_vouchers[code] = (advertised, params)
+
+    def fallback_plan(self, product_id, name, unit_amount, currency='usd', description=None):
+        """A plan to show and sell until the first sync from Stripe has run."""
+        self.fallback_plans.append({'id': product_id, 'name': name, 'description': description,
+                                    'unit_amount': unit_amount, 'currency': currency})
+
+    # ==================
+    # LOOKUPS
+    # ==================
+
+    def _current(self):
+        if self._snapshot is None:
+            # Not loaded yet, so join the load rather than guess
+            self.refresh()
+        return self._snapshot
+
+    @property
+    def version(self):
+        return self._current()['version']
+
+    def product(self, product_id=None):
+        """The product on sale, or the first one when product_id is None."""
+        products = self._current()['product']
+        if product_id is None:
+            return next(iter(products.values()), None)
+        return products.get(product_id)
+
+    def price_for(self, product_id):
+        """The product's default price, else its cheapest one."""
+        snapshot = self._current()
+        product = snapshot['product'].get(product_id)
+        if product is None:
+            return None
+        prices = snapshot['price']
+        if product['default_price'] in prices:
+            return prices[product['default_price']]
+        candidates = [price for price in prices.values() if price['product'] == product_id]
+        return min(candidates, key=lambda price: price['unit_amount'], default=None)
+
+    @staticmethod
+    def _redeemable(voucher, now=None):
+        return not voucher['redeem_by'] or voucher['redeem_by'] > (now or time.time())
+
+    def voucher(self, code):
+        """The voucher, if code is one that can still be redeemed."""
+        voucher = self._current()['coupon'].get(code) if code else None
+        return voucher if voucher is not None and self._redeemable(voucher) else None
+
+    def line_items(self, product_id=None):
+        """Checkout line items for one of the product, or None if it isn't on sale."""
+        product = self.product(product_id)
+        price = self.price_for(product['id']) if product is not None else None
+        if price is None:
+            return None
+        if price['id'] is None:
+            # A fallback plan, which has no price in Stripe
+            return [{'price_data': {'currency': price['currency'], 'product': product['id'],
+                                    'unit_amount': price['unit_amount']},
+                     'quantity': 1}]
+        return [{'price': price['id'], 'quantity': 1}]
+
+    def plans(self):
+        """The products on sale that have a price, each with its price."""
+        plans = []
+        for product in self._current()['product'].values():
+            price = self.price_for(product['id'])
+            if price is not None:
+                plans.append(dict(product, price=price))
+        return plans
+
+    def pricing(self):
+        """What the pricing section shows."""
+        vouchers = self._current()['coupon'].values()
+        return {
+            'plans': self.plans(),
+            'voucher': next((voucher for voucher in vouchers
+                             if voucher['advertised'] and self._redeemable(voucher)), None),
+        }
+
+    # ==================
+    # LOADING
+    # ==================
+
+    def _before_request(self):
+        # Threads don't survive fork, so each worker starts its own
+        if self._thread_pid != os.getpid():
+            with self._thread_lock:
+                if self._thread_pid != os.getpid():
+                    threading.Thread(target=self._run, daemon=True,
+                                     name='stripe-catalog').start()
+                    self._thread_pid = os.getpid()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    state = self._state()
+                    if self._sync_due(state) and self._claim_sync():
+                        self._sync()
+                    self._prune()
+                    state = self._state()
+                if self._snapshot is None or state.version != self._snapshot['version']:
+                    self.refresh()
+            except Exception:
+                self.app.logger.exception('Syncing the product catalog failed')
+            time.sleep(self.poll_interval)
+
+    def refresh(self):
+        """Reload the catalog from the database; concurrent calls share one reload."""
+        return self._flights.do('load', self._load)
+
+    def _load(self):
+        with self.app.app_context():
+            state = self._state()
+            if state.synced_at is None:
+                # Never synced: a background thread is on it, or will be once
+                # its claim comes round; until then the tables are empty
+                self._snapshot = self._fallback(state.version)
+            else:
+                self._snapshot = self._read(state.version)
+
+    def _fallback(self, version):
+        snapshot = {'version': version, 'product': {}, 'price': {}, 'coupon': {}}
+        for plan in self.fallback_plans:
+            snapshot['product'][plan['id']] = {
+                'id': plan['id'], 'name': plan['name'], 'description': plan['description'],
+                'default_price': None,
+            }
+            # Keyed by product, as these prices have no id
+            snapshot['price'][plan['id']] = {
+                'id': None, 'product': plan['id'], 'currency': plan['currency'],
+                'unit_amount': plan['unit_amount'],
+                'display': format_amount(plan['unit_amount'], plan['currency']),
+            }
+        for code, (advertised, params) in self.required_vouchers.items():
+            row = self._voucher_row(dict(params, id=code))
+            if row is not None:
+                snapshot['coupon'][code] = self._voucher_entry(row)
+        return snapshot
+
+    @staticmethod
+    def _voucher_entry(row):
+        if row['percent_off']:
+            label = f"{row['percent_off']:g}%"
+        else:
+            label = format_amount(row['amount_off'] or 0, row['currency'] or 'usd')
+        return dict(row, label=label)
+
+    def _read(self, version):
+        session = self.db.session
+        snapshot = {'version': version, 'product': {}, 'price': {}, 'coupon': {}}
+        for product in session.scalars(select(self.Product).order_by(self.Product.position)):
+            snapshot['product'][product.id] = {
+                'id': product.id, 'name': product.name, 'description': product.description,
+                'default_price': product.default_price,
+            }
+        for price in session.scalars(select(self.Price)):
+            snapshot['price'][price.id] = {
+                'id': price.id, 'product': price.product, 'currency': price.currency,
+                'unit_amount': price.unit_amount,
+                'display': format_amount(price.unit_amount, price.currency),
+            }
+        for voucher in session.execute(select(self.Voucher.__table__)).mappings():
+            snapshot['coupon'][voucher['code']] = self._voucher_entry(dict(voucher))
+        return snapshot
+
+    def _state(self):
+        """catalog_state's version, synced_at and sync_started_at."""
+        State = self.CatalogState
+        query = select(State.version, State.synced_at, State.sync_started_at).where(State.id == STATE_ID)
+        state = self.db.session.execute(query).one_or_none()
+        if state is None:
+            try:
+                self.db.session.add(State(id=STATE_ID, version=0))
+                self.db.session.commit()
+            except IntegrityError:
+                # Another worker added it first
+                self.db.session.rollback()
+            state = self.db.session.execute(query).one()
+        return state
+
+    # ==================
+    # SYNCING
+    # ==================
+
+    def _sync_due(self, state):
+        return (state.sync_started_at is None
+                or state.sync_started_at <= time.time() - self.sync_interval)
+
+    def _claim_sync(self):
+        """Whether this worker gets to sync; one claim per STRIPE_CATALOG_SYNC_INTERVAL."""
+        now = time.time()
+        State = self.CatalogState
+        claimed = self.db.session.execute(
+            update(State)
+            .where(State.id == STATE_ID,
+                   or_(State.sync_started_at.is_(None),
+                       State.sync_started_at <= now - self.sync_interval))
+            .values(sync_started_at=now)).rowcount
+        self.db.session.commit()
+        return claimed == 1
+
+    def sync(self):
+        """Rewrite the tables from Stripe now and reload this worker's copy."""
+        with self.app.app_context():
+            self._sync()
+        self.refresh()
+
+    def _sync_command(self):
+        """Sync the product catalog from Stripe now."""
+        self.sync()
+        snapshot = self._snapshot
+        click.echo(f"Synced {len(snapshot['product'])} products, {len(snapshot['price'])} prices "
+                   f"and {len(snapshot['coupon'])} vouchers (version {snapshot['version']})")
+
+    def _sync(self):
+        try:
+            rows = self._fetch()
+        except Exception:
+            # Let the next claim come after RETRY_INTERVAL rather than a full interval
+            self.db.session.execute(
+                update(self.CatalogState).where(self.CatalogState.id == STATE_ID)
+                .values(sync_started_at=time.time() - self.sync_interval + RETRY_INTERVAL))
+            self.db.session.commit()
+            raise
+        session = self.db.session
+        # The first sync replaces the fallback plans, even if Stripe has nothing
+        changed = self._state().synced_at is None
+        for kind, (model, _) in self.kinds.items():
+            key = model.__mapper__.primary_key[0].name
+            fetched = sorted(rows[kind], key=lambda row: row[key])
+            if self._rows(model) == fetched:
+                continue
+            session.execute(delete(model))
+            if fetched:
+                session.execute(insert(model), fetched)
+            changed = True
+        if changed:
+            self._bump(synced_at=time.time())
+        else:
+            session.execute(update(self.CatalogState).where(self.CatalogState.id == STATE_ID)
+                            .values(synced_at=time.time()))
+        session.commit()
+
+    def _rows(self, model, key=None):
+        """The table's rows as dicts, by primary key, or the one with key."""
+        column = model.__mapper__.primary_key[0]
+        query = select(model.__table__).order_by(column)
+        if key is not None:
+            query = query.where(column == key)
+        return [dict(row) for row in self.db.session.execute(query).mappings()]
+
+    def _prune(self):
+        """Delete vouchers past their redeem_by date."""
+        now = time.time()
+        if self._snapshot is None or all(self._redeemable(voucher, now)
+                                         for voucher in self._snapshot['coupon'].values()):
+            return
+        Voucher = self.Voucher
+        deleted = self.db.session.execute(
+            delete(Voucher).where(Voucher.redeem_by.is_not(None), Voucher.redeem_by <= now)).rowcount
+        if deleted:
+            self._bump()
+        self.db.session.commit()
+
+    def _fetch(self):
+        coupons = {}
+        for coupon in stripe.Coupon.list(limit=100).auto_paging_iter():
+            coupons[coupon['id']] = as_dict(coupon)
+        for code, (_, params) in self.required_vouchers.items():
+            if code not in coupons:
+                coupons[code] = as_dict(self._create_coupon(code, params))
+        products = [as_dict(product) for product
+                    in stripe.Product.list(limit=100, active=True).auto_paging_iter()]
+        prices = [as_dict(price) for price
+                  in stripe.Price.list(limit=100, active=True).auto_paging_iter()]
+        objects = {'product': products, 'price': prices, 'coupon': coupons.values()}
+        return {kind: [row for row in map(to_row, objects[kind]) if row is not None]
+                for kind, (_, to_row) in self.kinds.items()}
+
+    @staticmethod
+    def _create_coupon(coupon_id, params):
+        try:
+            return stripe.Coupon.create(id=coupon_id, **params)
+        except InvalidRequestError as e:
+            # Another worker created it first
+            if getattr(e, 'code', None) != 'resource_already_exists':
+                raise
+            return stripe.Coupon.retrieve(coupon_id)
+
+    def _bump(self, **values):
+        State = self.CatalogState
+        self.db.session.execute(update(State).where(State.id == STATE_ID)
+                                .values(version=State.version + 1, **values))
+
+    # Each returns the row to store for a Stripe object, or None if it doesn't belong
+
+    def _product_row(self, obj):
+        if not obj.get('active', True) or obj['id'] not in self.product_ids:
+            return None
+        default_price = obj.get('default_price')
+        if isinstance(default_price, dict):
+            default_price = default_price['id']
+        return {'id': obj['id'], 'name': obj['name'], 'description': obj.get('description'),
+                'default_price': default_price, 'position': self.product_ids.index(obj['id'])}
+
+    def _price_row(self, obj):
+        product = obj['product']
+        if isinstance(product, dict):
+            product = product['id']
+        # Checkout runs in payment mode, which takes one-time prices only
+        if (not obj.get('active', True) or product not in self.product_ids
+                or obj.get('type', 'one_time') != 'one_time' or obj.get('unit_amount') is None):
+            return None
+        return {'id': obj['id'], 'product': product, 'currency': obj['currency'],
+                'unit_amount': obj['unit_amount']}
+
+    def _voucher_row(self, obj):
+        metadata = obj.get('metadata') or {}
+        required = self.required_vouchers.get(obj['id'])
+        if not obj.get('valid', True) or (required is None and metadata.get('voucher') != 'true'):
+            return None
+        redeem_by = obj.get('redeem_by')
+        if redeem_by and redeem_by <= time.time():
+            return None
+        advertised = (required is not None and required[0]) or metadata.get('advertised') == 'true'
+        return {'code': obj['id'], 'name': obj.get('name'), 'percent_off': obj.get('percent_off'),
+                'amount_off': obj.get('amount_off'), 'currency': obj.get('currency'),
+                'redeem_by': redeem_by, 'advertised': advertised}
+
+    # ==================
+    # WEBHOOKS
+    # ==================
+
+    def apply_event(self, obj, event_type):
+        kind, _, action = event_type.rpartition('.')
+        if kind not in self.kinds:
+            return
+        model, to_row = self.kinds[kind]
+        obj = as_dict(obj)
+        row = None if action == 'deleted' else to_row(obj)
+        # Most events touch fields the catalog doesn't keep
+        if self._rows(model, obj['id']) == ([row] if row is not None else []):
+            return
+        key = model.__mapper__.primary_key[0]
+        session = self.db.session
+        session.execute(delete(model).where(key == obj['id']))
+        if row is not None:
+            session.execute(insert(model).values(**row))
+        self._bump()
+        session.commit()
+        self.refresh()
@@ -0,0 +1,213 @@
+"""
+DiscoBots.fr - Pooled, time-bounded Stripe client
+
+The stripe library's default client waits up to 80 seconds for a response,
+so a Stripe slowdown ties up every gunicorn sync worker in checkout and takes
+the other pages down with it. StripeTransport installs a client that:
+
+- keeps a small pool of keep-alive connections per worker, so calls skip the
+  TCP and TLS handshakes
+- gives up after STRIPE_CONNECT_TIMEOUT seconds connecting and
+  STRIPE_READ_TIMEOUT seconds waiting for a response
+- retries failed calls at most STRIPE_MAX_RETRIES times, with the library's
+  jittered exponential backoff and idempotency keys
+- opens a circuit breaker after STRIPE_BREAKER_THRESHOLD consecutive
+  failures (connection errors, timeouts, 429s and 5xx responses). While it is
+  open, calls raise StripeUnavailable at once; after STRIPE_BREAKER_COOLDOWN
+  seconds one trial call is let through, and its outcome closes or reopens it.
+
+Each worker has its own breaker. When metrics.py is set up first, calls and
+breaker state show up at /metrics as stripe_requests_total,
+stripe_request_duration_seconds and stripe_circuit_open.
+
+Configuration (environment variables):
+    STRIPE_CONNECT_TIMEOUT     seconds to connect (default 2)
+    STRIPE_READ_TIMEOUT        seconds to wait for a response (default 8)
+    STRIPE_MAX_RETRIES         retries after a failed call (default 1)
+    STRIPE_POOL_SIZE           keep-alive connections per worker (default 4)
+    STRIPE_BREAKER_THRESHOLD   consecutive failures that open the breaker (default 5)
+    STRIPE_BREAKER_COOLDOWN    seconds before a trial call (default 30)
+
+Usage:
+    stripe_transport = StripeTransport(app)
+
+    try:
+        checkout_session = stripe.checkout.Session.create(...)
+    except StripeUnavailable:
+        ...  # tell the visitor to come back in a moment
+"""
+
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+
+try:
+    from stripe import APIConnectionError, RequestsClient
+except ImportError:  # stripe < 8
+    from stripe.error import APIConnectionError
+    from stripe.http_client import RequestsClient
+
+class StripeUnavailable(APIConnectionError):
+    """The circuit breaker is open, so the call wasn't made."""
+
+    def __init__(self, retry_after):
+        super().__init__('Stripe is unavailable; not calling it for now', should_retry=False)
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=5, cooldown=30.0, on_change=None):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.on_change = on_change
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        previous, self.state = self.state, state
+        if previous != state and self.on_change is not None:
+            self.on_change(previous, state)
+
+    def retry_after(self):
+        """Seconds until a trial call will be let through."""
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            # One trial call at a time once the cooldown is over
+            if self.state == self.OPEN and self.retry_after() == 0:
+                self._set_state(self.HALF_OPEN)
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+def endpoint_label(url):
+    """/v1/coupons/Uflvb62d -> /v1/coupons/{id}, to keep metric labels few."""
+    parts = urlparse(url).path.strip('/').split('/')
+    labelled = []
+    for i, part in enumerate(parts):
+        # An id follows a plural collection name, e.g. sessions/cs_...
+        if i > 1 and parts[i - 1].endswith('s') and labelled[-1] != '{id}':
+            labelled.append('{id}')
+        else:
+            labelled.append(part)
+    return '/' + '/'.join(labelled)
+
+class PooledRequestsClient(RequestsClient):
+    """stripe's requests client with a per-worker pool and a circuit breaker."""
+
+    def __init__(self, breaker, connect_timeout, read_timeout, pool_size, registry=None):
+        super().__init__(timeout=(connect_timeout, read_timeout))
+        self.breaker = breaker
+        self.pool_size = pool_size
+        self.registry = registry
+        self._pid = None
+        self._pid_lock = threading.Lock()
+
+    def _ensure_session(self):
+        # Sockets inherited across fork are shared with the parent
+        if self._pid != os.getpid():
+            with self._pid_lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    self._thread_local = threading.local()
+                    self._pid = os.getpid()
+
+    def _record(self, url, status, elapsed=None):
+        if self.registry is None:
+            return
+        endpoint = endpoint_label(url)
+        self.registry.inc('stripe_requests_total', (endpoint, status))
+        if elapsed is not None:
+            self.registry.observe('stripe_request_duration_seconds', (endpoint,), elapsed)
+
+    def request(self, method, url, headers, post_data=None, **kwargs):
+        if not self.breaker.allow():
+            self._record(url, 'rejected')
+            raise StripeUnavailable(self.breaker.retry_after())
+        failed = True
+        try:
+            self._ensure_session()
+            start = time.perf_counter()
+            try:
+                response = super().request(method, url, headers, post_data, **kwargs)
+            except Exception:
+                self._record(url, 'error', time.perf_counter() - start)
+                raise
+            status = response[1]
+            self._record(url, str(status), time.perf_counter() - start)
+            # Other 4xx responses mean Stripe is up and our request was wrong
+            failed = status == 429 or status >= 500
+            return response
+        finally:
+            # Whatever went wrong, the breaker must hear of it: a trial call
+            # that went unrecorded would leave it half open for good
+            if failed:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+class StripeTransport:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('STRIPE_CONNECT_TIMEOUT', float(os.environ.get('STRIPE_CONNECT_TIMEOUT', 2)))
+        app.config.setdefault('STRIPE_READ_TIMEOUT', float(os.environ.get('STRIPE_READ_TIMEOUT', 8)))
+        app.config.setdefault('STRIPE_MAX_RETRIES', int(os.environ.get('STRIPE_MAX_RETRIES', 1)))
+        app.config.setdefault('STRIPE_POOL_SIZE', int(os.environ.get('STRIPE_POOL_SIZE', 4)))
+        app.config.setdefault('STRIPE_BREAKER_THRESHOLD', int(os.environ.get('STRIPE_BREAKER_THRESHOLD', 5)))
+        app.config.setdefault('STRIPE_BREAKER_COOLDOWN', float(os.environ.get('STRIPE_BREAKER_COOLDOWN', 30)))
+        self.app = app
+        metrics = app.extensions.get('metrics')
+        self.registry = metrics.registry if metrics is not None else None
+        self.breaker = CircuitBreaker(app.config['STRIPE_BREAKER_THRESHOLD'],
+                                      app.config['STRIPE_BREAKER_COOLDOWN'],
+                                      on_change=self._breaker_changed)
+        self.client = PooledRequestsClient(self.breaker,
+                                           app.config['STRIPE_CONNECT_TIMEOUT'],
+                                           app.config['STRIPE_READ_TIMEOUT'],
+                                           app.config['STRIPE_POOL_SIZE'],
+                                           self.registry)
+        stripe.default_http_client = self.client
+        stripe.max_network_retries = app.config['STRIPE_MAX_RETRIES']
+        app.extensions['stripe_transport'] = self
+
+    def _breaker_changed(self, previous, state):
+        if state == CircuitBreaker.OPEN:
+            self.app.logger.warning('Stripe circuit breaker opened after %d failures; '
+                                    'failing checkout fast for %.0f s',
+                                    self.breaker.failures, self.breaker.cooldown)
+        elif state == CircuitBreaker.CLOSED:
+            self.app.logger.info('Stripe circuit breaker closed')
+        if self.registry is not None:
+            # A half-open breaker still counts as open
+            self.registry.set('stripe_circuit_open', (), int(state != CircuitBreaker.CLOSED))
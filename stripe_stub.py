@@ -0,0 +1,539 @@
+"""
+DiscoBots.fr - Local Stripe stand-in for offline checkout testing
+
+A small HTTP server implementing the part of the Stripe API the apps use:
+checkout sessions, coupons, products and prices, plus signed webhook
+delivery. Point an app at it by setting STRIPE_API_BASE, and checkout can
+be load-tested without touching Stripe.
+
+Responses can be slowed down and made to fail:
+    --latency 80                  every call takes 80 ms
+    --latency uniform:20:200      between 20 and 200 ms
+    --latency lognormal:80:0.6    median 80 ms, long tail (sigma 0.6)
+    --error-rate 0.02             2% of calls answer 500 api_error
+    --rate-limit 25               over 25 calls per second answer 429
+
+The same settings can be changed while it runs with
+POST /_stub/config {"latency": "uniform:50:500", "error_rate": 0.1}, and
+GET /_stub/stats counts the calls by endpoint and status.
+
+Each session's url is a page on the stub: visiting it completes the payment
+and redirects to success_url, and ?cancel=1 goes to cancel_url. Completing
+or expiring a session and creating or updating a coupon, product or price
+sends the matching event (checkout.session.completed, coupon.updated, ...)
+to --webhook-url, signed with --webhook-secret like Stripe signs them.
+
+The product, price and voucher the apps sell are created at startup.
+
+Usage:
+    python stripe_stub.py --port 12111 --webhook-url http://localhost:5000/stripe/webhook
+    STRIPE_API_BASE=http://localhost:12111 gunicorn app:app
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import math
+import queue
+import random
+import re
+import secrets
+import threading
+import time
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, parse_qsl, urlparse
+
+API_VERSION = '2023-10-16'
+SESSION_LIFETIME = 24 * 60 * 60
+
+# The catalog the apps expect to find
+PRODUCT_ID = 'prod_S5lpY8QkDBwJhx'
+VOUCHER_CODE = 'Uflvb62d'
+
+class StubError(Exception):
+    def __init__(self, status, message, type='invalid_request_error', code=None, param=None):
+        super().__init__(message)
+        self.status = status
+        self.body = {'error': {'type': type, 'message': message}}
+        if code:
+            self.body['error']['code'] = code
+        if param:
+            self.body['error']['param'] = param
+
+def missing(kind, object_id, param='id'):
+    return StubError(404 if param == 'id' else 400, f"No such {kind}: '{object_id}'",
+                     code='resource_missing', param=param)
+
+def new_id(prefix):
+    return f'{prefix}_{secrets.token_hex(12)}'
+
+def decode_form(body):
+    """Stripe's form encoding, a[b][0][c]=1, back into nested dicts and lists."""
+    result = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        parts = re.findall(r'[^\[\]]+|\[\]', key)
+        target = result
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+
+    def listify(value):
+        if not isinstance(value, dict):
+            return value
+        value = {key: listify(item) for key, item in value.items()}
+        if value and all(key.isdigit() for key in value):
+            return [value[key] for key in sorted(value, key=int)]
+        return value
+    return listify(result)
+
+# ==================
+# FAULT INJECTION
+# ==================
+
+class Latency:
+    """Draws delays in seconds from a spec like 80, uniform:20:200 or lognormal:80:0.6."""
+
+    def __init__(self, spec='0'):
+        self.spec = str(spec)
+        kind, _, arguments = self.spec.partition(':')
+        if not arguments:
+            kind, arguments = 'fixed', kind
+        values = [float(value) for value in arguments.split(':')]
+        if kind == 'fixed' and len(values) == 1:
+            self.draw = lambda: values[0] / 1000
+        elif kind == 'uniform' and len(values) == 2:
+            self.draw = lambda: random.uniform(*values) / 1000
+        elif kind == 'lognormal' and len(values) == 2:
+            median, sigma = values
+            self.draw = lambda: random.lognormvariate(math.log(median), sigma) / 1000 if median else 0
+        else:
+            raise ValueError(f'Bad latency spec {self.spec!r}; use MS, uniform:MIN:MAX '
+                             'or lognormal:MEDIAN:SIGMA')
+
+class Faults:
+    def __init__(self, latency='0', error_rate=0.0, rate_limit=0.0):
+        self._lock = threading.Lock()
+        self.configure(latency=latency, error_rate=error_rate, rate_limit=rate_limit)
+
+    def configure(self, latency=None, error_rate=None, rate_limit=None):
+        with self._lock:
+            if latency is not None:
+                self.latency = Latency(latency)
+            if error_rate is not None:
+                self.error_rate = float(error_rate)
+            if rate_limit is not None:
+                self.rate_limit = float(rate_limit)
+                self._tokens = self.rate_limit
+                self._updated = time.monotonic()
+
+    def settings(self):
+        return {'latency': self.latency.spec, 'error_rate': self.error_rate,
+                'rate_limit': self.rate_limit}
+
+    def apply(self):
+        """Sleep, then raise the injected failure, if any, for one call."""
+        delay = self.latency.draw()
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            if self.rate_limit:
+                now = time.monotonic()
+                self._tokens = min(self.rate_limit,
+                                   self._tokens + (now - self._updated) * self.rate_limit)
+                self._updated = now
+                if self._tokens < 1:
+                    raise StubError(429, 'Too many requests hit the API too quickly.',
+                                    code='rate_limit')
+                self._tokens -= 1
+        if self.error_rate and random.random() < self.error_rate:
+            raise StubError(500, 'An injected error occurred.', type='api_error')
+
+# ==================
+# WEBHOOKS
+# ==================
+
+def sign(payload, secret, timestamp=None):
+    """The Stripe-Signature header value for payload."""
+    timestamp = int(timestamp or time.time())
+    signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(),
+                         hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+class WebhookSender:
+    """Delivers events in order from a background thread, retrying failures."""
+
+    def __init__(self, url, secret, attempts=3):
+        self.url = url
+        self.secret = secret
+        self.attempts = attempts
+        self.delivered = Counter()
+        self._queue = queue.Queue()
+        if url:
+            threading.Thread(target=self._run, daemon=True, name='webhooks').start()
+
+    def send(self, event_type, obj):
+        if self.url:
+            self._queue.put({
+                'id': new_id('evt'), 'object': 'event', 'api_version': API_VERSION,
+                'created': int(time.time()), 'livemode': False, 'type': event_type,
+                'data': {'object': obj}, 'pending_webhooks': 1,
+            })
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            payload = json.dumps(event)
+            for attempt in range(self.attempts):
+                request = urllib.request.Request(self.url, data=payload.encode(), method='POST', headers={
+                    'Content-Type': 'application/json',
+                    'Stripe-Signature': sign(payload, self.secret),
+                })
+                try:
+                    with urllib.request.urlopen(request, timeout=10):
+                        pass
+                    self.delivered['ok'] += 1
+                    break
+                except OSError:
+                    time.sleep(2 ** attempt)
+            else:
+                self.delivered['failed'] += 1
+
+# ==================
+# OBJECTS
+# ==================
+
+class Store:
+    def __init__(self, base_url, webhooks):
+        self.base_url = base_url
+        self.webhooks = webhooks
+        self.objects = {'checkout.session': {}, 'coupon': {}, 'product': {}, 'price': {}}
+        self._lock = threading.Lock()
+
+    def get(self, kind, object_id, param='id'):
+        obj = self.objects[kind].get(object_id)
+        if obj is None:
+            raise missing(kind.split('.')[-1], object_id, param)
+        return obj
+
+    def put(self, obj, event=None):
+        with self._lock:
+            self.objects[obj['object']][obj['id']] = obj
+        if event is not None:
+            self.webhooks.send(f"{obj['object']}.{event}", obj)
+        return obj
+
+    def list(self, kind, params):
+        limit = int(params.get('limit', 10))
+        items = sorted(self.objects[kind].values(), key=lambda obj: obj['created'], reverse=True)
+        for name in ('active', 'product', 'status'):
+            if name in params:
+                value = params[name]
+                if name == 'active':
+                    value = value == 'true'
+                items = [obj for obj in items if obj.get(name) == value]
+        return {'object': 'list', 'url': f"/v1/{kind.replace('.', '/')}s",
+                'has_more': len(items) > limit, 'data': items[:limit]}
+
+    def update(self, kind, object_id, params, fields):
+        obj = dict(self.get(kind, object_id))
+        for name in fields:
+            if name in params:
+                obj[name] = params[name]
+        if 'active' in params:
+            obj['active'] = params['active'] == 'true'
+        return self.put(obj, 'updated')
+
+    # Products and prices
+
+    def create_product(self, params):
+        if 'name' not in params:
+            raise StubError(400, 'Missing required param: name.', param='name')
+        return self.put({
+            'id': params.get('id') or new_id('prod'), 'object': 'product',
+            'name': params['name'], 'description': params.get('description'),
+            'active': params.get('active', 'true') == 'true', 'metadata': params.get('metadata', {}),
+            'default_price': params.get('default_price'),
+            'created': int(time.time()), 'livemode': False,
+        }, 'created')
+
+    def create_price(self, params):
+        product = params.get('product')
+        self.get('product', product, 'product')
+        return self.put({
+            'id': params.get('id') or new_id('price'), 'object': 'price', 'product': product,
+            'currency': params.get('currency', 'usd'), 'unit_amount': int(params['unit_amount']),
+            'type': 'recurring' if 'recurring' in params else 'one_time',
+            'recurring': params.get('recurring'), 'nickname': params.get('nickname'),
+            'active': params.get('active', 'true') == 'true', 'metadata': params.get('metadata', {}),
+            'created': int(time.time()), 'livemode': False,
+        }, 'created')
+
+    # Coupons
+
+    def create_coupon(self, params):
+        coupon_id = params.get('id') or secrets.token_hex(4)
+        if coupon_id in self.objects['coupon']:
+            raise StubError(400, 'Coupon already exists.', code='resource_already_exists', param='id')
+        if 'percent_off' not in params and 'amount_off' not in params:
+            raise StubError(400, 'Must provide percent_off or amount_off.', param='percent_off')
+        return self.put({
+            'id': coupon_id, 'object': 'coupon', 'name': params.get('name'),
+            'percent_off': float(params['percent_off']) if 'percent_off' in params else None,
+            'amount_off': int(params['amount_off']) if 'amount_off' in params else None,
+            'currency': params.get('currency'), 'duration': params.get('duration', 'once'),
+            'valid': True, 'times_redeemed': 0, 'metadata': params.get('metadata', {}),
+            'created': int(time.time()), 'livemode': False,
+        }, 'created')
+
+    def delete_coupon(self, coupon_id):
+        coupon = self.get('coupon', coupon_id)
+        with self._lock:
+            self.objects['coupon'].pop(coupon_id, None)
+        self.webhooks.send('coupon.deleted', coupon)
+        return {'id': coupon_id, 'object': 'coupon', 'deleted': True}
+
+    # Checkout sessions
+
+    def _line_amount(self, item):
+        quantity = int(item.get('quantity', 1))
+        if 'price' in item:
+            price = self.get('price', item['price'], 'line_items[0][price]')
+            return price['unit_amount'] * quantity, price['currency']
+        data = item.get('price_data')
+        if not data:
+            raise StubError(400, 'You must specify either `price` or `price_data` in each line item.',
+                            param='line_items')
+        if 'product' in data:
+            self.get('product', data['product'], 'line_items[0][price_data][product]')
+        return int(data['unit_amount']) * quantity, data.get('currency', 'usd')
+
+    def create_session(self, params):
+        for name in ('success_url', 'mode'):
+            if name not in params:
+                raise StubError(400, f'Missing required param: {name}.', param=name)
+        amounts = [self._line_amount(item) for item in params.get('line_items', [])]
+        subtotal = sum(amount for amount, _ in amounts)
+        discount = 0
+        discounts = params.get('discounts') or []
+        for entry in discounts:
+            if isinstance(entry, dict) and entry.get('coupon'):
+                coupon = self.get('coupon', entry['coupon'], 'discounts[0][coupon]')
+                if coupon['percent_off']:
+                    discount += round(subtotal * coupon['percent_off'] / 100)
+                elif coupon['amount_off']:
+                    discount += coupon['amount_off']
+        session_id = new_id('cs_test')
+        now = int(time.time())
+        return self.put({
+            'id': session_id, 'object': 'checkout.session', 'mode': params['mode'],
+            'url': f'{self.base_url}/pay/{session_id}', 'status': 'open',
+            'payment_status': 'unpaid', 'success_url': params['success_url'],
+            'cancel_url': params.get('cancel_url'),
+            'client_reference_id': params.get('client_reference_id'),
+            'customer_email': params.get('customer_email'), 'metadata': params.get('metadata', {}),
+            'currency': amounts[0][1] if amounts else 'usd',
+            'amount_subtotal': subtotal, 'amount_total': max(0, subtotal - discount),
+            'discounts': [entry for entry in discounts if isinstance(entry, dict)],
+            'allow_promotion_codes': params.get('allow_promotion_codes') == 'true',
+            'created': now, 'expires_at': int(params.get('expires_at', now + SESSION_LIFETIME)),
+            'livemode': False,
+        })
+
+    def finish_session(self, session_id, status):
+        session = dict(self.get('checkout.session', session_id))
+        if session['status'] != 'open':
+            raise StubError(400, f"This Checkout Session is already {session['status']}.")
+        session['status'] = status
+        if status == 'complete':
+            session['payment_status'] = 'paid'
+        return self.put(session, 'completed' if status == 'complete' else 'expired')
+
+    def expire_stale_sessions(self):
+        now = time.time()
+        for session in list(self.objects['checkout.session'].values()):
+            if session['status'] == 'open' and session['expires_at'] <= now:
+                self.finish_session(session['id'], 'expired')
+
+    def seed(self):
+        """The product, price and voucher the apps sell."""
+        self.create_product({'id': PRODUCT_ID, 'name': 'DiscoBots Standard',
+                             'description': 'Access to all DiscoBots bots'})
+        price = self.create_price({'product': PRODUCT_ID, 'currency': 'usd', 'unit_amount': '599'})
+        self.update('product', PRODUCT_ID, {'default_price': price['id']}, ['default_price'])
+        self.create_coupon({'id': VOUCHER_CODE, 'percent_off': '30', 'duration': 'once',
+                            'name': '30% Off Special Offer'})
+
+# ==================
+# HTTP
+# ==================
+
+ROUTES = [
+    ('POST', r'/v1/checkout/sessions', lambda store, params: store.create_session(params)),
+    ('GET', r'/v1/checkout/sessions', lambda store, params: store.list('checkout.session', params)),
+    ('GET', r'/v1/checkout/sessions/(?P<id>[\w-]+)',
+     lambda store, params, id: store.get('checkout.session', id)),
+    ('POST', r'/v1/checkout/sessions/(?P<id>[\w-]+)/expire',
+     lambda store, params, id: store.finish_session(id, 'expired')),
+    ('POST', r'/v1/coupons', lambda store, params: store.create_coupon(params)),
+    ('GET', r'/v1/coupons', lambda store, params: store.list('coupon', params)),
+    ('GET', r'/v1/coupons/(?P<id>[\w-]+)', lambda store, params, id: store.get('coupon', id)),
+    ('POST', r'/v1/coupons/(?P<id>[\w-]+)',
+     lambda store, params, id: store.update('coupon', id, params, ['name', 'metadata'])),
+    ('DELETE', r'/v1/coupons/(?P<id>[\w-]+)', lambda store, params, id: store.delete_coupon(id)),
+    ('POST', r'/v1/products', lambda store, params: store.create_product(params)),
+    ('GET', r'/v1/products', lambda store, params: store.list('product', params)),
+    ('GET', r'/v1/products/(?P<id>[\w-]+)', lambda store, params, id: store.get('product', id)),
+    ('POST', r'/v1/products/(?P<id>[\w-]+)',
+     lambda store, params, id: store.update('product', id, params,
+                                            ['name', 'description', 'metadata', 'default_price'])),
+    ('POST', r'/v1/prices', lambda store, params: store.create_price(params)),
+    ('GET', r'/v1/prices', lambda store, params: store.list('price', params)),
+    ('GET', r'/v1/prices/(?P<id>[\w-]+)', lambda store, params, id: store.get('price', id)),
+    ('POST', r'/v1/prices/(?P<id>[\w-]+)',
+     lambda store, params, id: store.update('price', id, params, ['nickname', 'metadata'])),
+]
+def route_label(method, pattern):
+    """A label like "GET /v1/coupons/{id}" for the stats."""
+    return method + ' ' + re.sub(r'\(\?P<(\w+)>[^)]*\)', r'{\1}', pattern)
+
+ROUTES = [(method, re.compile(pattern + '$'), view, route_label(method, pattern))
+          for method, pattern, view in ROUTES]
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so clients can reuse connections as they do with Stripe
+    protocol_version = 'HTTP/1.1'
+    server_version = 'stripe-stub'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, body, headers=()):
+        data = json.dumps(body).encode() if not isinstance(body, bytes) else body
+        self.send_response(status)
+        content_type = 'application/json' if not isinstance(body, bytes) else 'text/html'
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Request-Id', new_id('req'))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode() if length else ''
+
+    def _handle(self):
+        url = urlparse(self.path)
+        body = self._body()
+        server = self.server
+        endpoint = 'unmatched'
+        status = 500
+        try:
+            if url.path.startswith('/_stub/'):
+                endpoint = url.path
+                status, result = self._control(url.path, body)
+                self._send(status, result)
+                return
+            if url.path.startswith('/pay/'):
+                endpoint = '/pay'
+                status = self._pay(url)
+                return
+
+            for method, pattern, view, label in ROUTES:
+                match = pattern.match(url.path)
+                if match and method == self.command:
+                    endpoint = label
+                    break
+            else:
+                raise StubError(404, f'Unrecognized request URL ({self.command}: {url.path}).')
+            if not self.headers.get('Authorization', '').startswith('Bearer sk_'):
+                raise StubError(401, 'You did not provide a valid API key.',
+                                code='api_key_required')
+            server.faults.apply()
+            params = decode_form(body if self.command == 'POST' else url.query)
+            server.store.expire_stale_sessions()
+            status, result = 200, view(server.store, params, **match.groupdict())
+            self._send(status, result)
+        except StubError as e:
+            status = e.status
+            headers = [('Retry-After', '1')] if status == 429 else []
+            self._send(status, e.body, headers)
+        finally:
+            with server.stats_lock:
+                server.stats[f'{endpoint} {status}'] += 1
+
+    def _control(self, path, body):
+        server = self.server
+        if path == '/_stub/config' and self.command == 'POST':
+            try:
+                server.faults.configure(**json.loads(body or '{}'))
+            except (TypeError, ValueError) as e:
+                return 400, {'error': {'type': 'invalid_request_error', 'message': str(e)}}
+            return 200, server.faults.settings()
+        if path == '/_stub/config':
+            return 200, server.faults.settings()
+        if path == '/_stub/stats':
+            with server.stats_lock:
+                calls = dict(server.stats)
+            return 200, {'calls': calls, 'webhooks': dict(server.store.webhooks.delivered)}
+        return 404, {'error': {'type': 'invalid_request_error', 'message': 'Unknown stub path'}}
+
+    def _pay(self, url):
+        session_id = url.path.rsplit('/', 1)[-1]
+        cancel = parse_qs(url.query).get('cancel') == ['1']
+        session = self.server.store.get('checkout.session', session_id)
+        if cancel:
+            location = session['cancel_url']
+        else:
+            if session['status'] == 'open':
+                self.server.store.finish_session(session_id, 'complete')
+            location = session['success_url'].replace('{CHECKOUT_SESSION_ID}', session_id)
+        self._send(303, b'', [('Location', location)])
+        return 303
+
+    do_GET = do_POST = do_DELETE = _handle
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, faults, webhooks, verbose=False, seed=True):
+        super().__init__(address, StubHandler)
+        host, port = self.server_address[:2]
+        self.base_url = f'http://{host}:{port}'
+        self.faults = faults
+        self.store = Store(self.base_url, webhooks)
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+        self.verbose = verbose
+        if seed:
+            self.store.seed()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local Stripe stand-in.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12111)
+    parser.add_argument('--latency', default='0', help='MS, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls answering 500')
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help='calls per second before answering 429 (0: unlimited)')
+    parser.add_argument('--webhook-url', help='where to POST events')
+    parser.add_argument('--webhook-secret', default='whsec_stub')
+    parser.add_argument('--no-seed', action='store_true', help='start with an empty catalog')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    server = StubServer((args.host, args.port),
+                        Faults(args.latency, args.error_rate, args.rate_limit),
+                        WebhookSender(args.webhook_url, args.webhook_secret),
+                        verbose=args.verbose, seed=not args.no_seed)
+    print(f'Stripe stand-in listening on {server.base_url}')
+    print(f'export STRIPE_API_BASE={server.base_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,63 @@
+"""
+DiscoBots.fr - Stripe webhook endpoint
+
+Receives Stripe events at POST /stripe/webhook, checks their signature
+against STRIPE_WEBHOOK_SECRET and hands each one to the handlers subscribed
+to its type. Without a secret the endpoint isn't registered, since unsigned
+events can't be trusted.
+
+Handlers get the event's data.object and the event type, run in the
+request, and should be quick; an exception makes Stripe retry the event
+later.
+
+Configuration (environment variables):
+    STRIPE_WEBHOOK_SECRET   the endpoint's signing secret (whsec_...)
+
+Usage:
+    stripe_webhooks = StripeWebhooks(app)
+    stripe_webhooks.subscribe('checkout.session.', handle_session)
+"""
+
+import os
+
+import stripe
+from flask import jsonify, request
+
+try:
+    from stripe import SignatureVerificationError
+except ImportError:  # stripe < 8
+    from stripe.error import SignatureVerificationError
+
+class StripeWebhooks:
+    def __init__(self, app=None):
+        self._handlers = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('STRIPE_WEBHOOK_SECRET', os.environ.get('STRIPE_WEBHOOK_SECRET'))
+        self.app = app
+        self.secret = app.config['STRIPE_WEBHOOK_SECRET']
+        app.extensions['stripe_webhooks'] = self
+        if self.secret:
+            app.add_url_rule('/stripe/webhook', 'stripe_webhook', self.view, methods=['POST'])
+
+    def subscribe(self, prefixes, handler):
+        """Call handler(obj, event_type) for events whose type starts with a prefix."""
+        if isinstance(prefixes, str):
+            prefixes = (prefixes,)
+        self._handlers.append((tuple(prefixes), handler))
+
+    def dispatch(self, event_type, obj):
+        for prefixes, handler in self._handlers:
+            if event_type.startswith(prefixes):
+                handler(obj, event_type)
+
+    def view(self):
+        try:
+            event = stripe.Webhook.construct_event(
+                request.get_data(), request.headers.get('Stripe-Signature', ''), self.secret)
+        except (ValueError, SignatureVerificationError):
+            return jsonify({'message': 'Invalid payload or signature'}), 400
+        self.dispatch(event['type'], event['data']['object'])
+        return jsonify({'received': True})
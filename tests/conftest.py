@@ -0,0 +1,14 @@
+import os
+import tempfile
+import uuid
+
+# The apps configure themselves from the environment when imported, so this
+# runs before any test module imports them
+_directory = tempfile.mkdtemp(prefix='discobots-tests-')
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{_directory}/test.db')
+os.environ.setdefault('SHARED_CACHE_NAME', f'discobots-tests-{uuid.uuid4().hex[:8]}')
+os.environ.setdefault('METRICS_DIR', os.path.join(_directory, 'metrics'))
+os.environ.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:1000')
+os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test_tests')
+# Nothing listens here, so a stray Stripe call fails fast instead of going out
+os.environ.setdefault('STRIPE_API_BASE', 'http://127.0.0.1:9')
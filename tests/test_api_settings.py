@@ -0,0 +1,56 @@
+import uuid
+
+import pytest
+
+import discobots_api as api
+
+
+@pytest.fixture
+def client():
+    return api.app.test_client()
+
+
+def register(client, **extra):
+    name = uuid.uuid4().hex[:12]
+    return client.post('/api/register', json={
+        'username': name, 'email': f'{name}@example.com', 'password': 'password1', **extra})
+
+
+def test_register_rejects_unknown_settings(client):
+    response = register(client, theme='neon')
+    assert response.status_code == 400
+    assert 'theme' in response.get_json()['message']
+
+
+def test_register_keeps_valid_settings(client):
+    response = register(client, theme='dark', language='fr')
+    assert response.status_code == 201
+    assert response.get_json()['user']['theme'] == 'dark'
+
+
+def test_unchanged_settings_do_not_echo_the_token(client):
+    token = register(client, theme='dark').get_json()['token']
+    response = client.put('/api/settings', json={'theme': 'dark'},
+                          headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+    assert response.get_json()['message'] == 'Settings unchanged'
+    assert 'token' not in response.get_json()
+
+
+def test_change_saved_through_another_host_is_seen_once_the_entry_expires(client):
+    body = register(client, theme='dark').get_json()
+    user_id, token = body['user']['id'], body['token']
+    assert api.shared_cache.get(api.user_version_key(user_id)) is not None
+    # Another host saved light; this host's entry still has the old version
+    with api.app.app_context():
+        user = api.db.session.get(api.User, user_id)
+        user.theme = 'light'
+        user.version = user.version + 1
+        api.db.session.commit()
+    # Entries expire after USER_VERSION_TTL
+    assert api.USER_VERSION_TTL <= 60
+    api.shared_cache.delete(api.user_version_key(user_id))
+    response = client.put('/api/settings', json={'theme': 'dark'},
+                          headers={'Authorization': f'Bearer {token}'})
+    assert response.get_json()['message'] == 'Settings updated successfully'
+    assert response.get_json()['user']['theme'] == 'dark'
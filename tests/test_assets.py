@@ -0,0 +1,30 @@
+import pytest
+
+from assets import Image, build, build_frontend, minify_css
+
+
+def test_minify_css_keeps_descendant_pseudo_class_selectors():
+    assert minify_css('.a :hover { color: red; }') == '.a :hover{color:red}'
+
+
+def test_minify_css_strips_declaration_whitespace():
+    source = '/* theme */\n.nav > a,\n.nav > b {\n    margin: 0 auto;\n    color: #fff;\n}\n'
+    assert minify_css(source) == '.nav>a,.nav>b{margin:0 auto;color:#fff}'
+
+
+@pytest.mark.skipif(Image is None, reason='Pillow builds the image variants')
+def test_frontend_images_keep_their_loading_attribute(tmp_path):
+    static_dir, frontend_dir = tmp_path / 'static', tmp_path / 'frontend'
+    (static_dir / 'img').mkdir(parents=True)
+    frontend_dir.mkdir()
+    Image.new('RGB', (120, 40), 'purple').save(static_dir / 'img' / 'logo.png')
+    (frontend_dir / 'index.html').write_text(
+        '<header><img src="/img/logo.png" alt="Logo" height="40"></header>'
+        '<footer><img src="/img/logo.png" alt="Logo" height="30" loading="lazy"></footer>')
+
+    build_frontend(build(str(static_dir)), str(frontend_dir), str(static_dir))
+
+    header, footer = (frontend_dir / 'index.html').read_text().split('<footer>')
+    # The header logo is above the fold, so it must not wait for layout
+    assert '<picture>' in header and 'loading=' not in header
+    assert 'loading="lazy"' in footer
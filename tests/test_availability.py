@@ -0,0 +1,36 @@
+from unittest import mock
+
+from availability import BloomFilter, RateLimiter
+
+
+def test_bloom_filter_holds_what_was_added():
+    bloom = BloomFilter(100)
+    for i in range(100):
+        bloom.add(f'user{i}')
+    assert all(f'user{i}' in bloom for i in range(100))
+    assert sum(f'other{i}' in bloom for i in range(1000)) < 50
+
+
+def test_bloom_filter_reuses_published_bits():
+    bloom = BloomFilter(100)
+    bloom.add('jti')
+    copy = BloomFilter(100, bits=bytes(bloom.bits))
+    assert 'jti' in copy
+    assert copy.size == bloom.size and copy.hashes == bloom.hashes
+
+
+def test_rate_limiter_allows_a_burst_then_the_rate():
+    limiter = RateLimiter(rate=2, burst=3)
+    with mock.patch('availability.time.monotonic', return_value=100.0) as clock:
+        assert [limiter.allow('a') for _ in range(4)] == [True, True, True, False]
+        assert limiter.allow('b')
+        clock.return_value = 100.5
+        assert limiter.allow('a')
+        assert not limiter.allow('a')
+
+
+def test_rate_limiter_forgets_the_oldest_clients():
+    limiter = RateLimiter(rate=1, burst=1, max_clients=2)
+    for client in ('a', 'b', 'c'):
+        limiter.allow(client)
+    assert list(limiter._buckets) == ['b', 'c']
@@ -0,0 +1,103 @@
+import itertools
+import time
+
+import pytest
+from flask import Flask
+
+import discobots_all_in_one as aio
+from checkout_sessions import CheckoutSessions
+from page_cache import MemoryStore
+from shared_cache import SharedCache
+from stripe_webhooks import StripeWebhooks
+
+
+class RecordingStore(MemoryStore):
+    def __init__(self):
+        super().__init__()
+        self.ttls = {}
+
+    def set(self, key, value, ttl):
+        self.ttls[key] = ttl
+        super().set(key, value, ttl)
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.secret_key = 'tests'
+    return app
+
+
+@pytest.fixture
+def webhooks(app):
+    return StripeWebhooks(app)
+
+
+@pytest.fixture
+def sessions(app, webhooks):
+    return CheckoutSessions(app, store=RecordingStore(), webhooks=webhooks)
+
+
+counter = itertools.count()
+
+
+def create(expires_in=24 * 60 * 60):
+    session_id = f'cs_test_{next(counter)}'
+    return {'id': session_id, 'url': f'https://checkout.stripe.com/c/pay/{session_id}',
+            'expires_at': time.time() + expires_in}
+
+
+def test_open_session_is_handed_out_again(sessions):
+    parts = ('user:1', 'price_1', None)
+    url = sessions.get_or_create(parts, create)
+    assert sessions.get_or_create(parts, create) == url
+
+
+def test_visitors_never_share_a_session(app, sessions):
+    with app.test_request_context():
+        first_anonymous = sessions.owner()
+    with app.test_request_context():
+        second_anonymous = sessions.owner()
+    owners = {sessions.owner(1), sessions.owner(2), first_anonymous, second_anonymous}
+    assert len(owners) == 4
+    urls = {sessions.get_or_create((owner, 'price_1', None), create) for owner in owners}
+    assert len(urls) == 4
+
+
+def test_anonymous_owner_lasts_for_the_visitor_session(app, sessions):
+    with app.test_request_context():
+        assert sessions.owner() == sessions.owner()
+
+
+def test_entry_expires_before_stripe_expires_the_session(app, sessions):
+    sessions.get_or_create(('user:1', 'price_1', None), lambda: create(expires_in=300))
+    ttl = max(sessions.store.ttls.values())
+    # A minute before Stripe's expiry, and well below CHECKOUT_SESSION_REUSE_TTL
+    assert 230 < ttl <= 240 < sessions.ttl
+
+
+def test_session_about_to_expire_is_not_reused(sessions):
+    parts = ('user:1', 'price_1', None)
+    url = sessions.get_or_create(parts, lambda: create(expires_in=30))
+    assert sessions.get_or_create(parts, create) != url
+
+
+def test_webhook_event_stops_reuse(sessions, webhooks):
+    parts = ('user:1', 'price_1', None)
+    url = sessions.get_or_create(parts, create)
+    session_id = url.rsplit('/', 1)[1]
+    webhooks.dispatch('checkout.session.completed', {'id': session_id})
+    assert sessions.get_or_create(parts, create) != url
+
+
+def test_webhook_on_one_worker_stops_reuse_on_all(app, tmp_path):
+    store = SharedCache(path=str(tmp_path / 'test.cache'), slots=16, slot_size=1024, ways=4)
+    receiving, other = (CheckoutSessions(app, store=store) for _ in range(2))
+    parts = ('user:1', 'price_1', None)
+    url = other.get_or_create(parts, create)
+    receiving.invalidate({'id': url.rsplit('/', 1)[1]}, 'checkout.session.completed')
+    assert other.get_or_create(parts, create) != url
+
+
+def test_all_in_one_app_shares_sessions_between_workers():
+    assert aio.checkout_sessions.store is aio.shared_cache
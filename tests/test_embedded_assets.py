@@ -0,0 +1,31 @@
+import pytest
+
+import discobots_all_in_one as aio
+
+
+@pytest.fixture
+def client():
+    return aio.app.test_client()
+
+
+def get(client, encoding, etag=None):
+    headers = {'Accept-Encoding': encoding}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    return client.get(f"/assets/{aio.EMBEDDED_ASSETS['styles.css'].filename}", headers=headers)
+
+
+def test_each_encoding_has_its_own_etag(client):
+    gzipped = get(client, 'gzip')
+    identity = get(client, 'identity')
+    assert gzipped.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Encoding' not in identity.headers
+    assert gzipped.headers['ETag'] != identity.headers['ETag']
+
+
+def test_etag_revalidates_only_the_same_encoding(client):
+    etag = get(client, 'gzip').headers['ETag']
+    assert get(client, 'gzip', etag).status_code == 304
+    response = get(client, 'identity', etag)
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
@@ -0,0 +1,80 @@
+from types import SimpleNamespace
+
+import pytest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import DeclarativeBase
+
+from integrity import conflicting_field
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+db = SQLAlchemy(model_class=Base)
+
+
+class User(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(64), unique=True, nullable=False)
+    email = db.Column(db.String(120), unique=True, nullable=False)
+
+    __table_args__ = (db.Index('uq_user_email_lower', func.lower(email), unique=True),)
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(username='taken', email='taken@example.com'))
+        db.session.commit()
+        yield app
+
+
+def insert(username, email):
+    db.session.add(User(username=username, email=email))
+    with pytest.raises(IntegrityError) as excinfo:
+        db.session.commit()
+    db.session.rollback()
+    return excinfo.value
+
+
+def test_taken_username_on_sqlite(app):
+    assert conflicting_field(insert('taken', 'other@example.com')) == 'username'
+
+
+def test_taken_email_in_other_case_on_sqlite(app):
+    assert conflicting_field(insert('other', 'TAKEN@example.com')) == 'email'
+
+
+def postgres_error(constraint_name, message):
+    orig = Exception(message)
+    orig.diag = SimpleNamespace(constraint_name=constraint_name)
+    return IntegrityError('INSERT INTO "user" ...', {}, orig)
+
+
+def test_postgres_username_mentioning_email():
+    # The DETAIL line repeats the value, which here contains "email"
+    error = postgres_error('user_username_key',
+                           'duplicate key value violates unique constraint "user_username_key"\n'
+                           'DETAIL:  Key (username)=(my-email) already exists.')
+    assert conflicting_field(error) == 'username'
+
+
+def test_postgres_email_index():
+    error = postgres_error('uq_user_email_lower',
+                           'duplicate key value violates unique constraint "uq_user_email_lower"\n'
+                           'DETAIL:  Key (lower(email::text))=(username@example.com) already exists.')
+    assert conflicting_field(error) == 'email'
+
+
+def test_other_integrity_errors():
+    assert conflicting_field(postgres_error('user_pkey', 'duplicate key')) is None
+    orig = Exception('NOT NULL constraint failed: user.username')
+    assert conflicting_field(IntegrityError('INSERT', {}, orig)) is None
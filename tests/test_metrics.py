@@ -0,0 +1,48 @@
+import pytest
+from flask import Flask, render_template_string
+
+from metrics import Metrics
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setenv('METRICS_DIR', str(tmp_path))
+    app = Flask(__name__)
+    return app
+
+
+def test_metrics_are_hidden_without_a_token_outside_debug(app):
+    Metrics(app)
+    assert app.test_client().get('/metrics').status_code == 404
+
+
+def test_metrics_are_served_in_debug_mode(app):
+    Metrics(app)
+    app.debug = True
+    assert app.test_client().get('/metrics').status_code == 200
+
+
+def test_metrics_token(app):
+    app.config['METRICS_TOKEN'] = 'secret'
+    Metrics(app)
+    client = app.test_client()
+    assert client.get('/metrics').status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+
+
+def test_failed_render_does_not_leak_its_start_time(app):
+    metrics = Metrics(app)
+
+    @app.route('/broken')
+    def broken():
+        try:
+            render_template_string('{{ 1 // 0 }}')
+        except ZeroDivisionError:
+            pass
+        return 'ok'
+
+    client = app.test_client()
+    client.get('/broken')
+    client.get('/broken')
+    assert metrics._local.templates == []
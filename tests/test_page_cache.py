@@ -0,0 +1,81 @@
+import pytest
+from flask import Flask, flash, g, session
+
+from page_cache import PageCache
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.secret_key = 'tests'
+    app.config['TESTING'] = True
+    app.renders = 0
+
+    @app.before_request
+    def preferences():
+        g.theme = session.get('theme', 'light')
+        g.language = session.get('language', 'en')
+
+    app.page_cache = PageCache(app)
+
+    @app.route('/')
+    @app.page_cache.cached
+    def index():
+        app.renders += 1
+        return f'{g.theme} {g.language} {session.get("_user_id")} {app.renders}'
+
+    @app.route('/flashing')
+    @app.page_cache.cached
+    def flashing():
+        app.renders += 1
+        flash('Saved')
+        return 'flashing'
+
+    return app
+
+
+def test_anonymous_pages_are_rendered_once(app):
+    client = app.test_client()
+    first = client.get('/')
+    assert client.get('/').get_data() == first.get_data()
+    assert app.renders == 1
+    assert client.get('/', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+
+
+def test_signed_in_pages_are_never_stored(app):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = '1'
+    assert client.get('/').get_data(as_text=True) == 'light en 1 1'
+    assert client.get('/').get_data(as_text=True) == 'light en 1 2'
+    # A later anonymous visitor gets a page of their own
+    assert app.test_client().get('/').get_data(as_text=True) == 'light en None 3'
+
+
+def test_pages_with_pending_flashes_are_not_stored(app):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_flashes'] = [('message', 'Welcome back')]
+    client.get('/')
+    assert app.renders == 1
+    app.test_client().get('/')
+    assert app.renders == 2
+
+
+def test_pages_that_write_the_session_are_not_stored(app):
+    client = app.test_client()
+    client.get('/flashing')
+    app.test_client().get('/flashing')
+    assert app.renders == 2
+
+
+def test_theme_and_language_variants_are_cached_separately(app):
+    pages = set()
+    for theme, language in (('light', 'en'), ('dark', 'en'), ('light', 'fr')):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['theme'], session['language'] = theme, language
+        pages.add(client.get('/').get_data(as_text=True))
+        assert client.get('/').get_data(as_text=True).startswith(f'{theme} {language} ')
+    assert app.renders == 3
+    assert len(pages) == 3
@@ -0,0 +1,22 @@
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import passwords
+
+
+class BrokenPool:
+    def submit(self, fn, *args, **kwargs):
+        raise BrokenProcessPool('a pool process died')
+
+
+def test_failed_submit_releases_its_slot(monkeypatch):
+    monkeypatch.setattr(passwords, '_get_executor', lambda: BrokenPool())
+    for _ in range(passwords.MAX_PENDING + 2):
+        with pytest.raises(BrokenProcessPool):
+            passwords.hash_password('secret')
+
+
+def test_needs_rehash():
+    assert not passwords.needs_rehash(passwords.HASH_METHOD + '$salt$hash')
+    assert passwords.needs_rehash('pbkdf2:sha256:600000$salt$hash')
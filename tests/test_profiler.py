@@ -0,0 +1,32 @@
+import os
+
+import pytest
+from flask import Flask
+
+from profiler import RequestProfiler
+
+
+def profiler(tmp_path, keep):
+    app = Flask(__name__)
+    app.config.update(PROFILER_TOKEN='secret', PROFILE_DIR=str(tmp_path), PROFILE_KEEP=keep)
+    profiler = RequestProfiler(app)
+    for i in range(3):
+        path = tmp_path / f'{i}.collapsed.txt'
+        path.write_text('')
+        os.utime(path, (i, i))
+    return profiler
+
+
+def test_prune_keeps_the_newest(tmp_path):
+    profiler(tmp_path, keep=2)._prune()
+    assert sorted(os.listdir(tmp_path)) == ['1.collapsed.txt', '2.collapsed.txt']
+
+
+def test_keep_zero_keeps_every_profile(tmp_path):
+    profiler(tmp_path, keep=0)._prune()
+    assert len(os.listdir(tmp_path)) == 3
+
+
+def test_negative_keep_is_refused(tmp_path):
+    with pytest.raises(ValueError):
+        profiler(tmp_path, keep=-1)
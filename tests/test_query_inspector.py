@@ -0,0 +1,63 @@
+import pytest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
+from sqlalchemy.orm import DeclarativeBase
+
+from query_inspector import QueryBudgetExceeded, QueryInspector, fingerprint, parameter_shape
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+def make_app(mode, queries):
+    app = Flask(__name__)
+    app.config.update(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite://', QUERY_INSPECTOR=mode,
+                      QUERY_BUDGET=5)
+    db = SQLAlchemy(model_class=Base)
+    db.init_app(app)
+    app.inspector = QueryInspector(app, db)
+
+    @app.route('/users')
+    def users():
+        for user_id in range(queries):
+            db.session.execute(text('SELECT :id'), {'id': user_id})
+        return 'ok'
+
+    return app
+
+
+def test_fingerprint_normalises_literals_in_lists_and_whitespace():
+    assert (fingerprint("SELECT *\n  FROM user WHERE id = 42 AND name = 'o''brien'")
+            == 'SELECT * FROM user WHERE id = ? AND name = ?')
+    assert (fingerprint('SELECT * FROM user WHERE id IN (?, ?, ?)')
+            == fingerprint('SELECT * FROM user WHERE id IN (?)')
+            == 'SELECT * FROM user WHERE id IN (?...)')
+
+
+def test_parameter_shape_describes_types_never_values():
+    assert parameter_shape({'id': 7, 'email': 'secret@example.com'}) == '{id: int, email: str}'
+    assert parameter_shape((7, 'secret')) == '(int, str)'
+    assert parameter_shape([(1,), (2,)], executemany=True) == '2 x (int)'
+
+
+def test_repeated_statement_is_reported():
+    app = make_app('log', queries=4)
+    app.test_client().get('/users')
+    [row] = app.inspector.report()
+    assert row['endpoint'] == 'users'
+    assert row['max_queries'] == 4
+    assert row['repeated'] == {'SELECT ?': 1}
+
+
+def test_strict_mode_counts_queries_in_a_header():
+    app = make_app('strict', queries=1)
+    response = app.test_client().get('/users')
+    assert response.headers['X-Query-Count'] == '1'
+
+
+def test_strict_mode_raises_on_repeated_statements():
+    app = make_app('strict', queries=3)
+    with pytest.raises(QueryBudgetExceeded):
+        app.test_client().get('/users')
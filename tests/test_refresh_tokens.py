@@ -0,0 +1,58 @@
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import discobots_api as api
+from discobots_api import RefreshToken, db, hash_refresh_token, revocations
+
+
+@pytest.fixture
+def client():
+    return api.app.test_client()
+
+
+def register(client):
+    name = uuid.uuid4().hex[:12]
+    return client.post('/api/register', json={
+        'username': name, 'email': f'{name}@example.com', 'password': 'password1'}).get_json()
+
+
+def refresh(client, token):
+    return client.post('/api/token/refresh', json={'refresh_token': token})
+
+
+def stored(token):
+    return db.session.execute(
+        db.select(RefreshToken).filter_by(token_hash=hash_refresh_token(token))).scalar_one_or_none()
+
+
+def test_refresh_rotates_the_token(client):
+    first = register(client)['refresh_token']
+    response = refresh(client, first)
+    assert response.status_code == 200
+    second = response.get_json()['refresh_token']
+    assert second != first
+    assert refresh(client, second).status_code == 200
+
+
+def test_replayed_token_revokes_the_family(client):
+    first = register(client)['refresh_token']
+    second = refresh(client, first).get_json()['refresh_token']
+    response = refresh(client, first)
+    assert response.status_code == 401
+    assert response.get_json()['message'] == 'Refresh token reused'
+    # The token the thief or the user got from the first refresh is dead too
+    assert refresh(client, second).status_code == 401
+
+
+def test_rebuild_deletes_expired_refresh_tokens(client):
+    expired = register(client)['refresh_token']
+    current = register(client)['refresh_token']
+    with api.app.app_context():
+        stored(expired).expires_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        revocations.rebuild()
+        assert stored(expired) is None
+        assert stored(current) is not None
+    assert refresh(client, expired).status_code == 401
@@ -0,0 +1,98 @@
+import calendar
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import discobots_api as api
+from discobots_api import RevokedToken, User, db, revocations
+
+
+@pytest.fixture
+def user():
+    with api.app.app_context():
+        user = User(username='revoked', email='revoked@example.com', password_hash='x')
+        db.session.add(user)
+        db.session.commit()
+        yield user
+        db.session.rollback()
+        db.session.execute(db.delete(RevokedToken).where(RevokedToken.user_id == user.id))
+        db.session.delete(user)
+        db.session.commit()
+
+
+def revoke_all(user, revoked_at):
+    db.session.add(RevokedToken(jti=revocations.user_key(user.id), user_id=user.id,
+                                revoked_at=revoked_at,
+                                expires_at=datetime.utcnow() + timedelta(hours=1)))
+    db.session.commit()
+    revocations.rebuild()
+
+
+def payload(user, issued_at):
+    return {'sub': str(user.id), 'jti': 'a' * 32, 'iat': calendar.timegm(issued_at.timetuple())}
+
+
+def test_tokens_issued_before_revoke_all_are_revoked(user):
+    revoked_at = datetime(2026, 1, 1, 12, 0, 0, 300000)
+    revoke_all(user, revoked_at)
+    assert revocations.is_revoked(payload(user, revoked_at - timedelta(seconds=1)))
+
+
+def test_token_issued_in_the_same_second_after_revoke_all_is_valid(user):
+    revoked_at = datetime(2026, 1, 1, 12, 0, 0, 300000)
+    revoke_all(user, revoked_at)
+    # iat has whole seconds: 12:00:00.7 arrives as 12:00:00
+    assert not revocations.is_revoked(payload(user, revoked_at + timedelta(seconds=0.4)))
+
+
+def test_rebuild_leaves_the_request_session_alone(user):
+    db.session.add(User(username='uncommitted', email='uncommitted@example.com'))
+    revocations.rebuild()
+    db.session.rollback()
+    assert db.session.execute(
+        db.select(User).filter_by(username='uncommitted')).first() is None
+
+
+def test_concurrent_revocations_all_reach_the_published_filter(user, monkeypatch):
+    publish = api.shared_cache.set
+
+    def slow_publish(key, value, ttl=300):
+        # Widens the gap between reading the table and publishing the filter
+        if key == api.RevocationList.FILTER_KEY:
+            time.sleep(random.uniform(0, 0.05))
+        return publish(key, value, ttl)
+
+    monkeypatch.setattr(api.shared_cache, 'set', slow_publish)
+    user_id, expires_at = user.id, datetime.utcnow() + timedelta(hours=1)
+
+    def revoke(worker, jti):
+        with api.app.app_context():
+            worker.revoke(jti, user_id, expires_at)
+
+    jtis = [f'race-{i}' for i in range(8)]
+    threads = [threading.Thread(target=revoke, args=(api.RevocationList(), jti)) for jti in jtis]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    reader = api.RevocationList()
+    reader.refresh()
+    assert all(jti in reader.filter for jti in jtis)
+
+
+def test_recent_revocations_are_seen_before_the_filter_has_them(user):
+    worker = api.RevocationList()
+    worker.refresh()
+    # Revoked through another host, whose filter this host doesn't get
+    db.session.add(RevokedToken(jti='b' * 32, user_id=user.id,
+                                revoked_at=datetime.utcnow().replace(microsecond=0),
+                                expires_at=datetime.utcnow() + timedelta(hours=1)))
+    db.session.commit()
+    assert 'b' * 32 not in worker.filter
+    worker._next_poll = 0
+    issued_at = datetime.utcnow() - timedelta(minutes=1)
+    assert worker.is_revoked(dict(payload(user, issued_at), jti='b' * 32))
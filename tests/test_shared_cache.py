@@ -0,0 +1,79 @@
+import os
+import time
+
+import pytest
+
+from shared_cache import SharedCache
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'test.cache')
+
+
+def test_set_get_delete(path):
+    cache = SharedCache(path=path, slots=16, slot_size=1024, ways=4)
+    assert cache.set('key', {'a': 1})
+    assert cache.get('key') == {'a': 1}
+    cache.delete('key')
+    assert cache.get('key') is None
+
+
+def test_values_larger_than_a_slot_are_not_cached(path):
+    cache = SharedCache(path=path, slots=16, slot_size=1024, ways=4)
+    assert not cache.set('key', 'x' * 2048)
+    assert cache.get('key') is None
+
+
+def test_expired_entries_are_misses(path):
+    cache = SharedCache(path=path, slots=16, slot_size=1024, ways=4)
+    cache.set('key', 'value', ttl=-1)
+    assert cache.get('key') is None
+
+
+def test_entries_are_shared_between_instances(path):
+    SharedCache(path=path, slots=16, slot_size=1024, ways=4).set('key', 'value')
+    assert SharedCache(path=path, slots=16, slot_size=1024, ways=4).get('key') == 'value'
+
+
+def test_other_layout_replaces_the_file_instead_of_truncating_it(path):
+    old = SharedCache(path=path, slots=16, slot_size=1024, ways=4)
+    old.set('key', 'value')
+    old_inode = os.stat(path).st_ino
+
+    new = SharedCache(path=path, slots=32, slot_size=1024, ways=4)
+    assert new.get('key') is None
+    assert os.stat(path).st_ino != old_inode
+    # The old mapping still reads its own file rather than faulting
+    assert old.get('key') == 'value'
+
+
+def test_fork_reopens_and_closes_the_inherited_mapping(path):
+    cache = SharedCache(path=path, slots=16, slot_size=1024, ways=4)
+    cache.set('key', 'value')
+    inherited = cache._map
+    cache._pid = -1  # as seen from a forked child
+    assert cache.get('key') == 'value'
+    assert cache._map is not inherited
+    assert inherited.closed
+
+
+def test_lock_excludes_another_process(path):
+    cache = SharedCache(path=path, slots=16, slot_size=1024, ways=4)
+    cache.set('child', False)
+    ready, go = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.read(ready, 1)
+            # Blocks until the parent lets go
+            with cache.lock('rebuild'):
+                cache.set('child', True)
+        finally:
+            os._exit(0)
+    with cache.lock('rebuild'):
+        os.write(go, b'x')
+        time.sleep(0.2)
+        assert cache.get('child') is False
+    os.waitpid(pid, 0)
+    assert cache.get('child') is True
@@ -0,0 +1,92 @@
+import time
+from unittest import mock
+
+import pytest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import DeclarativeBase
+
+from stripe_catalog import StripeCatalog
+
+PRODUCT = 'prod_test'
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+@pytest.fixture
+def catalog():
+    db = SQLAlchemy(model_class=Base)
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['STRIPE_CATALOG_PRODUCTS'] = PRODUCT
+    db.init_app(app)
+    catalog = StripeCatalog(app, db)
+    catalog.require_voucher('SAVE30', advertised=True, percent_off=30, duration='once')
+    catalog.fallback_plan(PRODUCT, 'Standard', 599, 'usd')
+    with app.app_context():
+        db.create_all()
+        yield catalog
+    Base.metadata.clear()
+    Base.registry.dispose()
+
+
+def stripe_objects(unit_amount=599, coupons=()):
+    product = {'id': PRODUCT, 'name': 'Standard', 'active': True, 'default_price': 'price_1'}
+    price = {'id': 'price_1', 'product': PRODUCT, 'currency': 'usd', 'unit_amount': unit_amount,
+             'type': 'one_time', 'active': True}
+    coupon = {'id': 'SAVE30', 'percent_off': 30, 'valid': True}
+    return {'product': [product], 'price': [price], 'coupon': [coupon, *coupons]}
+
+
+def sync(catalog, **objects):
+    listed = stripe_objects(**objects)
+    fetched = {kind: [row for row in map(to_row, listed[kind]) if row is not None]
+               for kind, (_, to_row) in catalog.kinds.items()}
+    with mock.patch.object(catalog, '_fetch', return_value=fetched):
+        catalog.sync()
+
+
+def test_fallback_is_served_until_the_first_sync(catalog):
+    assert catalog.pricing()['plans'][0]['price']['display'] == '$5.99'
+    assert catalog.line_items() == [{'price_data': {'currency': 'usd', 'product': PRODUCT,
+                                                    'unit_amount': 599}, 'quantity': 1}]
+    assert catalog.voucher('SAVE30')['label'] == '30%'
+
+    sync(catalog)
+    assert catalog.line_items() == [{'price': 'price_1', 'quantity': 1}]
+
+
+def test_sync_bumps_the_version_only_when_rows_change(catalog):
+    sync(catalog)
+    version = catalog.version
+    sync(catalog)
+    assert catalog.version == version
+    sync(catalog, unit_amount=699)
+    assert catalog.version == version + 1
+    assert catalog.price_for(PRODUCT)['display'] == '$6.99'
+
+
+def test_events_bump_the_version_only_when_rows_change(catalog):
+    sync(catalog)
+    version = catalog.version
+    product = stripe_objects()['product'][0]
+    catalog.apply_event(dict(product, metadata={'unrelated': 'field'}), 'product.updated')
+    assert catalog.version == version
+    catalog.apply_event(dict(product, name='Premium'), 'product.updated')
+    assert catalog.version == version + 1
+    assert catalog.product()['name'] == 'Premium'
+
+
+def test_expired_vouchers_are_refused_and_pruned(catalog):
+    expiring = {'id': 'SOON', 'percent_off': 10, 'valid': True, 'redeem_by': time.time() + 60,
+                'metadata': {'voucher': 'true'}}
+    sync(catalog, coupons=[expiring])
+    assert catalog.voucher('SOON') is not None
+
+    with mock.patch('stripe_catalog.time.time', return_value=time.time() + 120):
+        assert catalog.voucher('SOON') is None
+        catalog._prune()
+    assert catalog.db.session.get(catalog.Voucher, 'SOON') is None
+    assert catalog.voucher('SAVE30') is not None
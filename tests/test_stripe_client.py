@@ -0,0 +1,90 @@
+from unittest import mock
+
+import pytest
+import stripe
+from flask import Flask
+
+from metrics import Metrics
+from stripe_client import (APIConnectionError, CircuitBreaker, PooledRequestsClient,
+                           StripeTransport, StripeUnavailable)
+
+URL = 'https://api.stripe.com/v1/coupons/Uflvb62d'
+
+
+def call(breaker, outcome):
+    """A call through the pooled client, answered with a status or raising."""
+    def answer(*args, **kwargs):
+        if isinstance(outcome, Exception):
+            raise outcome
+        return '{}', outcome, {}
+
+    with mock.patch('stripe_client.RequestsClient.request', side_effect=answer):
+        return PooledRequestsClient(breaker, 1, 1, 1).request('get', URL, {})
+
+
+def open_breaker(threshold=2):
+    breaker = CircuitBreaker(threshold=threshold, cooldown=30)
+    for _ in range(threshold):
+        with pytest.raises(APIConnectionError):
+            call(breaker, APIConnectionError('down'))
+    assert breaker.state == CircuitBreaker.OPEN
+    return breaker
+
+
+def cool_down(breaker):
+    breaker.opened_at -= breaker.cooldown
+
+
+def test_breaker_opens_after_consecutive_failures_and_rejects_calls():
+    breaker = open_breaker()
+    with pytest.raises(StripeUnavailable):
+        call(breaker, 200)
+
+
+def test_client_errors_do_not_count_as_failures():
+    breaker = CircuitBreaker(threshold=2)
+    for _ in range(3):
+        call(breaker, 404)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_trial_call_closes_or_reopens_the_breaker():
+    breaker = open_breaker()
+    cool_down(breaker)
+    call(breaker, 200)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker = open_breaker()
+    cool_down(breaker)
+    call(breaker, 503)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_trial_call_raising_something_else_reopens_the_breaker():
+    breaker = open_breaker()
+    cool_down(breaker)
+    with pytest.raises(ValueError):
+        call(breaker, ValueError('unexpected'))
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_circuit_open_gauge_follows_the_state(tmp_path, monkeypatch):
+    monkeypatch.setenv('METRICS_DIR', str(tmp_path))
+    monkeypatch.setattr(stripe, 'default_http_client', stripe.default_http_client)
+    app = Flask(__name__)
+    app.config['STRIPE_BREAKER_THRESHOLD'] = 1
+    metrics = Metrics(app)
+    breaker = StripeTransport(app).breaker
+
+    def gauge():
+        return metrics.registry.values.get(('stripe_circuit_open', ()), 0)
+
+    # Open, half open and open again: still one open breaker
+    breaker.record_failure()
+    cool_down(breaker)
+    breaker.allow()
+    breaker.record_failure()
+    assert gauge() == 1
+    breaker.record_success()
+    breaker.record_success()
+    assert gauge() == 0
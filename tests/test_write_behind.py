@@ -0,0 +1,88 @@
+import pytest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import DeclarativeBase
+
+from write_behind import WriteBehindQueue
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+db = SQLAlchemy(model_class=Base)
+
+
+class Account(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    theme = db.Column(db.String(20), default='light')
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add(Account(id=1))
+        db.session.commit()
+    return app
+
+
+def row(app):
+    with app.app_context():
+        account = db.session.get(Account, 1)
+        return account.theme, account.version
+
+
+def test_later_values_win(app):
+    flushed = []
+    queue = WriteBehindQueue(app, db, Account, on_flush=flushed.append)
+    queue.queue(1, theme='dark')
+    queue.queue(1, theme='blue')
+    queue.flush()
+    assert row(app) == ('blue', 1)
+    assert flushed == [{1: {'theme': 'blue'}}]
+
+
+def save_settings(app, theme):
+    """A settings save, committed directly from another worker."""
+    with app.app_context():
+        account = db.session.get(Account, 1)
+        account.theme = theme
+        account.version = Account.version + 1
+        db.session.commit()
+
+
+def test_versioned_write_lands_on_the_version_it_was_based_on(app):
+    flushed = []
+    queue = WriteBehindQueue(app, db, Account, version='version', on_flush=flushed.append)
+    queue.queue(1, theme='dark', version=1)
+    queue.flush()
+    assert row(app) == ('dark', 2)
+    assert flushed == [{1: {'theme': 'dark', 'version': 2}}]
+
+
+def test_versioned_write_skips_a_row_that_moved_on(app):
+    flushed = []
+    queue = WriteBehindQueue(app, db, Account, version='version', on_flush=flushed.append)
+    queue.queue(1, theme='dark', version=1)
+    save_settings(app, 'light')
+    queue.flush()
+    assert row(app) == ('light', 2)
+    assert flushed == []
+
+
+def test_toggles_queued_before_a_settings_save_elsewhere_are_dropped(app):
+    toggles = WriteBehindQueue(app, db, Account, version='version')
+    # Two toggles from a session that read the row at version 1
+    toggles.queue(1, theme='dark', version=1)
+    toggles.queue(1, theme='blue', version=1)
+    # Another worker's queue holds nothing for the row; its save commits directly
+    other = WriteBehindQueue(app, db, Account, version='version')
+    other.discard(1)
+    save_settings(app, 'green')
+    toggles.flush()
+    assert row(app) == ('green', 2)
@@ -0,0 +1,131 @@
+"""
+DiscoBots.fr - Write-behind persistence for user preferences
+
+Clicking the theme or language toggle shouldn't wait for a database commit.
+The new value is applied to the session straight away and queued here; the
+queue keeps only the latest values per user and writes them all in one
+transaction every few seconds, and once more when the worker exits.
+
+A queued write is lost if the worker is killed outright, which is acceptable
+for display preferences. Use a normal commit for anything that matters.
+
+With version='version', each queued write carries the version the row had
+when the caller read it, and only lands if the row still has that version,
+bumping it by one. A settings save committed directly, or a toggle flushed
+by another worker, then isn't overwritten by a write based on what came
+before it, wherever that write was queued. on_flush only sees the writes
+whose values the rows hold afterwards, with the version the rows now have.
+
+Usage:
+    preferences = WriteBehindQueue(app, db, User, version='version', on_flush=publish)
+    preferences.queue(user.id, theme='dark', version=user.version)
+"""
+
+import atexit
+import os
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import bindparam, select, update
+
+class WriteBehindQueue:
+    def __init__(self, app=None, db=None, model=None, version=None, on_flush=None):
+        self.on_flush = on_flush
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread_pid = None
+        if app is not None:
+            self.init_app(app, db, model, version)
+
+    def init_app(self, app, db, model, version=None):
+        app.config.setdefault('WRITE_BEHIND_INTERVAL', 2.0)
+        self.app = app
+        self.db = db
+        self.model = model
+        self.version = version
+        self.interval = app.config['WRITE_BEHIND_INTERVAL']
+        app.extensions['write_behind'] = self
+        atexit.register(self.flush)
+
+    def queue(self, key, **values):
+        """Record values for the row with primary key key; later calls win."""
+        with self._lock:
+            self._pending.setdefault(key, {}).update(values)
+        self._ensure_thread()
+
+    def discard(self, key):
+        """Drop the values queued for key, e.g. before a direct write."""
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def _ensure_thread(self):
+        # Threads don't survive fork, so each worker starts its own
+        if self._thread_pid != os.getpid():
+            with self._lock:
+                if self._thread_pid != os.getpid():
+                    threading.Thread(target=self._run, daemon=True,
+                                     name='write-behind').start()
+                    self._thread_pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Write-behind flush failed')
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        # Rows updating the same columns go out as one executemany
+        batches = defaultdict(list)
+        for key, values in pending.items():
+            # _key and _version are bound in WHERE, where the column names are taken
+            row = {'_key': key, **values}
+            if self.version in row:
+                row['_version'] = row.pop(self.version)
+            batches[tuple(sorted(row))].append(row)
+
+        table = self.model.__table__
+        key_column = table.primary_key.columns[0]
+        with self.app.app_context():
+            try:
+                for columns, rows in batches.items():
+                    statement = update(table).where(key_column == bindparam('_key'))
+                    if '_version' in columns:
+                        version = table.c[self.version]
+                        statement = (statement.where(version == bindparam('_version'))
+                                     .values({version: version + 1}))
+                    self.db.session.execute(statement, rows)
+                landed = pending
+                if self.version is not None:
+                    landed = self._landed(pending, table, key_column)
+                self.db.session.commit()
+            except Exception:
+                self.db.session.rollback()
+                # Put the values back unless newer ones arrived meanwhile
+                with self._lock:
+                    for key, values in pending.items():
+                        self._pending[key] = {**values, **self._pending.get(key, {})}
+                raise
+            if self.on_flush is not None and landed:
+                self.on_flush(landed)
+
+    def _landed(self, pending, table, key_column):
+        """The pending writes whose values the rows now hold, with their versions."""
+        columns = sorted({column for values in pending.values() for column in values}
+                         | {self.version})
+        rows = self.db.session.execute(
+            select(key_column, *(table.c[column] for column in columns))
+            .where(key_column.in_(pending))).mappings()
+        current = {row[key_column.name]: row for row in rows}
+        return {key: dict(values, **{self.version: current[key][self.version]})
+                for key, values in pending.items()
+                if key in current and all(current[key][column] == value
+                                          for column, value in values.items()
+                                          if column != self.version)}